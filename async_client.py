@@ -0,0 +1,347 @@
+'''
+This file implements an asyncio client library for programs that use the chat application (e.g., services
+that send messages in bulk), and a command line tool that sends the messages of a file as fast as possible.
+
+ChatClient exposes create, login, send, list_users and fetch_mailbox as coroutines. Instead of lines of
+input for the interactive menus, it sends structured requests (MSG_REQUEST, see chat.py) that carry a
+whole operation and are answered with its status. Requests are pipelined: every coroutine writes its
+request immediately and waits for its own answer, so many requests can be outstanding on one
+connection (e.g., with asyncio.gather()), and answers are matched to requests by their ID.
+
+Like client.py, ChatClient learns the backup IP addresses from the leader's MSG_INIT, detects a failed
+leader with heartbeats, and fails over to whichever server takes over. It then resumes its session and
+retransmits every request that was not answered (the leader never delivers a retransmitted message
+twice). It follows redirects to the home shard of a username in a sharded deployment.
+
+Usage: python3 async_client.py IP_ADDRESS PORT USERNAME PASSWORD FILE [--create] [--window N]
+       (each line of FILE is 'RECIPIENT MESSAGE')
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+from collections import Counter, deque
+from time import monotonic
+import asyncio
+import json
+
+from async_server import read_frame
+from chat import REQUEST_CREATE, REQUEST_LOGIN, REQUEST_SEND, CREATED, LOGGED_IN, LOGIN_FAILED, REDIRECTED, TAKEN
+from leader_probe import PROBE_TIMEOUT
+from protocol import encode_frame, MSG_TEXT, MSG_INIT, MSG_HEARTBEAT, MSG_SESSION, MSG_RESUME, MSG_MAIL, MSG_MAIL_ACK, MSG_LIST, MSG_LOOKUP, MSG_REQUEST
+import heartbeat
+
+# Constants/configurations
+ENCODING = 'utf-8' # message encoding
+WINDOW   = 256 # requests the command line tool keeps outstanding
+
+# Connects to every candidate server in parallel, like probe_leaders() in leader_probe.py: the first server to answer is the leader.
+# Returns (server index, StreamReader, StreamWriter, first frame) of the new leader, or None if no server answers within timeout seconds.
+async def probe_leaders_async(candidates, timeout):
+    async def probe(index, address):
+        reader, writer = await asyncio.open_connection(*address)
+        try:
+            frame = await read_frame(reader)
+        except BaseException:
+            writer.close()
+            raise
+        if frame is None:
+            writer.close()
+            raise ConnectionError('server closed the connection')
+        return index, reader, writer, frame
+
+    pending = {asyncio.ensure_future(probe(index, address)) for index, address in candidates}
+    winner = None
+    deadline = monotonic() + timeout
+    while pending and winner is None and monotonic() < deadline:
+        done, pending = await asyncio.wait(pending, timeout=deadline - monotonic(), return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is not None:
+                continue # connection refused (server is down)
+            if winner is None:
+                winner = task.result()
+            else:
+                task.result()[2].close()
+    for task in pending:
+        task.cancel()
+    return winner
+
+# Connection of one user to the chat application
+class ChatClient:
+    def __init__(self, ip_address, port):
+        self.servers     = [ip_address] # IP addresses of the servers (indexed by machine number, from MSG_INIT)
+        self.port        = port # base port of the servers
+        self.leader      = 0 # machine number of the server we are connected to
+        self.reader      = None
+        self.writer      = None
+        self.detector    = None # failure detector for the leader
+        self.tasks       = [] # read loop and keepalive tasks
+        self.ready       = asyncio.Event() # set while requests can be sent (connected, and the session resumed after a failover)
+        self.closed      = False
+        self.next_id     = 0
+        self.pending     = {} # request ID -> (request, Future of its answer), in the order they were sent
+        self.reads       = deque() # (frame, Future) of MSG_LIST and MSG_LOOKUP requests, answered in order
+        self.session     = None # {username, token} recieved after logging in (to resume after a failover)
+        self.credentials = None # (username, password) to log in again if the session cannot be resumed
+        self.mail        = [] # queued messages ('<sender> body') recieved after logging in
+        self.inbox       = [] # live messages ('<sender> body') recieved from online senders
+        self.mail_seen   = 0 # cursor up to which queued messages have been recieved (a new leader may resend some)
+        self.mail_done   = asyncio.Event() # cleared while the pages of queued messages are arriving
+        self.mail_done.set()
+
+    async def connect(self):
+        reader, writer = await asyncio.open_connection(self.servers[self.leader], self.port + self.leader)
+        self.start(reader, writer)
+
+    async def close(self):
+        self.closed = True
+        for task in self.tasks:
+            task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+        for _, future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('client closed'))
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def start(self, reader, writer, frame=None):
+        self.reader, self.writer = reader, writer
+        self.detector = heartbeat.new_detector()
+        for task in self.tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        self.tasks = [asyncio.ensure_future(self.read_loop(frame)), asyncio.ensure_future(self.keepalive())]
+        self.ready.set()
+
+    # Creates an account (and logs in). Returns CREATED, TAKEN, or INVALID (see chat.py).
+    async def create(self, username, password):
+        answer = await self.request({'op': REQUEST_CREATE, 'username': username, 'password': password})
+        if answer['status'] == CREATED:
+            self.credentials = (username, password)
+        return answer['status']
+
+    # Logs in. Returns LOGGED_IN, LOGIN_FAILED, or INVALID (see chat.py). Queued messages are then recieved in the background.
+    async def login(self, username, password):
+        answer = await self.request({'op': REQUEST_LOGIN, 'username': username, 'password': password})
+        if answer['status'] == LOGGED_IN:
+            self.credentials = (username, password)
+        return answer['status']
+
+    # Sends a message. Returns DELIVERED (to the online recipient), MAILBOX, UNKNOWN (no such user), DUPLICATE (already
+    # sent before a failover), UNAVAILABLE (the recipient's shard did not answer), or NOT_LOGGED_IN (see chat.py).
+    async def send(self, to, body):
+        answer = await self.request({'op': REQUEST_SEND, 'to': to, 'body': body})
+        return answer['status']
+
+    # Returns one page of usernames in alphabetical order ({users, offset, total, cursor} with the cursor of the next page, see directory.py)
+    async def list_users(self, prefix='', cursor=None, size=None):
+        request = {'prefix': prefix, 'cursor': cursor}
+        if size is not None:
+            request['size'] = size
+        return await self.read(MSG_LIST, request)
+
+    # Returns the messages recieved since the last call ('<sender> body'): queued ones, then live ones. If the messages queued
+    # while the user was offline are still arriving, waits for the last page of them (a new account has none).
+    async def fetch_mailbox(self):
+        await self.mail_done.wait()
+        messages, self.mail, self.inbox = self.mail + self.inbox, [], []
+        return messages
+
+    # Sends a structured request and waits for its answer (retransmitted after a failover)
+    async def request(self, request):
+        self.next_id += 1
+        request = dict(request, id=self.next_id)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request['id']] = (request, future)
+        if self.ready.is_set():
+            self.write([(MSG_REQUEST, request)])
+        await self.drain()
+        return await future
+
+    # Sends a read-only request (answered in order)
+    async def read(self, msg_type, request):
+        frame = (msg_type, request)
+        future = asyncio.get_running_loop().create_future()
+        self.reads.append((frame, future))
+        if self.ready.is_set():
+            self.write([frame])
+        await self.drain()
+        return await future
+
+    def write(self, frames):
+        try:
+            self.writer.write(b''.join(encode_frame(msg_type, json.dumps(payload).encode(encoding=ENCODING)) for msg_type, payload in frames))
+        except (OSError, RuntimeError):
+            pass # retransmitted once we have reconnected
+
+    # Waits until the connection's buffer has room (backpressure on callers that pipeline many requests)
+    async def drain(self):
+        try:
+            await self.writer.drain()
+        except (ConnectionError, RuntimeError):
+            pass
+
+    # Retransmits every request that was not answered yet, in order
+    def retransmit(self):
+        frames = [(MSG_REQUEST, request) for request, _ in self.pending.values()]
+        frames.extend(frame for frame, _ in self.reads)
+        self.write(frames)
+
+    # Pings an idle leader, and drops the connection once it has been silent for too long (the read loop then fails over)
+    async def keepalive(self):
+        while True:
+            await asyncio.sleep(heartbeat.HEARTBEAT_INTERVAL)
+            if self.detector.suspect():
+                self.writer.transport.abort()
+                return
+            if self.detector.silence() >= heartbeat.HEARTBEAT_INTERVAL:
+                self.writer.write(encode_frame(MSG_HEARTBEAT, b''))
+
+    async def read_loop(self, frame=None):
+        while True:
+            if frame is None:
+                frame = await read_frame(self.reader)
+                if frame is None:
+                    break
+            self.detector.heartbeat()
+            self.handle(*frame)
+            frame = None
+        if not self.closed:
+            await self.fail_over()
+
+    def handle(self, msg_type, payload):
+        if msg_type == MSG_REQUEST:
+            answer = json.loads(payload.decode(encoding=ENCODING))
+            if answer['status'] == REDIRECTED:
+                asyncio.ensure_future(self.redirect(answer))
+                return
+            _, future = self.pending.pop(answer['id'], (None, None))
+            if future is not None and not future.done():
+                future.set_result(answer)
+        elif msg_type in (MSG_LIST, MSG_LOOKUP):
+            _, future = self.reads.popleft()
+            if not future.done():
+                future.set_result(json.loads(payload.decode(encoding=ENCODING)))
+        # Backup IP addresses (indexed by machine number, so only from the first leader)
+        elif msg_type == MSG_INIT:
+            if len(self.servers) == 1:
+                self.servers.extend(payload.decode(encoding=ENCODING).split(',')[:-1])
+        elif msg_type == MSG_SESSION:
+            self.session = json.loads(payload.decode(encoding=ENCODING))
+        # Page of queued messages: keep those not seen yet and acknowledge the page (which requests the next ones)
+        elif msg_type == MSG_MAIL:
+            page = json.loads(payload.decode(encoding=ENCODING))
+            self.mail.extend(text for cursor, text in enumerate(page['messages'], start=page['start']) if cursor >= self.mail_seen)
+            cursor = page['start'] + len(page['messages'])
+            self.mail_seen = max(self.mail_seen, cursor)
+            self.writer.write(encode_frame(MSG_MAIL_ACK, str(cursor).encode(encoding=ENCODING)))
+            if page['remaining'] == 0:
+                self.mail_done.set()
+            else:
+                self.mail_done.clear()
+        # Resumed on a new leader: retransmit what was not answered, or log in again if the session expired
+        elif msg_type == MSG_RESUME:
+            if not json.loads(payload.decode(encoding=ENCODING))['ok'] and self.credentials is not None:
+                self.session = None
+                self.next_id += 1
+                username, password = self.credentials
+                self.write([(MSG_REQUEST, {'id': self.next_id, 'op': REQUEST_LOGIN, 'username': username, 'password': password})])
+            self.retransmit()
+            self.ready.set()
+        # Message from another user (prompts of the interactive menus are ignored)
+        elif msg_type == MSG_TEXT:
+            text = payload.decode(encoding=ENCODING)
+            if text.startswith('<'):
+                self.inbox.append(text)
+
+    # The leader failed: connect to whichever server takes over, and resume the session there
+    async def fail_over(self):
+        self.ready.clear()
+        self.writer.close()
+        candidates = [(index, (address, self.port + index)) for index, address in enumerate(self.servers)]
+        winner = await probe_leaders_async(candidates, PROBE_TIMEOUT)
+        if winner is None:
+            for _, future in list(self.pending.values()) + list(self.reads):
+                if not future.done():
+                    future.set_exception(ConnectionError('no server of the chat application answered'))
+            self.pending.clear()
+            self.reads.clear()
+            return
+        self.leader, reader, writer, frame = winner
+        self.start(reader, writer, frame)
+        if self.session is not None:
+            self.ready.clear()
+            writer.write(encode_frame(MSG_RESUME, json.dumps(self.session).encode(encoding=ENCODING)))
+        else:
+            self.retransmit()
+
+    # The username belongs to another shard: send the unanswered requests (starting with the login) to its home shard
+    async def redirect(self, answer):
+        self.ready.clear()
+        for task in self.tasks:
+            task.cancel()
+        self.writer.close()
+        self.servers, self.port, self.leader = [answer['ip']], answer['port'], 0
+        reader, writer = await asyncio.open_connection(answer['ip'], answer['port'])
+        self.start(reader, writer)
+        self.retransmit()
+
+# Sends every message of a file, keeping up to window requests outstanding. Returns the number of messages per status.
+async def send_file(client, path, window):
+    statuses = Counter()
+    slots = asyncio.Semaphore(window)
+
+    async def send(recipient, body):
+        try:
+            statuses[await client.send(recipient, body)] += 1
+        finally:
+            slots.release()
+
+    sends = []
+    with open(path, encoding=ENCODING) as lines:
+        for line in lines:
+            recipient, _, body = line.rstrip('\n').partition(' ')
+            if not recipient:
+                continue
+            await slots.acquire()
+            sends.append(asyncio.ensure_future(send(recipient, body)))
+    await asyncio.gather(*sends)
+    return statuses
+
+async def run(args):
+    async with ChatClient(args.ip_address, args.port) as client:
+        status = await client.create(args.username, args.password) if args.create else TAKEN
+        if status == TAKEN:
+            status = await client.login(args.username, args.password)
+        if status == LOGIN_FAILED:
+            print('Could not log in as {}.'.format(args.username))
+            return
+        print('Logged in as {} @ {}:{}'.format(args.username, client.servers[client.leader], client.port + client.leader))
+        start = monotonic()
+        statuses = await send_file(client, args.file, args.window)
+        elapsed = monotonic() - start
+        total = sum(statuses.values())
+        print('Sent {} messages in {:.3f}s ({:.0f} messages/s): {}'.format(total, elapsed, total / max(elapsed, 1e-9), dict(statuses)))
+
+def main():
+    parser = ArgumentParser(description='Sends the messages of a file (one "RECIPIENT MESSAGE" per line) as fast as possible.')
+    parser.add_argument('ip_address', metavar='IP_ADDRESS')
+    parser.add_argument('port', metavar='PORT', type=int)
+    parser.add_argument('username', metavar='USERNAME')
+    parser.add_argument('password', metavar='PASSWORD')
+    parser.add_argument('file', metavar='FILE')
+    parser.add_argument('--create', action='store_true', help='create the account first (log in if it already exists)')
+    parser.add_argument('--window', type=int, default=WINDOW, help='requests kept outstanding (default: {})'.format(WINDOW))
+    heartbeat.add_arguments(parser)
+    # A thread-per-client leader cannot answer heartbeats while it waits for a backup to be suspected, so clients wait longer by default
+    parser.set_defaults(failure_timeout=2*heartbeat.FAILURE_TIMEOUT)
+    args = parser.parse_args()
+    heartbeat.configure(args.heartbeat_interval, args.failure_timeout, args.phi_threshold)
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
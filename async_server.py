@@ -0,0 +1,166 @@
+'''
+This file implements the asyncio-based leader server mode of the chat application.
+
+Instead of one thread per client, every client connection is a ChatSession state machine driven
+by a single event loop, so idle connections only cost a socket and a small amount of memory.
+
+Usage: python3 server.py LEADER_IP MACHINE_NUM --mode async
+'''
+# Import relevant python packages
+from socket import SOMAXCONN
+import asyncio
+import resource
+
+from chat import ChatSession, CLOSED
+from outbound import POLICY_MAILBOX, POLICY_DROP
+import log
+import outbound
+import sharding
+from protocol import FrameBuffer, encode_frame, HEADER, MAX_FRAME_SIZE, RECV_SIZE, MSG_TEXT, MSG_INIT
+
+# Constants/configurations
+ENCODING = 'utf-8' # message encoding
+
+# Connection wrapper with the same send interface as QueuedSocket (see outbound.py).
+# Writes are buffered by the event loop, which is the single writer; the transport's buffer is the outbound queue.
+class AsyncConnection:
+    def __init__(self, writer, limit=None, policy=None):
+        self.writer   = writer
+        self.limit    = outbound.OUTBOUND_LIMIT if limit is None else limit
+        self.policy   = outbound.OUTBOUND_POLICY if policy is None else policy
+        self.reserved = 0 # bytes reserved for messages from other sessions that are not written yet
+        writer.transport.set_write_buffer_limits(high=self.limit)
+
+    def queued(self):
+        return self.writer.transport.get_write_buffer_size() + self.reserved
+
+    # Reserves room for a message from another session. Returns False if the message has to go to the mailbox instead.
+    def reserve(self, size):
+        if self.writer.is_closing():
+            return False
+        if self.queued() > 0 and self.queued() + size > self.limit:
+            if self.policy == POLICY_MAILBOX:
+                return False
+            if self.policy == POLICY_DROP:
+                log.warning('LEADER: dropping slow connection with {} bytes queued', self.queued())
+                self.writer.transport.abort()
+                return False
+        self.reserved += size
+        return True
+
+    # Queues an encoded message for which room was reserved (a broadcast queues the same bytes on every connection)
+    def send_reserved(self, data):
+        self.reserved -= len(data)
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    # Waits until the transport's buffer has drained below its limit
+    async def wait_for_room(self):
+        if not self.writer.is_closing():
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                pass # the connection's own session notices the disconnect
+
+    def send_frames(self, frames):
+        self.writer.write(b''.join(encode_frame(msg_type, payload) for msg_type, payload in frames))
+
+    def send_frame(self, msg_type, payload):
+        self.writer.write(encode_frame(msg_type, payload))
+
+    def send_text(self, text):
+        self.send_frame(MSG_TEXT, text.encode(encoding=ENCODING))
+
+    def close(self):
+        self.writer.close()
+
+# Reads a complete frame from an asyncio stream. Returns None if the peer has disconnected.
+async def read_frame(reader):
+    try:
+        header = await reader.readexactly(HEADER.size)
+        length, msg_type = HEADER.unpack(header)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError('Frame of {} bytes exceeds MAX_FRAME_SIZE'.format(length))
+        payload = await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    return msg_type, payload
+
+# Reads frames from an asyncio stream into a FrameBuffer, so frames a client sent back-to-back are taken without waiting (see ChatSession.handle_frames())
+class FrameReader(FrameBuffer):
+    def __init__(self, reader):
+        super().__init__()
+        self.reader = reader
+
+    # Waits for the next complete frame. Returns None if the peer has disconnected.
+    async def recv_frame(self):
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            try:
+                data = await self.reader.read(RECV_SIZE)
+            except ConnectionError:
+                return None
+            if not data:
+                return None
+            self.feed(data)
+
+# Coroutine for server to interact with each client user in chat application (worker processes run a subclass of ChatSession, see workers.py)
+async def client_session(reader, writer, users, active_sockets, replicator, server_addrs, session_class=ChatSession):
+    addr = writer.get_extra_info('peername')
+    sock = AsyncConnection(writer)
+    active_sockets.add(sock) # update active sockets set
+    log.debug('LEADER: {}:{} connected', addr[0], addr[1])
+
+    # For initialization, send to client all backup IPs
+    message = ''
+    for server_address in server_addrs[1:]:
+        message += server_address
+        message += ','
+    sock.send_frame(MSG_INIT, message.encode(encoding=ENCODING))
+
+    session = session_class(sock, addr, users, active_sockets, replicator)
+    frames = FrameReader(reader)
+    try:
+        session.start()
+        session.flush()
+        while session.state != CLOSED:
+            frame = await frames.recv_frame()
+            if frame is None:
+                break
+            session.handle_frames(frame, frames.next_frame)
+            # Wait for another shard to answer a forwarded message
+            if session.forward is not None:
+                session.forwarded(await sharding.wait_async(session.forward))
+            # Reply once the replication quorum has acknowledged the state changes
+            await session.wait_committed()
+            # Apply backpressure if the client (or, with the block policy, a recipient) is not reading
+            for connection in session.flush():
+                await connection.wait_for_room()
+    # If we're unable to send a message, close connection.
+    except Exception as e:
+        log.debug('LEADER: closing {}:{} ({})', addr[0], addr[1], e)
+    session.disconnect()
+
+# Raises the open file descriptor limit so the event loop can hold as many connections as the OS allows
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+async def serve_forever(server, users, active_sockets, replicator, server_addrs):
+    async def on_connect(reader, writer):
+        await client_session(reader, writer, users, active_sockets, replicator, server_addrs)
+
+    # start_server listens on the socket again: keep the server's backlog instead of asyncio's default (100),
+    # which overflows when many clients connect at once
+    async_server = await asyncio.start_server(on_connect, sock=server, backlog=SOMAXCONN)
+    async with async_server:
+        await async_server.serve_forever()
+
+# Main leader server loop (asyncio mode) on an already listening server socket
+def serve(server, users, active_sockets, replicator, server_addrs):
+    raise_fd_limit()
+    server.settimeout(None)
+    asyncio.run(serve_forever(server, users, active_sockets, replicator, server_addrs))
@@ -0,0 +1,166 @@
+'''
+This file benchmarks the thread-per-client and asyncio leader server modes against each other, and
+the asyncio mode against leaders that serve clients from several worker processes (see workers.py).
+
+For each mode, a leader server (without backups) is started on loopback and
+    1. IDLE clients connect and wait at the welcome prompt; we report connection setup time,
+       and the server's resident memory (RSS) and thread count while holding them (of all its processes).
+    2. ACTIVE clients create an account and each issue REQUESTS "List all users" requests;
+       we report throughput and latency percentiles. The active clients are split across CLIENT_PROCESSES
+       processes, so a single client process does not cap the throughput of a server using several cores.
+
+Usage: python3 benchmark.py [--modes thread async] [--workers WORKERS ...] [--idle IDLE] [--active ACTIVE] [--requests REQUESTS]
+                            [--client-processes CLIENT_PROCESSES] [--port PORT]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from socket import create_connection
+from time import perf_counter, sleep
+import asyncio
+import os
+import subprocess
+import sys
+
+from async_server import read_frame, raise_fd_limit
+from chat import WELCOME_PROMPT, MENU_PROMPT
+from protocol import encode_frame, MSG_TEXT
+
+# Constants/configurations
+ENCODING     = 'utf-8' # message encoding
+SERVER_IP    = '127.0.0.1'
+PORT         = 4234 # base application port for benchmark leader server
+CONNECT_RATE = 500 # maximum number of concurrent connection attempts
+
+# Starts a leader server without backups in a subprocess and waits until it accepts connections
+def start_server(mode, port, workers=1):
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    process = subprocess.Popen([sys.executable, server_path, SERVER_IP, '0', '--ip', SERVER_IP, '--port', str(port),
+                                '--replicas', '0', '--mode', mode, '--workers', str(workers)], stdout=subprocess.DEVNULL)
+    while True:
+        try:
+            create_connection((SERVER_IP, port)).close()
+            return process
+        except ConnectionRefusedError:
+            sleep(0.05)
+
+# Reads /proc/PID/status for the server's resident memory (in KB) and number of threads, summed over its worker processes
+def process_stats(pid):
+    stats = {'VmRSS': 0, 'Threads': 0}
+    with open('/proc/{}/status'.format(pid)) as status:
+        for line in status:
+            key, value = line.split(':', 1)
+            if key in stats:
+                stats[key] += int(value.split()[0])
+    with open('/proc/{}/task/{}/children'.format(pid, pid)) as children:
+        for child in children.read().split():
+            for key, value in process_stats(int(child)).items():
+                stats[key] += value
+    return stats
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+# Sends one line of client input
+def send(writer, text):
+    writer.write(encode_frame(MSG_TEXT, text.encode(encoding=ENCODING)))
+
+# Reads frames until the server sends the given prompt
+async def expect(reader, prompt):
+    while True:
+        frame = await read_frame(reader)
+        if frame is None:
+            raise ConnectionError('server disconnected while waiting for prompt')
+        if frame[1].decode(encoding=ENCODING) == prompt:
+            return
+
+async def connect(port, limit):
+    async with limit:
+        reader, writer = await asyncio.open_connection(SERVER_IP, port)
+        await expect(reader, WELCOME_PROMPT)
+    return reader, writer
+
+# Opens idle connections and samples server process stats while holding them
+async def idle_phase(port, num_clients, pid):
+    limit = asyncio.Semaphore(CONNECT_RATE)
+    start = perf_counter()
+    connections = await asyncio.gather(*[connect(port, limit) for _ in range(num_clients)])
+    elapsed = perf_counter() - start
+    await asyncio.sleep(0.5) # let the server finish starting client threads
+    stats = process_stats(pid)
+    for _, writer in connections:
+        writer.close()
+    return elapsed, stats
+
+async def active_client(port, limit, client_id, num_requests, latencies):
+    reader, writer = await connect(port, limit)
+    for text in ['1', 'bench_{}'.format(client_id), 'password']:
+        send(writer, text)
+    await expect(reader, MENU_PROMPT)
+
+    for _ in range(num_requests):
+        start = perf_counter()
+        send(writer, '2')
+        await expect(reader, MENU_PROMPT)
+        latencies.append(perf_counter() - start)
+    writer.close()
+
+async def active_clients(port, first_id, num_clients, num_requests):
+    limit = asyncio.Semaphore(CONNECT_RATE)
+    latencies = []
+    await asyncio.gather(*[active_client(port, limit, first_id + i, num_requests, latencies) for i in range(num_clients)])
+    return latencies
+
+# Runs one client process's share of the active clients. Returns their latencies.
+def run_active_clients(port, first_id, num_clients, num_requests):
+    raise_fd_limit()
+    return asyncio.run(active_clients(port, first_id, num_clients, num_requests))
+
+# Splits the active clients across client processes. Returns the latencies of all requests and the elapsed time.
+def active_phase(port, num_clients, num_requests, num_processes):
+    counts = [num_clients // num_processes + (index < num_clients % num_processes) for index in range(num_processes)]
+    shares = [(port, sum(counts[:index]), count, num_requests) for index, count in enumerate(counts)]
+    with Pool(num_processes) as pool:
+        start = perf_counter()
+        results = pool.starmap(run_active_clients, shares)
+        elapsed = perf_counter() - start
+    return [latency for latencies in results for latency in latencies], elapsed
+
+def benchmark(mode, port, num_idle, num_active, num_requests, num_processes, workers=1):
+    process = start_server(mode, port, workers)
+    try:
+        baseline = process_stats(process.pid)
+        connect_time, idle = asyncio.run(idle_phase(port, num_idle, process.pid))
+        latencies, elapsed = active_phase(port, num_active, num_requests, num_processes)
+    finally:
+        process.terminate()
+        process.wait()
+
+    print('=== {} ==='.format('{} mode'.format(mode) if workers == 1 else '{} worker processes'.format(workers)))
+    print('idle:   {} connections in {:.2f}s, RSS {} KB -> {} KB ({:.1f} KB/connection), {} threads'.format(
+        num_idle, connect_time, baseline['VmRSS'], idle['VmRSS'],
+        (idle['VmRSS'] - baseline['VmRSS']) / max(num_idle, 1), idle['Threads']))
+    print('active: {} clients x {} requests in {:.2f}s ({:.0f} requests/s), latency p50 {:.2f} ms, p99 {:.2f} ms'.format(
+        num_active, num_requests, elapsed, len(latencies) / elapsed,
+        percentile(latencies, 0.50) * 1000, percentile(latencies, 0.99) * 1000))
+
+def main():
+    parser = ArgumentParser(description='Compare thread-per-client, asyncio, and worker process leader server modes.')
+    parser.add_argument('--modes', nargs='+', choices=['thread', 'async'], default=['thread', 'async'])
+    parser.add_argument('--workers', type=int, nargs='*', default=[], help='also benchmark leaders with these numbers of worker processes')
+    parser.add_argument('--idle', type=int, default=5000, help='number of idle client connections')
+    parser.add_argument('--active', type=int, default=100, help='number of active clients')
+    parser.add_argument('--requests', type=int, default=100, help='requests per active client')
+    parser.add_argument('--client-processes', type=int, default=1, help='processes the active clients are split across')
+    parser.add_argument('--port', type=int, default=PORT)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    for mode in args.modes:
+        benchmark(mode, args.port, args.idle, args.active, args.requests, args.client_processes)
+    for workers in args.workers:
+        benchmark('async', args.port, args.idle, args.active, args.requests, args.client_processes, workers)
+
+if __name__ == '__main__':
+    main()
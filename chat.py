@@ -0,0 +1,781 @@
+'''
+This file implements the chat application menus (welcome, login, account creation, and chatroom)
+as a per-connection state machine.
+
+A ChatSession does not read from its connection. The server (thread-per-client or asyncio) reads
+each line of client input and passes it to handle(), which moves the session to its next state and
+queues its replies. The server then waits until the replication quorum has acknowledged the
+session's state changes (commit_seq) before sending the replies with flush().
+A message for an online user is queued on the recipient's connection (see outbound.py) once it is committed.
+
+Sessions never modify 'users' themselves: every state change is an operation that the replicator
+applies under its lock, so the leader's state and the replication log always agree.
+
+Clients that number their input (MSG_INPUT) are resumable: after logging in they recieve a session
+token that is replicated with the user, and every line is acknowledged (MSG_INPUT_ACK) once its
+state changes are committed. After a failover, the client resumes the session on the new leader
+(MSG_RESUME) and retransmits the lines it has not seen acknowledged. The ID of the last message sent
+by each session is replicated too, so a retransmitted message is never delivered twice.
+
+Queued messages are delivered on login in pages of MAIL_PAGE_SIZE messages (MSG_MAIL), at most
+MAIL_WINDOW pages ahead of what the client has acknowledged (MSG_MAIL_ACK). Every message has a
+cursor (its position among all messages ever queued for the user), and only acknowledged messages
+are removed from the mailbox, so a connection that drops halfway through loses nothing.
+
+In a sharded deployment (see sharding.py), a client entering the username of another shard's user
+to log in or create an account is redirected to that shard (MSG_REDIRECT). A message for a user of
+another shard is forwarded to its leader; the session answers the client once that shard has answered.
+The leaders of other shards connect like clients and send forwarded requests (MSG_FORWARD), which any
+session handles like a message sent by one of its own users, once the connection has authenticated
+itself with the deployment's shared secret (FORWARD_HELLO). Other connections cannot forward.
+
+Programmatic clients (see async_client.py) send structured requests instead of lines of input
+(MSG_REQUEST): each request carries a whole operation (create an account, log in, or send a message)
+and is answered with its status once its state changes are committed. Requests are numbered like
+resumable input, so a message retransmitted after a failover is never delivered twice either.
+
+A message can also be broadcast to a named group or to all users. It is encoded once, and the same
+bytes are queued on every online recipient's connection. A single replicated operation (OP_BROADCAST)
+queues it in the mailboxes of all other recipients, where it is stored once (see BODIES in store.py).
+In a sharded deployment, it is forwarded to every other shard, which delivers it to its own users.
+'''
+# Import relevant python packages
+from secrets import token_hex
+from time import perf_counter
+import json
+
+from directory import LIST_PAGE_SIZE
+from outbound import POLICY_BLOCK
+from protocol import encode_frame, MSG_TEXT, MSG_HEARTBEAT, MSG_SESSION, MSG_RESUME, MSG_INPUT, MSG_INPUT_ACK, MSG_MAIL, MSG_MAIL_ACK, MSG_LIST, MSG_REDIRECT, MSG_FORWARD, MSG_LOOKUP, MSG_REQUEST
+from replication import OP_CREATE_USER, OP_DELETE_USER, OP_APPEND_MAIL, OP_DRAIN_MAIL, OP_CREATE_SESSION, OP_SENT, OP_ADOPT_USER, OP_JOIN_GROUP, OP_LEAVE_GROUP, OP_BROADCAST
+from sharding import remote_home, FORWARD_MAIL, FORWARD_ADOPT, FORWARD_BROADCAST, DELIVERED, MAILBOX, UNKNOWN, ADOPTED, EXISTS, ACCEPTED, REJECTED
+from store import format_message
+import log
+import metrics
+import sharding
+
+# Constants/configurations
+ENCODING       = 'utf-8' # message encoding
+LOGIN_ATTEMPTS = 3
+MAIL_PAGE_SIZE = 100 # queued messages per MSG_MAIL page
+MAIL_WINDOW    = 4 # pages sent ahead of the client's acknowledgements
+PIPELINE_DEPTH = 256 # frames a client sent back-to-back that are handled before waiting for replication once
+
+WELCOME_PROMPT = '\nPlease enter 1 or 2 :\n1. Create account.\n2. Login'
+MENU_PROMPT    = ('\nPlease enter 1, 2, 3, 4, or 5:\n1. Send message.\n2. List all users.\n3. Delete your account.'
+                  '\n4. Send message to a group (or to all users).\n5. Join or leave a group.')
+ALL_USERS      = '*' # group name that broadcasts to all users
+
+# Replies to a sent message depending on where it went (see sharding.py for the statuses)
+SEND_REPLIES = {
+    DELIVERED: '\nMessage delivered to active user.\n',
+    MAILBOX:   '\nMessage delivered to mailbox.\n',
+    UNKNOWN:   'Target user {} does not exist!\n',
+}
+
+# Operations of structured requests (MSG_REQUEST)
+REQUEST_CREATE = 'create' # {id, op, username, password}
+REQUEST_LOGIN  = 'login'  # {id, op, username, password}: also answered with the number of queued messages (sent as MSG_MAIL pages)
+REQUEST_SEND   = 'send'   # {id, op, to, body}
+
+# Statuses of structured requests (besides DELIVERED, MAILBOX and UNKNOWN for sent messages)
+CREATED       = 'created'
+TAKEN         = 'taken' # username already taken
+LOGGED_IN     = 'logged_in'
+LOGIN_FAILED  = 'login_failed'
+REDIRECTED    = 'redirected' # the username belongs to another shard (also answered with the shard and its IP address and port)
+DUPLICATE     = 'duplicate' # retransmitted message that was already sent before a failover
+UNAVAILABLE   = 'unavailable' # the recipient's shard did not answer
+NOT_LOGGED_IN = 'not_logged_in'
+INVALID       = 'invalid' # unknown operation, or account operation while logged in
+
+# Names of the requests timed in REQUEST_SECONDS: lines of client input are named after the state that handles them
+# (menu choices after the choice), and other frames after their type
+MENU_REQUESTS = {'1': 'menu_send', '2': 'menu_list', '3': 'menu_delete', '4': 'menu_group_send', '5': 'menu_group_join'}
+FRAME_REQUESTS = {MSG_RESUME: 'resume', MSG_MAIL_ACK: 'mail_ack', MSG_LIST: 'list', MSG_FORWARD: 'forward', MSG_LOOKUP: 'lookup', MSG_HEARTBEAT: 'heartbeat'}
+
+# Metrics (see metrics.py)
+REQUEST_SECONDS = metrics.Histogram('chat_request_seconds', 'Seconds from recieving a request until its replies are sent (including the replication quorum wait)', label_name='request')
+MESSAGES        = metrics.Counter('chat_messages_total', 'Messages sent to users, by whether they were delivered to an online user or queued in a mailbox', label_name='route')
+
+# Session states (i.e., what the next line of client input is expected to be)
+WELCOME         = 'welcome' # choice of 1) create account or 2) login
+CREATE_USERNAME = 'create_username'
+CREATE_PASSWORD = 'create_password'
+LOGIN_USERNAME  = 'login_username'
+LOGIN_PASSWORD  = 'login_password'
+MENU            = 'menu' # choice of 1) send message, 2) list all users, or 3) delete account
+SEND_TARGET     = 'send_target'
+SEND_MESSAGE    = 'send_message'
+DELETE_CONFIRM  = 'delete_confirm'
+GROUP_TARGET    = 'group_target' # group (or ALL_USERS) to send a message to
+GROUP_MESSAGE   = 'group_message'
+GROUP_NAME      = 'group_name' # group to join or leave
+CLOSED          = 'closed'
+
+# Remove sock from active sockets
+def remove_connection(sock, addr, active_sockets):
+    assert sock in active_sockets, 'ERROR: remove_connection encountered corrupted active_sockets'
+    active_sockets.remove(sock)
+    sock.close()
+    log.debug('Removed {}:{} from active sockets', addr[0], addr[1])
+
+# State machine for a single client connection
+class ChatSession:
+    def __init__(self, sock, addr, users, active_sockets, replicator):
+        self.sock           = sock
+        self.addr           = addr
+        self.users          = users
+        self.active_sockets = active_sockets
+        self.replicator     = replicator
+        self.directory      = replicator.directory # sorted usernames (see directory.py)
+        self.groups         = replicator.groups # members of every group (see directory.py)
+        self.replies        = [] # frames to send to the client once commit_seq is committed
+        self.deliveries     = [] # (socket, encoded frames) to deliver to online users once commit_seq is committed
+        self.commit_seq     = 0 # sequence number of the last replicated state change
+        self.continuations  = [] # handlers to run once the session's state changes are applied (see after_commit())
+        self.resumable      = False # client numbers its input and can resume the session after a failover
+        self.token          = None # session token (resumable clients only)
+        self.input_id       = 0 # ID of the line of client input being handled
+        self.mail_cursor    = None # cursor of the next queued message to send (None once the mailbox has been delivered)
+        self.forward        = None # Future of the answer to a message forwarded to other shards (see forwarded())
+        self.forward_done   = None # handles the answer (None if the shards did not answer)
+        self.shard_peer     = None # shard of the leader forwarding requests on this connection (None: not authenticated)
+        self.request_name   = None # name of the request being handled (see REQUEST_SECONDS)
+        self.received       = 0.0 # time the request was recieved
+        self.handled        = [] # (request name, time recieved) of earlier requests answered by the next flush()
+        self.answer         = None # answer to the structured request being handled
+
+        self.state        = WELCOME
+        self.username     = None # username of logged in user
+        self.pending      = None # username entered while creating an account or logging in
+        self.attempt_num  = 1 # login attempt number
+        self.dst_username = None # recipient of message being composed
+        self.dst_group    = None # group (or ALL_USERS) the message being composed is sent to
+
+        self.handlers = {
+            WELCOME:         self.welcome,
+            CREATE_USERNAME: self.create_username,
+            CREATE_PASSWORD: self.create_password,
+            LOGIN_USERNAME:  self.login_username,
+            LOGIN_PASSWORD:  self.login_password,
+            MENU:            self.menu,
+            SEND_TARGET:     self.send_target,
+            SEND_MESSAGE:    self.send_message,
+            DELETE_CONFIRM:  self.delete_confirm,
+            GROUP_TARGET:    self.group_target,
+            GROUP_MESSAGE:   self.group_message,
+            GROUP_NAME:      self.group_name,
+        }
+        self.operations = {
+            REQUEST_CREATE: self.request_create,
+            REQUEST_LOGIN:  self.request_login,
+            REQUEST_SEND:   self.request_send,
+        }
+
+    # Sends the first prompt to a newly connected client
+    def start(self):
+        self.prompt_welcome()
+
+    # Handles a frame and the frames already buffered behind it (pipelined by the client, see async_client.py), so that one
+    # replication wait and one write answer them all. Stops at a forwarded message, which is answered before the next frame,
+    # and at a frame whose handling continues once its state changes are applied (see after_commit()).
+    def handle_frames(self, frame, next_frame):
+        for _ in range(PIPELINE_DEPTH):
+            self.handle_frame(*frame)
+            if self.forward is not None or self.continuations or self.state == CLOSED:
+                return
+            frame = next_frame()
+            if frame is None:
+                return
+
+    # Handles one frame recieved from the client
+    def handle_frame(self, msg_type, payload):
+        if self.request_name is not None:
+            self.handled.append((self.request_name, self.received))
+        self.received = perf_counter()
+        self.request_name = FRAME_REQUESTS.get(msg_type)
+        if msg_type == MSG_TEXT:
+            self.handle(payload.decode(encoding=ENCODING))
+        elif msg_type == MSG_INPUT:
+            self.input_id, text = json.loads(payload.decode(encoding=ENCODING))
+            self.resumable = True
+            self.handle(text)
+            # Sent with the replies, i.e., once the state changes are committed
+            ack = [self.input_id, self.state in (WELCOME, MENU)]
+            self.replies.append((MSG_INPUT_ACK, json.dumps(ack).encode(encoding=ENCODING)))
+        elif msg_type == MSG_REQUEST:
+            self.handle_request(json.loads(payload.decode(encoding=ENCODING)))
+        elif msg_type == MSG_RESUME:
+            self.resume(json.loads(payload.decode(encoding=ENCODING)))
+        elif msg_type == MSG_MAIL_ACK:
+            self.ack_mail(int(payload))
+        elif msg_type == MSG_LIST:
+            self.list_users(json.loads(payload.decode(encoding=ENCODING)))
+        elif msg_type == MSG_FORWARD:
+            self.handle_forward(json.loads(payload.decode(encoding=ENCODING)))
+        elif msg_type == MSG_LOOKUP:
+            username = json.loads(payload.decode(encoding=ENCODING))['username']
+            self.replies.append((MSG_LOOKUP, json.dumps({'username': username, 'exists': username in self.users}).encode(encoding=ENCODING)))
+        # Answer heartbeats so the client knows the leader is alive
+        elif msg_type == MSG_HEARTBEAT:
+            self.replies.append((MSG_HEARTBEAT, b''))
+
+    # Handles one line of client input in the current state
+    def handle(self, text):
+        self.request_name = self.state
+        self.handlers[self.state](text)
+
+    def reply(self, text):
+        self.replies.append((MSG_TEXT, text.encode(encoding=ENCODING)))
+
+    # Queues messages for online users and all replies (pipelined into a single syscall).
+    # Returns the connections the session should wait for before handling more input (backpressure).
+    def flush(self):
+        connections = [self.sock]
+        for sock, data in self.deliveries:
+            sock.send_reserved(data)
+            if sock.policy == POLICY_BLOCK:
+                connections.append(sock)
+        if self.replies and self.state != CLOSED:
+            self.sock.send_frames(self.replies)
+        self.deliveries = []
+        self.replies = []
+        now = perf_counter()
+        for request_name, received in self.handled:
+            REQUEST_SECONDS.observe(now - received, request_name)
+        self.handled = []
+        if self.request_name is not None:
+            REQUEST_SECONDS.observe(now - self.received, self.request_name)
+            self.request_name = None
+        return connections if self.state != CLOSED else []
+
+    # Applies state changes and appends them to the replication log
+    def commit(self, *ops):
+        self.commit_seq = self.replicator.replicate_many(list(ops))
+
+    # Runs callback once the state changes committed so far are applied to 'users' (they already are here,
+    # but not yet in the copy of a worker process, see workers.py)
+    def after_commit(self, callback):
+        callback()
+
+    # Waits (without blocking the event loop) until the session's state changes are committed, so its replies can be sent
+    async def wait_committed(self):
+        await self.replicator.wait_async(self.commit_seq)
+
+    # Handles the client disconnecting
+    def disconnect(self):
+        if self.state == CLOSED:
+            return
+        self.close()
+        if self.username is not None:
+            log.debug('{} logged off.', self.username)
+
+    # Stops handling input and closes the connection
+    def close(self):
+        self.state = CLOSED
+        remove_connection(self.sock, self.addr, self.active_sockets)
+
+    # Queues the user's messages on this connection from now on (the latest login of a user gets them)
+    def attach(self, username, user):
+        user.socket = self.sock
+
+    # Connection a message for an online user is queued on (None if the user is offline)
+    def connection(self, username, user):
+        return user.socket if user.socket in self.active_sockets else None
+
+    def prompt_welcome(self):
+        self.state = WELCOME
+        self.reply(WELCOME_PROMPT)
+
+    def prompt_menu(self):
+        self.state = MENU
+        self.reply(MENU_PROMPT)
+
+    # Handles 1) user creation and 2) login for users
+    def welcome(self, choice):
+        choice = choice.strip()
+        if choice == '1':
+            self.state = CREATE_USERNAME
+            self.reply('\nPlease enter a username: ')
+        elif choice == '2':
+            self.attempt_num = 1
+            self.prompt_login()
+        else:
+            self.reply('{} is not a valid option. Please enter either 1 or 2!'.format(choice))
+            self.prompt_welcome()
+
+    # Handles user creation for new users: solicit username
+    def create_username(self, username):
+        username = username.strip()
+        if remote_home(username) is not None:
+            self.redirect(username)
+            return
+        # Username has already been taken (re-enter)
+        if username in self.users:
+            self.reply('{} is already taken. Please enter a unique username.\n'.format(username))
+            self.reply('\nPlease enter a username: ')
+            return
+        self.pending = username
+        self.state = CREATE_PASSWORD
+        self.reply('Please enter a password.')
+
+    # Handles user creation for new users: solicit password
+    def create_password(self, password):
+        username, password = self.pending, password.strip()
+        # Another client took the username while we were waiting for the password
+        if username in self.users:
+            self.reply('{} is already taken. Please enter a unique username.\n'.format(username))
+            self.state = CREATE_USERNAME
+            self.reply('\nPlease enter a username: ')
+            return
+
+        # Update user information
+        self.commit([OP_CREATE_USER, username, password])
+        self.after_commit(lambda: self.account_created(username))
+
+    def account_created(self, username):
+        self.attach(username, self.users[username])
+        self.start_session(username)
+
+        # Confirm success of account creation
+        log.debug('{}:{} successfully created account with username: {}', self.addr[0], self.addr[1], username)
+        self.reply('\nSuccessfully created account with username: {}\n'.format(username))
+        self.enter_chatroom(username)
+
+    def prompt_login(self):
+        self.state = LOGIN_USERNAME
+        self.reply('\nPlease enter your username.')
+
+    # Handles login for existing user: solicit username
+    def login_username(self, username):
+        username = username.strip()
+        if remote_home(username) is not None:
+            self.redirect(username)
+            return
+        # Username does not exist
+        if username not in self.users:
+            self.reply('\n{} is not a valid username.\n'.format(username))
+            self.failed_login('attempt(s)')
+            return
+        self.pending = username
+        self.state = LOGIN_PASSWORD
+        self.reply('Please enter your password.')
+
+    # Handles login for existing user: solicit password
+    def login_password(self, password):
+        username, password = self.pending, password.strip()
+        user = self.users.get(username)
+
+        # Entered incorrect password (or account was deleted in the meantime)
+        if user is None or password != user.password:
+            self.reply('\nIncorrect password.\n')
+            self.failed_login('attempts')
+            return
+
+        # update user's active socket
+        self.attach(username, user)
+        self.username = username
+
+        log.debug('{} successfully logged via {}:{}', username, self.addr[0], self.addr[1])
+        self.reply('\nSuccessfully logged in\n')
+        self.deliver_mailbox(username)
+        self.start_session(username)
+        self.enter_chatroom(username)
+
+    # Starts delivering queued mail (the rest is sent as the client acknowledges pages)
+    def deliver_mailbox(self, username):
+        user = self.users[username]
+        # No mail to send
+        if len(user.mailbox) == 0:
+            self.reply('\nYou do not have any queued messages.')
+            return
+        self.reply('\nWelcome back, {}. {} unread messages:\n'.format(username, len(user.mailbox)))
+        self.mail_cursor = user.drained
+        self.send_mail()
+
+    # Sends pages of queued mail until MAIL_WINDOW pages are unacknowledged
+    def send_mail(self):
+        user = self.users.get(self.username)
+        if self.mail_cursor is None or user is None:
+            return
+        mailbox, drained = user.mailbox, user.drained
+        self.mail_cursor = max(self.mail_cursor, drained)
+        end = min(drained + len(mailbox), drained + MAIL_WINDOW * MAIL_PAGE_SIZE)
+        while self.mail_cursor < end:
+            start = self.mail_cursor
+            messages = mailbox.messages(start-drained, min(end, start+MAIL_PAGE_SIZE)-drained)
+            self.mail_cursor = start + len(messages)
+            page = {'username': self.username, 'start': start, 'messages': messages, 'remaining': drained + len(mailbox) - self.mail_cursor}
+            self.replies.append((MSG_MAIL, json.dumps(page).encode(encoding=ENCODING)))
+
+    # Removes the messages the client has recieved from its mailbox and sends the next pages
+    def ack_mail(self, cursor):
+        user = self.users.get(self.username)
+        if self.mail_cursor is None or user is None:
+            return
+        cursor = min(cursor, self.mail_cursor) # never remove messages that were not sent
+        if cursor > user.drained:
+            self.commit([OP_DRAIN_MAIL, self.username, cursor])
+        self.send_mail()
+        # Whole mailbox delivered and acknowledged (messages spilled to it later are delivered at the next login)
+        if not user.mailbox:
+            self.mail_cursor = None
+
+    # Issues a (replicated) session token to a resumable client
+    def start_session(self, username):
+        if not self.resumable:
+            return
+        self.token = token_hex(16)
+        self.commit([OP_CREATE_SESSION, username, self.token])
+        session = {'username': username, 'token': self.token}
+        self.replies.append((MSG_SESSION, json.dumps(session).encode(encoding=ENCODING)))
+
+    # Resumes a session after a failover: the client is logged in again without the interactive login
+    def resume(self, session):
+        username, token = session['username'], session['token']
+        user = self.users.get(username)
+        if self.state != WELCOME or user is None or token not in (user.sessions or {}):
+            self.replies.append((MSG_RESUME, json.dumps({'ok': False}).encode(encoding=ENCODING)))
+            self.prompt_welcome()
+            return
+        self.attach(username, user)
+        self.resumable = True
+        self.token = token
+        self.username = username
+        log.debug('{} resumed session via {}:{}', username, self.addr[0], self.addr[1])
+        self.replies.append((MSG_RESUME, json.dumps({'ok': True}).encode(encoding=ENCODING)))
+        self.deliver_mailbox(username)
+        self.prompt_menu()
+
+    # Operations recording that this session sent the message in the current line of input (resumable clients only)
+    def sent_ops(self):
+        if self.token is None:
+            return []
+        return [[OP_SENT, self.username, self.token, self.input_id]]
+
+    # Whether the current line of input is a retransmission of a message that was already sent
+    def already_sent(self):
+        if self.token is None:
+            return False
+        sessions = self.users[self.username].sessions or {}
+        return self.input_id <= sessions.get(self.token, 0)
+
+    # Sends the client to the home shard of username, where it enters its choice and the username again
+    def redirect(self, username):
+        shard = remote_home(username)
+        ip, port = sharding.SHARDS.addresses[shard]
+        log.debug('{}:{} redirected to shard {} for {}', self.addr[0], self.addr[1], shard, username)
+        self.reply('\n{} belongs to shard {} @ {}:{}\n'.format(username, shard, ip, port))
+        self.replies.append((MSG_REDIRECT, json.dumps({'shard': shard, 'ip': ip, 'port': port}).encode(encoding=ENCODING)))
+        self.prompt_welcome()
+
+    def failed_login(self, attempts_label):
+        if self.attempt_num < LOGIN_ATTEMPTS:
+            self.reply('Failed to login. You have {} remaining {}.\n'.format(LOGIN_ATTEMPTS-self.attempt_num, attempts_label))
+            self.attempt_num += 1
+            self.prompt_login()
+        else:
+            self.reply('Failed to login. Returning to the welcome page.\n')
+            self.prompt_welcome()
+
+    # Let user know all other users available for messaging
+    def enter_chatroom(self, username):
+        self.username = username
+        self.replies.append((MSG_TEXT, self.directory.text_page('\nWelcome to chatroom!\nAll users:\n')))
+        self.prompt_menu()
+
+    # Answers a MSG_LIST request with one page of the user directory
+    def list_users(self, request):
+        if self.username is None:
+            page = json.dumps({'error': 'not logged in'}).encode(encoding=ENCODING)
+        else:
+            page = self.directory.list_page(request.get('prefix', ''), request.get('cursor'), request.get('size', LIST_PAGE_SIZE))
+        self.replies.append((MSG_LIST, page))
+
+    # Handles 1) send message, 2) list all users (or those starting with a prefix, e.g., '2 al'), and 3) delete account for logged in users
+    def menu(self, choice):
+        choice = choice.strip()
+        command, _, prefix = choice.partition(' ')
+        self.request_name = MENU_REQUESTS.get(command if command == '2' else choice, 'menu_invalid')
+        # Send message to another user
+        if choice == '1':
+            self.state = SEND_TARGET
+            self.reply('\nEnter username of message recipient:')
+        elif command == '2':
+            prefix = prefix.strip()
+            header = '\nUsers starting with {}:\n'.format(prefix) if prefix else '\nAll users:\n'
+            self.replies.append((MSG_TEXT, self.directory.text_page(header, prefix)))
+            self.prompt_menu()
+        elif choice == '3':
+            self.state = DELETE_CONFIRM
+            self.reply('\nType confirm to delete your current account')
+        elif choice == '4':
+            self.state = GROUP_TARGET
+            self.reply('\nEnter the name of the group (or {} for all users):'.format(ALL_USERS))
+        elif choice == '5':
+            self.state = GROUP_NAME
+            self.reply('\nEnter the name of a group to join (or to leave, if you are a member):')
+        else:
+            self.reply('\n{} is not a valid option. Please enter either 1, 2, 3, 4, or 5.'.format(choice))
+            self.prompt_menu()
+
+    # Solicit target user
+    def send_target(self, dst_username):
+        dst_username = dst_username.strip()
+        # Client specified target user that does not exist - return to general chat application loop
+        # (users of other shards are checked by their shard once the message is forwarded)
+        if dst_username not in self.users and remote_home(dst_username) is None:
+            self.reply('Target user {} does not exist!\n'.format(dst_username))
+            self.prompt_menu()
+            return
+        self.dst_username = dst_username
+        self.state = SEND_MESSAGE
+        self.reply('Enter your message: ')
+
+    # Solicit message
+    def send_message(self, body):
+        dst_username = self.dst_username
+        # Client retransmitted a message after a failover that was already sent before it
+        if self.already_sent():
+            self.reply('\nMessage already delivered.\n')
+        # Target user belongs to another shard: answered once that shard has answered (see forwarded())
+        elif remote_home(dst_username) is not None:
+            request = {'type': FORWARD_MAIL, 'username': dst_username, 'body': body, 'sender': self.username}
+            self.forward = sharding.forward(remote_home(dst_username), request)
+            self.forward_done = self.message_forwarded
+            self.state = MENU
+            return
+        else:
+            status = self.deliver(dst_username, body, self.username, self.sent_ops())
+            self.reply(SEND_REPLIES[status].format(dst_username))
+        self.prompt_menu()
+
+    # Handles the answer of other shards to a forwarded message (None if they did not answer)
+    def forwarded(self, answer):
+        self.forward = None
+        self.forward_done(answer)
+
+    def message_forwarded(self, answer):
+        if answer is None:
+            self.reply('\nThe server of {} is unavailable. Message not sent.\n'.format(self.dst_username))
+        else:
+            ops = self.sent_ops()
+            if ops:
+                self.commit(*ops)
+            self.reply(SEND_REPLIES[answer['status']].format(self.dst_username))
+        self.prompt_menu()
+
+    # Delivers a message to an online user, or queues it in their mailbox, and commits ops with it.
+    # Returns DELIVERED, MAILBOX, or UNKNOWN (target user deleted their account while the message was being typed).
+    def deliver(self, dst_username, body, sender, ops=()):
+        message = format_message(sender, body)
+        data = encode_frame(MSG_TEXT, message.encode(encoding=ENCODING))
+        dst = self.users.get(dst_username)
+        if dst is None:
+            return UNKNOWN
+        # Target user is online (and its connection is not full) so deliver message immediately (once it is recorded as sent)
+        connection = self.connection(dst_username, dst)
+        if connection is not None and connection.reserve(len(data)):
+            if ops:
+                self.commit(*ops)
+            self.deliveries.append((connection, data))
+            MESSAGES.inc(label=DELIVERED)
+            log.sample(log.DEBUG, '(DELIVERED TO USER) <to {}> {}', dst_username, message)
+            return DELIVERED
+        # Target user is currently offline (or not reading fast enough) so deliver message to mailbox
+        self.commit([OP_APPEND_MAIL, dst_username, body, sender], *ops)
+        MESSAGES.inc(label=MAILBOX)
+        log.sample(log.DEBUG, '(DELIVERED TO MAILBOX) <to {}> {}', dst_username, message)
+        return MAILBOX
+
+    # Handles a request forwarded by the leader of another shard (answered once its state changes are committed)
+    def handle_forward(self, request):
+        answer = {'id': request['id']}
+        if self.shard_peer is None:
+            if sharding.authenticate(request):
+                self.shard_peer = request['shard']
+                log.info('Shard {} leader connected from {}:{}', self.shard_peer, self.addr[0], self.addr[1])
+                status = ACCEPTED
+            else:
+                log.warning('Rejected a forwarded request from {}:{} (not a shard leader)', self.addr[0], self.addr[1])
+                status = REJECTED
+        elif request['type'] == FORWARD_MAIL:
+            status = self.deliver(request['username'], request['body'], request['sender'])
+        elif request['type'] == FORWARD_BROADCAST: # (addressed to a group, not to a username)
+            status = DELIVERED
+            answer['delivered'], answer['queued'] = self.broadcast(request['group'], request['body'], request['sender'])
+        elif request['type'] == FORWARD_ADOPT:
+            username = request['username']
+            status = EXISTS if username in self.users else ADOPTED
+            if status == ADOPTED:
+                self.commit([OP_ADOPT_USER, username, request['record']])
+                log.info('Adopted {} from another shard', username)
+        else:
+            return
+        answer['status'] = status
+        self.replies.append((MSG_FORWARD, json.dumps(answer).encode(encoding=ENCODING)))
+
+    # Solicit target group
+    def group_target(self, group):
+        group = group.strip()
+        if not group:
+            self.prompt_menu()
+            return
+        self.dst_group = group
+        self.state = GROUP_MESSAGE
+        self.reply('Enter your message: ')
+
+    # Solicit message for the group, and send it to the members on every shard
+    def group_message(self, body):
+        if self.already_sent():
+            self.reply('\nMessage already delivered.\n')
+            self.prompt_menu()
+            return
+        group = None if self.dst_group == ALL_USERS else self.dst_group
+        delivered, queued = self.broadcast(group, body, self.username, self.sent_ops())
+        # Answered once the other shards (if any) have sent it to their members too
+        request = {'type': FORWARD_BROADCAST, 'group': group, 'body': body, 'sender': self.username}
+        self.forward = sharding.forward_all(request)
+        if self.forward is not None:
+            self.forward_done = lambda answer: self.broadcast_sent(delivered, queued, answer, forwarded=True)
+            self.state = MENU
+            return
+        self.broadcast_sent(delivered, queued)
+
+    def broadcast_sent(self, delivered, queued, answer=None, forwarded=False):
+        if answer is not None:
+            delivered += answer['delivered']
+            queued += answer['queued']
+        self.reply('\nMessage delivered to {} active users and {} mailboxes.\n'.format(delivered, queued))
+        if forwarded and (answer is None or answer['unavailable']):
+            self.reply('Some servers are unavailable: their users did not recieve the message.\n')
+        self.prompt_menu()
+
+    # Sends a message to the online members of a group (every user if group is None) and commits a single operation
+    # that queues it in the mailboxes of the others. Returns the number of users it was delivered and queued to.
+    def broadcast(self, group, body, sender, ops=()):
+        members = self.directory.all() if group is None else self.groups.members(group)
+        data = encode_frame(MSG_TEXT, format_message(sender, body).encode(encoding=ENCODING)) # shared by all connections
+        delivered = []
+        for username in members:
+            dst = self.users.get(username)
+            connection = self.connection(username, dst) if username != sender and dst is not None else None
+            if connection is not None and connection.reserve(len(data)):
+                self.deliveries.append((connection, data))
+                delivered.append(username)
+        self.commit([OP_BROADCAST, sender, body, group, delivered], *ops)
+        queued = len(members) - len(delivered) - (sender in members)
+        MESSAGES.inc(len(delivered), DELIVERED)
+        MESSAGES.inc(queued, MAILBOX)
+        log.sample(log.DEBUG, '(BROADCAST TO {}) <{}> {} ({} delivered, {} queued)', group or 'ALL', sender, body, len(delivered), queued)
+        return len(delivered), queued
+
+    # Joins the group, or leaves it if the user is already a member
+    def group_name(self, group):
+        group = group.strip()
+        user = self.users.get(self.username)
+        if not group or group == ALL_USERS or user is None:
+            self.reply('\n{} is not a valid group name.\n'.format(group))
+        elif user.groups is not None and group in user.groups:
+            self.commit([OP_LEAVE_GROUP, self.username, group])
+            self.reply('\nLeft group {}.\n'.format(group))
+        else:
+            members = len(self.groups.members(group)) + 1 # (counted before joining, see after_commit())
+            self.commit([OP_JOIN_GROUP, self.username, group])
+            self.reply('\nJoined group {} ({} members on this server).\n'.format(group, members))
+        self.prompt_menu()
+
+    def delete_confirm(self, confirm):
+        if confirm.strip() == 'confirm':
+            self.commit([OP_DELETE_USER, self.username])
+            self.close()
+            log.debug('{} deleted account.', self.username)
+        else:
+            self.prompt_menu()
+
+    # Handles a structured request of a programmatic client (a whole operation in one frame, answered with its status)
+    def handle_request(self, request):
+        self.input_id = request['id'] # identifies a sent message like the ID of a line of input (see already_sent())
+        self.resumable = True
+        self.answer = {'id': request['id']}
+        handler = self.operations.get(request.get('op'))
+        self.request_name = 'request_{}'.format(request['op']) if handler is not None else 'request_invalid'
+        if handler is None:
+            self.answer_request(INVALID)
+        else:
+            handler(request)
+
+    def answer_request(self, status, **fields):
+        self.answer.update(fields, status=status)
+        self.replies.append((MSG_REQUEST, json.dumps(self.answer).encode(encoding=ENCODING)))
+
+    def redirect_request(self, username):
+        shard = remote_home(username)
+        ip, port = sharding.SHARDS.addresses[shard]
+        self.answer_request(REDIRECTED, shard=shard, ip=ip, port=port)
+
+    def request_create(self, request):
+        username, password = request['username'].strip(), request['password'].strip()
+        if self.username is not None:
+            self.answer_request(INVALID)
+        elif remote_home(username) is not None:
+            self.redirect_request(username)
+        elif username in self.users:
+            self.answer_request(TAKEN)
+        else:
+            self.commit([OP_CREATE_USER, username, password])
+            self.after_commit(lambda: self.request_created(username))
+
+    def request_created(self, username):
+        self.attach(username, self.users[username])
+        self.username = username
+        self.state = MENU
+        self.start_session(username)
+        log.debug('{}:{} successfully created account with username: {}', self.addr[0], self.addr[1], username)
+        self.answer_request(CREATED)
+
+    # Logs in and starts delivering the user's queued messages (without the prompts of the interactive login)
+    def request_login(self, request):
+        username, password = request['username'].strip(), request['password'].strip()
+        user = self.users.get(username)
+        if self.username is not None:
+            self.answer_request(INVALID)
+        elif remote_home(username) is not None:
+            self.redirect_request(username)
+        elif user is None or password != user.password:
+            self.answer_request(LOGIN_FAILED)
+        else:
+            self.attach(username, user)
+            self.username = username
+            self.state = MENU
+            self.start_session(username)
+            queued = len(user.mailbox)
+            if queued:
+                self.mail_cursor = user.drained
+                self.send_mail()
+            log.debug('{} successfully logged via {}:{}', username, self.addr[0], self.addr[1])
+            self.answer_request(LOGGED_IN, queued=queued)
+
+    def request_send(self, request):
+        dst_username, body = request['to'].strip(), request['body']
+        if self.username is None:
+            self.answer_request(NOT_LOGGED_IN)
+        elif self.already_sent():
+            self.answer_request(DUPLICATE)
+        # Recipient belongs to another shard: answered once that shard has answered (see forwarded())
+        elif remote_home(dst_username) is not None:
+            forward = {'type': FORWARD_MAIL, 'username': dst_username, 'body': body, 'sender': self.username}
+            self.forward = sharding.forward(remote_home(dst_username), forward)
+            self.forward_done = self.request_forwarded
+        else:
+            self.answer_request(self.deliver(dst_username, body, self.username, self.sent_ops()))
+
+    def request_forwarded(self, answer):
+        if answer is None:
+            self.answer_request(UNAVAILABLE)
+            return
+        ops = self.sent_ops()
+        if ops:
+            self.commit(*ops)
+        self.answer_request(answer['status'])
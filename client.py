@@ -1,35 +1,42 @@
 '''
 This file implements client functionality of chat application.
 
-Usage: python3 client.py IP_ADDRESS PORT
+Usage: python3 client.py IP_ADDRESS PORT [--heartbeat-interval SECONDS] [--failure-timeout SECONDS] [--phi-threshold PHI]
 '''
 # Import relevant python packages
+from argparse import ArgumentParser
 from select import select
 from socket import socket, AF_INET, SOCK_STREAM
+from time import monotonic
+import json
 import sys
-from time import sleep
+
+from leader_probe import probe_leaders, PROBE_TIMEOUT
+from protocol import FramedSocket, MSG_INIT, MSG_HEARTBEAT, MSG_SESSION, MSG_RESUME, MSG_INPUT, MSG_INPUT_ACK, MSG_MAIL, MSG_MAIL_ACK, MSG_REDIRECT
+import heartbeat
 
 # Constants/configurations
 ENCODING    = 'utf-8' # message encoding
-BUFFER_SIZE = 2048 # fixed 2KB buffer size
-
-# Fault-tolerance
-REPLICAS = 2 # 2-fault tolerant system
-SLEEP_TIME  = 0.5 # wait for 0.5 seconds to connect to backup servers
 
 # Main function for client functionality
 def main():
     # Get IP address and port number of server socket
-    if len(sys.argv) != 3:
-        print('Usage: python3 client.py IP_ADDRESS PORT')
-        sys.exit('client.py exiting')
-    ip_address = str(sys.argv[1])
-    port = int(sys.argv[2])
-    
+    parser = ArgumentParser(description='Chat application client.')
+    parser.add_argument('ip_address', metavar='IP_ADDRESS')
+    parser.add_argument('port', metavar='PORT', type=int)
+    heartbeat.add_arguments(parser)
+    # A thread-per-client leader cannot answer heartbeats while it waits for a backup to be suspected, so clients wait longer by default
+    parser.set_defaults(failure_timeout=2*heartbeat.FAILURE_TIMEOUT)
+    args = parser.parse_args()
+    heartbeat.configure(args.heartbeat_interval, args.failure_timeout, args.phi_threshold)
+    ip_address = args.ip_address
+    port = args.port
+
     # Creates client socket with IPv4 and TCP
     client = socket(family=AF_INET, type=SOCK_STREAM)
     # Connect to server socket
     client.connect((ip_address, port))
+    client = FramedSocket(client)
     print('Successfully connected to server @ {}:{}'.format(ip_address, port))
 
     '''
@@ -41,20 +48,48 @@ def main():
 
     # Enable fault-tolerance
     leader = 0 # initialize the server with index 0 as leader
-    server_addrs = [ip_address] # list of all possible server IP addresses
-    init = True # initialization phase where leader sends backup IPs
+    server_addrs = [ip_address] # list of all possible server IP addresses (indexed by machine number)
+    detector = heartbeat.new_detector() # failure detector for the leader server
+    last_ping = monotonic()
 
     attempt_to_delete = False # variable to make sure that account deletion does not automatic re-connect
 
+    # Resumable session
+    session  = None # {username, token} recieved from the leader after logging in
+    input_id = 0 # ID of the last line of input sent
+    unacked  = [] # (ID, line) sent since the session was last idle at a menu, retransmitted after a failover
+    resuming = False # waiting for the new leader to resume the session (input is held back until then)
+    mail_seen = {} # username -> cursor up to which queued messages have been printed (a new leader may resend some)
+
     while True:
-        read_objects, _, _ = select(sockets_list, [], []) # do not use wlist, xlist
+        read_objects, _, _ = select(sockets_list, [], [], heartbeat.HEARTBEAT_INTERVAL) # do not use wlist, xlist
+        connected = True
+
+        # Nothing recieved: ping an idle leader, and fail over once it has been silent for too long
+        if not read_objects:
+            if detector.suspect():
+                print('Server @ {}:{} suspected after {:.3f}s of silence!'.format(ip_address, port+leader, detector.silence()))
+                client.close()
+                connected = False
+            elif detector.silence() >= heartbeat.HEARTBEAT_INTERVAL and monotonic() - last_ping >= heartbeat.HEARTBEAT_INTERVAL:
+                try:
+                    client.send_frame(MSG_HEARTBEAT, b'')
+                except OSError:
+                    pass
+                last_ping = monotonic()
 
         for read_object in read_objects:
 
             # Recieved message from client user input
             if read_object == sys.stdin:
                 message = sys.stdin.readline()
-                client.send(message.encode(encoding=ENCODING))
+                input_id += 1
+                unacked.append((input_id, message))
+                if not resuming:
+                    try:
+                        client.send_frame(MSG_INPUT, json.dumps([input_id, message]).encode(encoding=ENCODING))
+                    except OSError:
+                        pass # retransmitted once we have reconnected
                 if attempt_to_delete:
                     if message == "confirm\n":
                         client.close()
@@ -65,46 +100,95 @@ def main():
                     attempt_to_delete = True
             # Recieved message from server socket
             else:
-                message = read_object.recv(BUFFER_SIZE)
-                # Server socket has disconnected
-                if not message:
+                try:
+                    connected = read_object.fill()
+                except OSError:
+                    connected = False
+                if not connected:
                     print('Server @ {}:{} disconnected!'.format(ip_address, port+leader))
-                    sleep(SLEEP_TIME)
-                    backup_success = False
-                    # Attempt to connect to a backup server if there still exists any (i.e., leader <= REPLICAS)
-                    while not backup_success and leader <= REPLICAS:
-                        leader = leader + 1
-                        # try connecting to next possible leader
-                        try:
-                            client = socket(family=AF_INET, type=SOCK_STREAM) # creates client socket with IPv4 and TCP
-                            ip_address = server_addrs[leader] # connect to server socket
-                            print("Attempting to connect to backup @ {}:{}".format(ip_address, port+leader))
-                            client.connect((ip_address, port+leader))
-                            sockets_list = [sys.stdin, client]
-                            init = True # make sure that we are in initialization phase so we can recieve backup IPs when we enter chatroom.
-                            backup_success = True
-                        except:
-                            continue
-
-                    if backup_success:
-                        print('Successfully connected to backup server @ {}:{}'.format(ip_address, port+leader))
-                        
-                    else:
-                        client.close()
-                        sys.exit('Unable to find a backup server. Closing application.')
+                    client.close()
                 else:
-                    if init:
-                        msg = message.decode(encoding=ENCODING).split('@') # split backup IPs with welcome message
-                        addr_list   = msg[0].split(',')[:-1]
-                        welcome_msg = msg[1]
-                        for addr in addr_list:
-                            server_addrs.append(addr)
-                        init = False # finished initialization phase
-                        print('All backup server IP addresses: {}'.format(addr_list))
-                        print(welcome_msg)
-                    else:
-                        print(message.decode(encoding=ENCODING))
+                    detector.heartbeat()
+
+        # Leader has failed: connect to whichever server takes over (measuring how long that took)
+        if not connected:
+            silence, start = detector.silence(), monotonic()
+            candidates = [(index, (addr, port+index)) for index, addr in enumerate(server_addrs)]
+            print('Probing servers {} for the new leader'.format(['{}:{}'.format(*address) for _, address in candidates]))
+            winner = probe_leaders(candidates, PROBE_TIMEOUT)
+            if winner is None:
+                sys.exit('Unable to find a backup server. Closing application.')
+            leader, client = winner
+            ip_address = server_addrs[leader]
+            sockets_list = [sys.stdin, client]
+            detector = heartbeat.new_detector()
+            print('Successfully connected to backup server @ {}:{}'.format(ip_address, port+leader))
+            print('Failover took {:.3f}s ({:.3f}s to detect the failure + {:.3f}s to find the new leader)'.format(silence + monotonic() - start, silence, monotonic() - start))
+            # Resume the session instead of logging in again
+            if session is not None:
+                client.send_frame(MSG_RESUME, json.dumps(session).encode(encoding=ENCODING))
+                resuming = True
+            else:
+                unacked = []
+
+        # A single read may contain several (or only part of a) messages
+        redirect = None
+        for msg_type, message in client.frames():
+            # Initialization phase: recieve backup IPs from the first leader
+            if msg_type == MSG_INIT:
+                addr_list = message.decode(encoding=ENCODING).split(',')[:-1]
+                if len(server_addrs) == 1:
+                    for addr in addr_list:
+                        server_addrs.append(addr)
+                print('All backup server IP addresses: {}'.format(addr_list))
+            elif msg_type == MSG_SESSION:
+                session = json.loads(message.decode(encoding=ENCODING))
+            # Lines up to this one are committed; once the session is back at a menu they never need to be retransmitted
+            elif msg_type == MSG_INPUT_ACK:
+                acked_id, idle = json.loads(message.decode(encoding=ENCODING))
+                if idle:
+                    unacked = [(line_id, line) for line_id, line in unacked if line_id > acked_id]
+            # Retransmit the unfinished command (the new leader ignores messages that were already sent)
+            elif msg_type == MSG_RESUME:
+                resuming = False
+                if json.loads(message.decode(encoding=ENCODING))['ok']:
+                    print('Resumed session as {}'.format(session['username']))
+                    if unacked:
+                        client.send_frames([(MSG_INPUT, json.dumps(line).encode(encoding=ENCODING)) for line in unacked])
+                else:
+                    print('Session expired. Please log in again.')
+                    session, unacked = None, []
+            # Page of queued messages: print those not seen yet and acknowledge the page (which requests the next ones)
+            elif msg_type == MSG_MAIL:
+                page = json.loads(message.decode(encoding=ENCODING))
+                seen = mail_seen.get(page['username'], 0)
+                for cursor, text in enumerate(page['messages'], start=page['start']):
+                    if cursor >= seen:
+                        print(text)
+                cursor = page['start'] + len(page['messages'])
+                mail_seen[page['username']] = max(seen, cursor)
+                client.send_frame(MSG_MAIL_ACK, str(cursor).encode(encoding=ENCODING))
+            # The username belongs to another shard: the rest of this connection's frames are not needed
+            elif msg_type == MSG_REDIRECT:
+                redirect = json.loads(message.decode(encoding=ENCODING))
+                break
+            elif msg_type != MSG_HEARTBEAT:
+                print(message.decode(encoding=ENCODING))
+
+        # Connect to the home shard and enter the lines of the unfinished login (or account creation) there again
+        if redirect is not None:
+            client.close()
+            leader, ip_address, port = 0, redirect['ip'], redirect['port']
+            client = socket(family=AF_INET, type=SOCK_STREAM)
+            client.connect((ip_address, port))
+            client = FramedSocket(client)
+            sockets_list = [sys.stdin, client]
+            server_addrs = [ip_address] # the home shard's leader sends its backup IPs
+            detector = heartbeat.new_detector()
+            print('Redirected to shard {} @ {}:{}'.format(redirect['shard'], ip_address, port))
+            if unacked:
+                client.send_frames([(MSG_INPUT, json.dumps(line).encode(encoding=ENCODING)) for line in unacked])
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
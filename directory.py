@@ -0,0 +1,140 @@
+'''
+This file implements the user directory: a sorted index of all usernames that serves "List all users".
+
+The directory is maintained by the replicator as it applies account creations and deletions, so it
+never has to enumerate 'users' (which other threads may be changing). Every change bumps its version.
+The directory's own lock is only held to insert or remove one username (a binary search) or to copy
+one page, so listing users never waits for the replicator and a page is always taken from one version.
+
+Pages are selected with a username prefix, a cursor (the last username of the previous page), and a
+page size. Each encoded page is cached until the next change, so clients asking for the same page
+(e.g., the first page shown after every login) share a single encoding.
+
+The members of each group (see OP_JOIN_GROUP in replication.py) are indexed the same way, so sending
+a message to a group never has to enumerate 'users' either.
+'''
+# Import relevant python packages
+from bisect import bisect_left, bisect_right
+from threading import Lock
+import json
+
+# Constants/configurations
+ENCODING       = 'utf-8' # message encoding
+LIST_PAGE_SIZE = 100 # usernames per page unless the client asks for another page size
+MAX_PAGE_SIZE  = 1000 # largest page size a client can ask for
+CACHE_SIZE     = 1024 # encoded pages cached per version
+
+# Smallest string that is greater than every string starting with prefix (None if there is none)
+def prefix_end(prefix):
+    if ord(prefix[-1]) == 0x10ffff:
+        return prefix_end(prefix[:-1]) if len(prefix) > 1 else None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+class Directory:
+    def __init__(self, usernames=()):
+        self.usernames = sorted(usernames)
+        self.version   = 0 # incremented on every change
+        self.cache     = (0, {}) # (version, {key: encoded page}) of pages encoded from that version
+        self.lock      = Lock()
+
+    def __len__(self):
+        return len(self.usernames)
+
+    # Adds a new username
+    def add(self, username):
+        with self.lock:
+            index = bisect_left(self.usernames, username)
+            if index < len(self.usernames) and self.usernames[index] == username:
+                return
+            self.usernames.insert(index, username)
+            self.version += 1
+
+    # Removes a deleted username
+    def remove(self, username):
+        with self.lock:
+            index = bisect_left(self.usernames, username)
+            if index == len(self.usernames) or self.usernames[index] != username:
+                return
+            del self.usernames[index]
+            self.version += 1
+
+    # Returns a copy of all usernames
+    def all(self):
+        with self.lock:
+            return list(self.usernames)
+
+    # Returns (version, usernames of the page, offset of the page among matching usernames, number of matching usernames, next cursor)
+    def page(self, prefix='', cursor=None, size=LIST_PAGE_SIZE):
+        size = max(1, min(size, MAX_PAGE_SIZE))
+        last = prefix_end(prefix) if prefix else None
+        with self.lock:
+            usernames = self.usernames
+            first = bisect_left(usernames, prefix)
+            end = bisect_left(usernames, last) if last is not None else len(usernames)
+            start = max(first, bisect_right(usernames, cursor)) if cursor is not None else first
+            names = usernames[start:min(end, start + size)]
+            version = self.version
+        next_cursor = names[-1] if names and start + len(names) < end else None
+        return version, names, start - first, end - first, next_cursor
+
+    # Encoded page for a human-readable listing (MSG_TEXT)
+    def text_page(self, header, prefix='', cursor=None, size=LIST_PAGE_SIZE):
+        return self.cached_page(('text', header, prefix, cursor, size), self.encode_text)
+
+    # Encoded page for a MSG_LIST request
+    def list_page(self, prefix='', cursor=None, size=LIST_PAGE_SIZE):
+        return self.cached_page(('list', prefix, cursor, size), self.encode_list)
+
+    # Returns the cached page, encoding it the first time it is asked for
+    def cached_page(self, key, encode):
+        version, pages = self.cache
+        if version != self.version or len(pages) >= CACHE_SIZE:
+            pages = {}
+            self.cache = (self.version, pages)
+        payload = pages.get(key)
+        if payload is None:
+            version, payload = encode(*key[1:])
+            # Only cache pages of the current version (a user may have been created while encoding)
+            if version == self.cache[0]:
+                pages[key] = payload
+        return payload
+
+    def encode_text(self, header, prefix, cursor, size):
+        version, names, offset, total, _ = self.page(prefix, cursor, size)
+        lines = [header]
+        for index, username in enumerate(names, start=offset):
+            lines.append('{}. {}\n'.format(index, username))
+        if offset + len(names) < total:
+            lines.append('... and {} more (enter 2 followed by the beginning of a username to search)\n'.format(total - offset - len(names)))
+        return version, ''.join(lines).encode(encoding=ENCODING)
+
+    def encode_list(self, prefix, cursor, size):
+        version, names, offset, total, next_cursor = self.page(prefix, cursor, size)
+        page = {'version': version, 'users': names, 'offset': offset, 'total': total, 'cursor': next_cursor}
+        return version, json.dumps(page).encode(encoding=ENCODING)
+
+# Members of every group (group name -> set of usernames), maintained by the replicator like the directory
+class Groups:
+    def __init__(self, users=None):
+        self.groups = {}
+        self.lock   = Lock()
+        for username, user in (users or {}).items():
+            for group in user.groups or ():
+                self.join(group, username)
+
+    def join(self, group, username):
+        with self.lock:
+            self.groups.setdefault(group, set()).add(username)
+
+    def leave(self, group, username):
+        with self.lock:
+            members = self.groups.get(group)
+            if members is not None:
+                members.discard(username)
+                if not members:
+                    del self.groups[group]
+
+    # Returns the usernames of the members of a group
+    def members(self, group):
+        with self.lock:
+            return list(self.groups.get(group, ()))
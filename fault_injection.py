@@ -0,0 +1,481 @@
+'''
+This file automates the crash-permutation tests of the 2-fault tolerant system (see "What was our testing
+strategy?" in design_notebook.md): it runs the three-server topology with clients under steady load, injects
+two faults in every ordering of the servers, and measures how the system recovers.
+
+Faults:
+    - kill: the server process is killed (SIGKILL)
+    - pause: the server process is stopped (SIGSTOP), i.e., it hangs with its connections open
+    - partition: the server is cut off from the other servers and the clients, i.e., nothing it sends
+      or is sent reaches the other side, and connections to it are never accepted
+Partitions are made by a TCP proxy: the servers listen on SERVER_IP, and the proxy listens on the same ports
+on PROXY_IP, which the servers (LEADER_IP) and clients connect to. The proxy learns which backup a replication
+connection comes from from its MSG_JOIN, and stops relaying the connections of a partitioned server.
+
+For every scenario (an ordering of two servers, e.g., 0-1, and a fault for each), a fresh set of servers is
+started, CLIENTS resumable clients (like client.py) log in and each send a message to a random other client
+every LOAD_INTERVAL seconds, and the two faults are injected SETTLE seconds apart. We measure:
+    - time to new leader: from a fault of the leader until another server answers new clients
+    - time to client reconnect: from a fault until each client has resumed its session on a new leader
+    - lost messages: messages whose sending was acknowledged, but that their recipient never recieved
+    - duplicated messages: messages a recipient recieved more than once
+Results are saved as JSON (--output).
+
+Usage: python3 fault_injection.py [--orderings 0-1 1-0 ...] [--faults kill pause partition] [--mixed] [--clients CLIENTS]
+                                  [--port PORT] [--mode thread|async] [--output OUTPUT] [--logs LOGS]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+from collections import Counter
+from itertools import permutations, product
+from random import Random
+from socket import socket, create_connection, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SOMAXCONN, SHUT_RDWR
+from threading import Condition, Event, Lock, Thread
+from time import monotonic, sleep
+import json
+import os
+import signal
+import subprocess
+import sys
+
+from leader_probe import probe_leaders, PROBE_TIMEOUT
+from protocol import FramedSocket, RECV_SIZE, MSG_TEXT, MSG_JOIN, MSG_HEARTBEAT, MSG_SESSION, MSG_RESUME, MSG_INPUT, MSG_INPUT_ACK, MSG_MAIL, MSG_MAIL_ACK
+from read_replica import READ_OFFSET
+from server import REPLICATION_OFFSET
+import heartbeat
+
+# Constants/configurations
+ENCODING         = 'utf-8' # message encoding
+SERVER_IP        = '127.0.0.2' # address the servers listen on
+PROXY_IP         = '127.0.0.1' # address the proxy listens on (and the servers and clients connect to)
+PORT             = 6234 # base port of the first leader
+SERVERS          = 3 # leader and two backups
+FAULTS           = ['kill', 'pause', 'partition']
+PASSWORD         = 'password'
+LOAD_INTERVAL    = 0.05 # seconds between messages sent by each client
+SETTLE           = 2.0 # seconds of steady load before, between, and after the faults
+RECOVERY_TIMEOUT = 15.0 # seconds to wait for a new leader and for the clients to reconnect after a fault
+DRAIN_TIMEOUT    = 5.0 # seconds to wait for the clients' last messages to be acknowledged once the load stops
+SEED             = 262 # message recipients are the same for every scenario
+
+# TCP proxy in front of every port of every server, which can partition a server away from everyone else
+class Proxy:
+    def __init__(self, port, num_servers):
+        self.partitioned = set() # machine numbers of partitioned servers
+        self.closed      = False
+        self.condition   = Condition()
+        self.sockets     = [] # listening and relayed sockets (closed with the proxy)
+        self.lock        = Lock()
+        for machine_num in range(num_servers):
+            for offset in (0, REPLICATION_OFFSET, READ_OFFSET):
+                listener = socket(AF_INET, SOCK_STREAM)
+                listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+                listener.bind((PROXY_IP, port + offset + machine_num))
+                listener.listen(SOMAXCONN)
+                self.sockets.append(listener)
+                Thread(target=self.accept_loop, args=(listener, machine_num, offset == REPLICATION_OFFSET), daemon=True).start()
+
+    def partition(self, machine_num):
+        with self.condition:
+            self.partitioned.add(machine_num)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        with self.lock:
+            sockets, self.sockets = self.sockets, []
+        for sock in sockets:
+            try:
+                sock.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    # Waits until none of the servers a connection is between is partitioned. Returns False once the proxy is closed.
+    def wait_reachable(self, servers):
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or not (servers & self.partitioned))
+            return not self.closed
+
+    def accept_loop(self, listener, machine_num, replication):
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return
+            Thread(target=self.open_link, args=(sock, listener.getsockname()[1], {machine_num}, replication), daemon=True).start()
+
+    # Connects a new connection to the server (once it is reachable) and relays it in both directions.
+    # On a replication port, the first frame is the backup's MSG_JOIN: the connection is also between that backup and the leader.
+    def open_link(self, downstream, port, servers, replication):
+        first = b''
+        if replication:
+            join = FramedSocket(downstream)
+            try:
+                frame = join.recv_frame(timeout=RECOVERY_TIMEOUT)
+            except (OSError, TimeoutError):
+                frame = None
+            if frame is None:
+                downstream.close()
+                return
+            if frame[0] == MSG_JOIN:
+                servers.add(json.loads(frame[1].decode(encoding=ENCODING))['machine_num'])
+            first = bytes(join.buffer)
+        if not self.wait_reachable(servers):
+            downstream.close()
+            return
+        try:
+            upstream = create_connection((SERVER_IP, port))
+            upstream.sendall(first)
+        except OSError:
+            downstream.close() # the server is down: refuse the connection too
+            return
+        with self.lock:
+            self.sockets.extend([downstream, upstream])
+        Thread(target=self.relay, args=(upstream, downstream, servers), daemon=True).start()
+        self.relay(downstream, upstream, servers)
+
+    # Relays bytes from one side to the other while the servers are reachable
+    def relay(self, source, destination, servers):
+        while True:
+            try:
+                data = source.recv(RECV_SIZE)
+            except OSError:
+                data = b''
+            if not data or not self.wait_reachable(servers):
+                break
+            try:
+                destination.sendall(data)
+            except OSError:
+                break
+        for sock in (source, destination):
+            try:
+                sock.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+
+# Client under steady load that fails over like client.py: it finds the new leader, resumes its session,
+# and retransmits the lines that were not acknowledged
+class LoadClient:
+    def __init__(self, name, targets, scenario):
+        self.name         = name
+        self.targets      = targets # recipients of the messages, in order
+        self.scenario     = scenario
+        self.sock         = None
+        self.detector     = None
+        self.session      = None # {username, token}
+        self.resuming     = False
+        self.input_id     = 0
+        self.unacked      = [] # (ID, line) not acknowledged yet
+        self.message_ids  = {} # input ID of the line with a message's text -> message ID
+        self.sent         = [] # IDs of the messages sent
+        self.acknowledged = set() # IDs of the messages whose sending was acknowledged
+        self.recieved     = Counter() # message ID -> number of times recieved
+        self.mail_seen    = 0 # cursor up to which queued messages were recieved (a new leader may resend some)
+        self.resumed      = [] # times the session was resumed on a new leader
+        self.resume_failures = 0
+        self.ready        = Event() # logged in
+
+    def connect(self):
+        candidates = [(index, (PROXY_IP, self.scenario.port + index)) for index in range(SERVERS)]
+        while not self.scenario.done.is_set():
+            winner = probe_leaders(candidates, PROBE_TIMEOUT)
+            if winner is not None:
+                self.sock = winner[1]
+                self.detector = heartbeat.FailureDetector(2*heartbeat.FAILURE_TIMEOUT, heartbeat.PHI_THRESHOLD)
+                return True
+        return False
+
+    def send_lines(self, lines):
+        frames = []
+        for text in lines:
+            self.input_id += 1
+            self.unacked.append((self.input_id, text))
+            frames.append((MSG_INPUT, json.dumps([self.input_id, text]).encode(encoding=ENCODING)))
+        if not self.resuming:
+            try:
+                self.sock.send_frames(frames)
+            except OSError:
+                pass # retransmitted once we have reconnected
+
+    # Sends the next message (once the previous one was acknowledged)
+    def send_message(self):
+        message_id = '{}#{}'.format(self.name, len(self.sent))
+        target = self.targets[len(self.sent) % len(self.targets)]
+        self.sent.append(message_id)
+        self.send_lines(['1', target])
+        self.send_lines(['m {}'.format(message_id)])
+        self.message_ids[self.input_id] = message_id
+
+    # The leader failed: resume the session on the new one
+    def fail_over(self):
+        self.sock.close()
+        if not self.connect():
+            return
+        if self.session is not None:
+            self.sock.send_frame(MSG_RESUME, json.dumps(self.session).encode(encoding=ENCODING))
+            self.resuming = True
+        else:
+            self.sock.send_frames([(MSG_INPUT, json.dumps(line).encode(encoding=ENCODING)) for line in self.unacked])
+
+    def recieve(self, text):
+        if text.startswith('<') and ' m ' in text:
+            self.recieved[text.rpartition(' ')[2]] += 1
+
+    def handle(self, msg_type, payload):
+        if msg_type == MSG_SESSION:
+            self.session = json.loads(payload.decode(encoding=ENCODING))
+            self.ready.set()
+        elif msg_type == MSG_INPUT_ACK:
+            acked_id, idle = json.loads(payload.decode(encoding=ENCODING))
+            if idle:
+                for line_id, _ in self.unacked:
+                    if line_id <= acked_id and line_id in self.message_ids:
+                        self.acknowledged.add(self.message_ids[line_id])
+                self.unacked = [(line_id, text) for line_id, text in self.unacked if line_id > acked_id]
+        elif msg_type == MSG_RESUME:
+            self.resuming = False
+            if json.loads(payload.decode(encoding=ENCODING))['ok']:
+                self.resumed.append(monotonic())
+                if self.unacked:
+                    self.sock.send_frames([(MSG_INPUT, json.dumps(line).encode(encoding=ENCODING)) for line in self.unacked])
+            else:
+                self.resume_failures += 1
+                self.session, self.unacked = None, []
+                self.send_lines(['2', self.name, PASSWORD])
+        elif msg_type == MSG_MAIL:
+            page = json.loads(payload.decode(encoding=ENCODING))
+            for cursor, text in enumerate(page['messages'], start=page['start']):
+                if cursor >= self.mail_seen:
+                    self.recieve(text)
+            cursor = page['start'] + len(page['messages'])
+            self.mail_seen = max(self.mail_seen, cursor)
+            self.sock.send_frame(MSG_MAIL_ACK, str(cursor).encode(encoding=ENCODING))
+        elif msg_type == MSG_TEXT:
+            self.recieve(payload.decode(encoding=ENCODING))
+
+    def run(self):
+        if not self.connect():
+            return
+        self.send_lines(['1', self.name, PASSWORD])
+        next_send = monotonic()
+        while not self.scenario.done.is_set():
+            if self.scenario.load.is_set() and self.ready.is_set() and not self.unacked and not self.resuming and monotonic() >= next_send:
+                self.send_message()
+                next_send = monotonic() + LOAD_INTERVAL
+            try:
+                frame = self.sock.recv_frame(timeout=LOAD_INTERVAL)
+            except TimeoutError:
+                if self.detector.suspect():
+                    self.fail_over()
+                elif self.detector.silence() >= heartbeat.HEARTBEAT_INTERVAL:
+                    try:
+                        self.sock.send_frame(MSG_HEARTBEAT, b'')
+                    except OSError:
+                        pass
+                continue
+            except (OSError, ValueError):
+                frame = None
+            if frame is None:
+                self.fail_over()
+                continue
+            self.detector.heartbeat()
+            self.handle(*frame)
+        self.sock.close()
+
+# One scenario: a fresh set of servers behind the proxy, clients under steady load, and a fault for each server of the ordering
+class Scenario:
+    def __init__(self, ordering, faults, args):
+        self.ordering  = ordering # machine numbers of the servers to fault, in order
+        self.faults    = faults # fault for each of them
+        self.port      = args.port
+        self.args      = args
+        self.processes = []
+        self.leader    = 0
+        self.failed    = set() # machine numbers of the faulted servers
+        self.load      = Event() # clients send messages while set
+        self.done      = Event() # clients stop once set
+        self.name      = '{} {}'.format('-'.join(str(machine_num) for machine_num in ordering), '/'.join(faults))
+
+    def start_server(self, machine_num):
+        server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+        command = [sys.executable, server_path, PROXY_IP, str(machine_num), '--ip', SERVER_IP, '--port', str(self.port),
+                   '--replicas', str(SERVERS - 1), '--mode', self.args.mode]
+        output = subprocess.DEVNULL
+        if self.args.logs is not None:
+            output = open(os.path.join(self.args.logs, '{}_server_{}.log'.format(self.name.replace(' ', '_').replace('/', '+'), machine_num)), 'w')
+        # Unbuffered, so the output of killed servers is not lost
+        self.processes.append(subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT, env=dict(os.environ, PYTHONUNBUFFERED='1')))
+
+    # Starts the leader, then the backups, and waits until the leader answers clients (i.e., every backup has joined)
+    def start_servers(self):
+        self.start_server(0)
+        wait_for_port(self.port)
+        sleep(0.1) # the leader listens for backups right after its client port
+        for machine_num in range(1, SERVERS):
+            self.start_server(machine_num)
+        for machine_num in range(1, SERVERS):
+            wait_for_port(self.port + READ_OFFSET + machine_num)
+        winner = probe_leaders([(0, (PROXY_IP, self.port))], RECOVERY_TIMEOUT)
+        if winner is None:
+            raise RuntimeError('the leader did not start')
+        winner[1].close()
+
+    def inject(self, machine_num, fault):
+        if fault == 'kill':
+            self.processes[machine_num].kill()
+        elif fault == 'pause':
+            self.processes[machine_num].send_signal(signal.SIGSTOP)
+        else:
+            self.proxy.partition(machine_num)
+        self.failed.add(machine_num)
+
+    # Waits until one of the remaining servers answers new clients. Returns its machine number (None if none did).
+    def find_leader(self, deadline):
+        candidates = [(index, (PROXY_IP, self.port + index)) for index in range(SERVERS) if index not in self.failed]
+        while candidates and monotonic() < deadline:
+            winner = probe_leaders(candidates, min(PROBE_TIMEOUT, max(0, deadline - monotonic())))
+            if winner is not None:
+                winner[1].close()
+                return winner[0]
+        return None
+
+    # Injects a fault and measures the recovery
+    def fault(self, machine_num, fault, clients):
+        was_leader = machine_num == self.leader
+        start = monotonic()
+        deadline = start + RECOVERY_TIMEOUT
+        self.inject(machine_num, fault)
+        result = {'server': machine_num, 'fault': fault, 'was_leader': was_leader, 'new_leader': None, 'time_to_new_leader': None}
+        if was_leader:
+            self.leader = self.find_leader(deadline)
+            if self.leader is not None:
+                result['new_leader'] = self.leader
+                result['time_to_new_leader'] = round(monotonic() - start, 3)
+            # Clients of the failed leader reconnect to the new one
+            while monotonic() < deadline and not all(client.resumed and client.resumed[-1] >= start for client in clients):
+                sleep(0.05)
+        else:
+            sleep(SETTLE)
+        reconnects = sorted(client.resumed[-1] - start for client in clients if client.resumed and client.resumed[-1] >= start)
+        result['clients_reconnected'] = len(reconnects)
+        if reconnects:
+            result['time_to_reconnect'] = {'p50': round(reconnects[len(reconnects) // 2], 3), 'max': round(reconnects[-1], 3)}
+        print('  fault {} of server {}{}: new leader {} after {}s, {} clients reconnected{}'.format(
+            fault, machine_num, ' (leader)' if was_leader else '', result['new_leader'], result['time_to_new_leader'],
+            len(reconnects), ' (p50 {p50}s, max {max}s)'.format(**result['time_to_reconnect']) if reconnects else ''))
+        return result
+
+    def run(self):
+        self.proxy = Proxy(self.port, SERVERS)
+        try:
+            self.start_servers()
+            return self.run_clients()
+        finally:
+            self.done.set()
+            for process in self.processes:
+                process.kill()
+                process.wait()
+            self.proxy.close()
+
+    def run_clients(self):
+        random = Random(SEED)
+        names = ['client_{}'.format(index) for index in range(self.args.clients)]
+        clients = [LoadClient(name, [random.choice([other for other in names if other != name]) for _ in range(len(names))], self) for name in names]
+        threads = [Thread(target=client.run, daemon=True) for client in clients]
+        for thread in threads:
+            thread.start()
+        for client in clients:
+            if not client.ready.wait(RECOVERY_TIMEOUT):
+                raise RuntimeError('{} could not log in'.format(client.name))
+
+        print('scenario {}'.format(self.name))
+        self.load.set()
+        sleep(SETTLE)
+        faults = [self.fault(machine_num, fault, clients) for machine_num, fault in zip(self.ordering, self.faults)]
+        sleep(SETTLE)
+
+        # Stop sending, and wait for the last messages to be acknowledged and delivered
+        self.load.clear()
+        deadline = monotonic() + DRAIN_TIMEOUT
+        while monotonic() < deadline and any(client.unacked or client.resuming for client in clients):
+            sleep(0.05)
+        sleep(SETTLE)
+        self.done.set()
+        for thread in threads:
+            thread.join()
+        return {'scenario': self.name, 'faults': faults, 'messages': count_messages(clients)}
+
+# Compares what the clients sent and recieved
+def count_messages(clients):
+    recieved = Counter()
+    for client in clients:
+        recieved.update(client.recieved)
+    sent = [message_id for client in clients for message_id in client.sent]
+    acknowledged = set().union(*(client.acknowledged for client in clients))
+    return {
+        'sent':           len(sent),
+        'acknowledged':   len(acknowledged),
+        'recieved':       len(recieved),
+        'lost':           sorted(message_id for message_id in acknowledged if message_id not in recieved),
+        'duplicated':     sorted(message_id for message_id, count in recieved.items() if count > 1),
+        'unacknowledged': len(sent) - len(acknowledged),
+        'resume_failures': sum(client.resume_failures for client in clients),
+    }
+
+# Waits until a server listens on a port
+def wait_for_port(port):
+    deadline = monotonic() + RECOVERY_TIMEOUT
+    while True:
+        try:
+            create_connection((SERVER_IP, port)).close()
+            return
+        except ConnectionRefusedError:
+            if monotonic() > deadline:
+                raise
+            sleep(0.05)
+
+# Orderings (e.g., '0-1') of two of the servers
+def parse_ordering(text):
+    ordering = tuple(int(machine_num) for machine_num in text.split('-'))
+    if len(set(ordering)) != len(ordering) or not all(0 <= machine_num < SERVERS for machine_num in ordering):
+        raise ValueError('orderings must list distinct servers, e.g., 0-1')
+    return ordering
+
+def print_summary(results):
+    print('{:<26} {:>12} {:>16} {:>6} {:>6} {:>6} {:>6}'.format('scenario', 'new leader s', 'reconnect max s', 'sent', 'acked', 'lost', 'dup'))
+    for result in results:
+        messages = result['messages']
+        leader_times = [str(fault['time_to_new_leader']) for fault in result['faults'] if fault['was_leader']]
+        reconnects = [str(fault['time_to_reconnect']['max']) for fault in result['faults'] if 'time_to_reconnect' in fault]
+        print('{:<26} {:>12} {:>16} {:>6} {:>6} {:>6} {:>6}'.format(result['scenario'], ','.join(leader_times) or '-', ','.join(reconnects) or '-',
+                                                                   messages['sent'], messages['acknowledged'], len(messages['lost']), len(messages['duplicated'])))
+
+def main():
+    parser = ArgumentParser(description='Inject faults into the three-server topology under load and measure failover time and message loss.')
+    parser.add_argument('--orderings', nargs='+', type=parse_ordering, default=list(permutations(range(SERVERS), 2)),
+                        help='servers to fault, in order (default: every ordering of two servers, e.g., 0-1 0-2 1-0 ...)')
+    parser.add_argument('--faults', nargs='+', choices=FAULTS, default=FAULTS, help='faults to inject')
+    parser.add_argument('--mixed', action='store_true', help='also combine different faults within a scenario (e.g., kill then pause)')
+    parser.add_argument('--clients', type=int, default=10, help='number of clients under steady load')
+    parser.add_argument('--port', type=int, default=PORT, help='base port of the first leader')
+    parser.add_argument('--mode', choices=['thread', 'async'], default='thread')
+    parser.add_argument('--output', default='fault_results.json', help='file to save the results to (JSON)')
+    parser.add_argument('--logs', help='directory to save the output of every server to')
+    args = parser.parse_args()
+    if args.logs is not None:
+        os.makedirs(args.logs, exist_ok=True)
+
+    results = []
+    for ordering in args.orderings:
+        fault_lists = product(args.faults, repeat=len(ordering)) if args.mixed else [[fault] * len(ordering) for fault in args.faults]
+        for faults in fault_lists:
+            results.append(Scenario(ordering, list(faults), args).run())
+    print_summary(results)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print('Results saved to {}'.format(args.output))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+'''
+This file implements the heartbeat-based failure detector shared by servers and clients.
+
+Every connection whose peer may fail (leader -> backup, backup -> leader, and client -> leader) is
+kept alive with MSG_HEARTBEAT frames whenever it is otherwise idle for HEARTBEAT_INTERVAL seconds.
+The receiving side feeds every frame it recieves into a FailureDetector and suspects the peer
+once it has been silent for too long, instead of waiting for TCP to notice (which never happens
+for a hung process or a network partition).
+
+Two detectors are available:
+    - timeout-based (default): suspect the peer after FAILURE_TIMEOUT seconds of silence, so a failure
+      is always detected within FAILURE_TIMEOUT + HEARTBEAT_INTERVAL seconds
+    - phi-accrual: suspect the peer once phi = -log10(P(silence this long)) exceeds PHI_THRESHOLD, where
+      the probability is estimated from the recently observed gaps between frames
+'''
+# Import relevant python packages
+from collections import deque
+from math import erfc, inf, log10, sqrt
+from time import monotonic
+
+# Constants/configurations
+HEARTBEAT_INTERVAL = 0.1 # seconds of idleness after which a heartbeat is sent
+FAILURE_TIMEOUT    = 0.5 # seconds of silence after which the peer is suspected (timeout-based detector)
+PHI_THRESHOLD      = None # if set, use the phi-accrual detector with this threshold instead (e.g., 8)
+WINDOW_SIZE        = 100 # number of recent gaps between frames used to estimate phi
+MIN_STD_DEVIATION  = 0.05 # lower bound for the standard deviation of gaps (in seconds), so phi does not explode
+
+# Overrides the module configuration (from command line options)
+def configure(interval=None, timeout=None, phi_threshold=None):
+    global HEARTBEAT_INTERVAL
+    global FAILURE_TIMEOUT
+    global PHI_THRESHOLD
+    if interval is not None:
+        HEARTBEAT_INTERVAL = interval
+    if timeout is not None:
+        FAILURE_TIMEOUT = timeout
+    PHI_THRESHOLD = phi_threshold
+
+# Adds the heartbeat and failure detector command line options to an ArgumentParser
+def add_arguments(parser):
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help='seconds of idleness after which a heartbeat is sent (default: {})'.format(HEARTBEAT_INTERVAL))
+    parser.add_argument('--failure-timeout', type=float, default=FAILURE_TIMEOUT,
+                        help='seconds of silence after which a peer is suspected to have failed (default: {})'.format(FAILURE_TIMEOUT))
+    parser.add_argument('--phi-threshold', type=float, default=PHI_THRESHOLD,
+                        help='use a phi-accrual failure detector with this threshold instead of --failure-timeout (e.g., 8)')
+
+# Failure detector for one peer using the module configuration
+def new_detector():
+    return FailureDetector(FAILURE_TIMEOUT, PHI_THRESHOLD)
+
+# Tracks when a peer was last heard from and decides whether it has failed
+class FailureDetector:
+    def __init__(self, timeout=FAILURE_TIMEOUT, phi_threshold=None, window=WINDOW_SIZE):
+        self.timeout       = timeout
+        self.phi_threshold = phi_threshold
+        self.last          = monotonic() # time the peer was last heard from (or the detector was created)
+        self.gaps          = deque(maxlen=window) # recent gaps between frames (in seconds)
+
+    # Records that a frame was recieved from the peer
+    def heartbeat(self, now=None):
+        now = monotonic() if now is None else now
+        self.gaps.append(now - self.last)
+        self.last = now
+
+    # Seconds since the peer was last heard from
+    def silence(self, now=None):
+        now = monotonic() if now is None else now
+        return now - self.last
+
+    # Suspicion level: -log10 of the probability that the peer is still alive but silent for this long,
+    # assuming normally distributed gaps (bursts of frames do not count as gaps shorter than HEARTBEAT_INTERVAL)
+    def phi(self, now=None):
+        mean, std = HEARTBEAT_INTERVAL, MIN_STD_DEVIATION
+        if self.gaps:
+            mean = max(mean, sum(self.gaps) / len(self.gaps))
+            std = max(std, sqrt(sum((gap - mean) ** 2 for gap in self.gaps) / len(self.gaps)))
+        p_later = 0.5 * erfc((self.silence(now) - mean) / (std * sqrt(2)))
+        return -log10(p_later) if p_later > 0 else inf
+
+    def suspect(self, now=None):
+        if self.phi_threshold is not None:
+            return self.phi(now) > self.phi_threshold
+        return self.silence(now) > self.timeout
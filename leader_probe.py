@@ -0,0 +1,49 @@
+'''
+This file implements how clients (and servers forwarding to another shard) find the current leader
+after connecting or after a failover.
+
+Only the leader answers a new connection on the client port (with MSG_INIT). Backups keep listening,
+and leave new connections waiting in their listen backlog until they take over, so connecting to
+every server at once and keeping the first one that answers finds the leader, whichever it is.
+'''
+# Import relevant python packages
+from select import select
+from socket import socket, AF_INET, SOCK_STREAM
+from time import monotonic
+
+from protocol import FramedSocket
+
+# Constants/configurations
+PROBE_TIMEOUT = 5.0 # seconds to wait for one of the servers to take over as leader
+
+# Connects to every candidate server in parallel. Only the leader answers a new connection (with MSG_INIT), and a
+# backup that takes over later answers the connection we left waiting in its queue, so the first server to answer is the leader.
+# Returns (server index, FramedSocket) of the new leader, or None if no server answers within timeout seconds.
+def probe_leaders(candidates, timeout):
+    pending = {}
+    for index, address in candidates:
+        sock = socket(family=AF_INET, type=SOCK_STREAM)
+        sock.setblocking(False)
+        sock.connect_ex(address)
+        pending[sock] = (index, FramedSocket(sock))
+
+    winner = None
+    deadline = monotonic() + timeout
+    while pending and winner is None and monotonic() < deadline:
+        readable, _, _ = select(list(pending), [], [], max(0, deadline - monotonic()))
+        for sock in readable:
+            index, candidate = pending.pop(sock)
+            try:
+                answered = candidate.fill()
+            except OSError:
+                answered = False # connection refused (server is down)
+            if answered:
+                winner = (index, candidate)
+                break
+            sock.close()
+
+    for sock in pending:
+        sock.close()
+    if winner is not None:
+        winner[1].sock.setblocking(True)
+    return winner
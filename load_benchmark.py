@@ -0,0 +1,433 @@
+'''
+This file drives a leader and its backups with thousands of scripted clients, to measure how the replicated
+server behaves under load and to compare runs against each other.
+
+A leader and REPLICAS backups are started on loopback (base port PORT, so they also use the ports above it
+for backups, replication, and reads). CLIENTS clients then speak the same menu protocol as client.py, in phases:
+    1. create: each client connects and creates an account
+    2. chat: each client sends ROUNDS messages to random other clients and lists the users after each one
+    3. login: each client reconnects and logs in again
+    4. delete: each client deletes its account
+We report the throughput and p50/p99/p999 latency of every operation (from the line that starts it until its
+prompt comes back), and of delivery (from sending a message until its recipient recieves it). While the clients
+run, every backup is sampled on its read port for replication lag:
+    - visibility: time from the leader confirming an account creation until the backup has the account
+    - age: how stale the backup's state may be (see BackupState.staleness())
+and every server for its resident memory (RSS). At the end, every backup reports (from its metrics) how many
+bytes of replication stream it recieved before and after compression, and how many operations each batch held.
+
+Results are saved as JSON (--output). With --compare BASELINE, the latencies are compared to an earlier run's,
+and the exit status is 1 if a p99 latency grew by more than --max-regression percent.
+
+Usage: python3 load_benchmark.py [--clients CLIENTS] [--rounds ROUNDS] [--replicas REPLICAS] [--port PORT] [--mode thread|async]
+                                 [--quorum 0|1|all] [--output OUTPUT] [--compare BASELINE] [--max-regression PERCENT]
+                                 [--batch-delay SECONDS] [--batch-size BYTES] [--compression zlib|none] [--compression-level 1-9]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+from random import Random
+from socket import create_connection
+from time import perf_counter, sleep
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+from async_server import read_frame, raise_fd_limit
+from benchmark import process_stats, percentile, SERVER_IP, CONNECT_RATE
+from chat import WELCOME_PROMPT, MENU_PROMPT
+from protocol import encode_frame, MSG_TEXT, MSG_MAIL, MSG_MAIL_ACK, MSG_LOOKUP
+from read_replica import READ_OFFSET
+import metrics
+import replication
+
+# Constants/configurations
+ENCODING         = 'utf-8' # message encoding
+PORT             = 5234 # base port of the benchmark leader (its backups use the following ports)
+SAMPLE_INTERVAL  = 0.5 # seconds between samples of replication age and RSS
+VISIBILITY_EVERY = 20 # measure the visibility lag of every VISIBILITY_EVERY-th account creation
+POLL_INTERVAL    = 0.001 # seconds between lookups while waiting for an account to reach a backup
+VISIBILITY_LIMIT = 10.0 # seconds after which an account that has not reached a backup is counted as missing
+DELIVERY_LIMIT   = 1.0 # seconds to wait after the chat phase for messages still on their way to their recipients
+METRICS_OFFSET   = 400 # servers serve their metrics on port PORT+METRICS_OFFSET+MACHINE_NUM
+SEED             = 262 # message recipients are the same for every run
+OPERATIONS       = ['create', 'send', 'deliver', 'list', 'login', 'delete']
+
+# Starts a server (leader if machine_num is 0) in a subprocess
+def start_server(machine_num, args):
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    command = [sys.executable, server_path, SERVER_IP, str(machine_num), '--ip', SERVER_IP, '--port', str(args.port),
+               '--replicas', str(args.replicas), '--mode', args.mode, '--quorum', args.quorum,
+               '--batch-delay', str(args.batch_delay), '--batch-size', str(args.batch_size),
+               '--compression', args.compression, '--compression-level', str(args.compression_level),
+               '--metrics-port', str(args.port + METRICS_OFFSET)]
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+# Waits until a port accepts connections
+def wait_for_port(port):
+    while True:
+        try:
+            create_connection((SERVER_IP, port)).close()
+            return
+        except ConnectionRefusedError:
+            sleep(0.05)
+
+# Starts the leader, then its backups, and waits until the leader serves clients (i.e., every backup has joined)
+def start_servers(args):
+    processes = [start_server(0, args)]
+    wait_for_port(args.port) # the leader listens for backups right after its client port
+    sleep(0.1)
+    for machine_num in range(1, args.replicas + 1):
+        processes.append(start_server(machine_num, args))
+    for machine_num in range(1, args.replicas + 1):
+        wait_for_port(args.port + READ_OFFSET + machine_num)
+    return processes
+
+# Replication stream a backup recieved (from the metrics it serves): bytes before and after compression, and batch sizes
+def stream_stats(port):
+    samples = {}
+    for line in metrics.fetch(SERVER_IP, port).splitlines():
+        if not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            samples[name] = float(value)
+    wire = samples.get('replication_stream_bytes_total{size="wire"}', 0)
+    raw = samples.get('replication_stream_bytes_total{size="raw"}', 0)
+    batches = samples.get('replication_batch_frames_count', 0)
+    return {'wire_bytes': int(wire), 'raw_bytes': int(raw), 'saved_pct': round(100 * (raw - wire) / raw, 1) if raw else None,
+            'batches': int(batches), 'ops_per_batch': round(samples['replication_batch_frames_sum'] / batches, 1) if batches else None}
+
+# Latency summary of one operation (in milliseconds)
+def summarize(samples, elapsed=None):
+    if not samples:
+        return {'count': 0}
+    summary = {'count': len(samples),
+               'p50_ms':  round(percentile(samples, 0.50) * 1000, 3),
+               'p99_ms':  round(percentile(samples, 0.99) * 1000, 3),
+               'p999_ms': round(percentile(samples, 0.999) * 1000, 3),
+               'max_ms':  round(max(samples) * 1000, 3)}
+    if elapsed:
+        summary['throughput'] = round(len(samples) / elapsed, 1)
+    return summary
+
+# Connection of one scripted client. A reader task sorts the frames it recieves: prompts and replies are
+# queued for the client, messages from other clients are timed, and pages of queued mail are acknowledged.
+class BenchConnection:
+    def __init__(self, results):
+        self.results = results
+        self.texts   = asyncio.Queue() # replies (None once the server disconnected)
+
+    async def open(self, port, limit):
+        async with limit:
+            self.reader, self.writer = await asyncio.open_connection(SERVER_IP, port)
+            self.task = asyncio.ensure_future(self.read_loop())
+            await self.expect(WELCOME_PROMPT)
+
+    async def read_loop(self):
+        while True:
+            frame = await read_frame(self.reader)
+            if frame is None:
+                self.texts.put_nowait(None)
+                return
+            msg_type, payload = frame
+            if msg_type == MSG_MAIL:
+                page = json.loads(payload.decode(encoding=ENCODING))
+                self.writer.write(encode_frame(MSG_MAIL_ACK, str(page['start'] + len(page['messages'])).encode(encoding=ENCODING)))
+            elif msg_type == MSG_TEXT:
+                text = payload.decode(encoding=ENCODING)
+                # Messages from other clients ('<sender> sent at T') carry the time they were sent
+                if text.startswith('<bench_'):
+                    self.results['deliver'].append(perf_counter() - float(text.rpartition(' ')[2]))
+                else:
+                    self.texts.put_nowait(text)
+
+    def send(self, *lines):
+        for text in lines:
+            self.writer.write(encode_frame(MSG_TEXT, text.encode(encoding=ENCODING)))
+
+    # Waits until the server sends the given prompt
+    async def expect(self, prompt):
+        while True:
+            text = await self.texts.get()
+            if text is None:
+                raise ConnectionError('server disconnected while waiting for prompt')
+            if text == prompt:
+                return
+
+    # Waits until the server closes the connection
+    async def expect_close(self):
+        while await self.texts.get() is not None:
+            pass
+
+    def close(self):
+        self.writer.close()
+        self.task.cancel()
+
+# Read-only connection to a backup's read port, used to sample its replication lag
+class ReadClient:
+    def __init__(self, port):
+        self.port = port
+        self.lock = asyncio.Lock() # one lookup at a time (answers come back in order)
+        self.lost = False # the backup disconnected (e.g., the leader stopped replicating to it and it exited)
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(SERVER_IP, self.port)
+
+    # Answer to a MSG_LOOKUP request ({username, exists, seq, epoch, age}, or {error} while the backup catches up)
+    async def lookup(self, username):
+        async with self.lock:
+            self.writer.write(encode_frame(MSG_LOOKUP, json.dumps({'username': username}).encode(encoding=ENCODING)))
+            frame = await read_frame(self.reader)
+        if frame is None:
+            self.lost = True
+            raise ConnectionError('backup disconnected')
+        return json.loads(frame[1].decode(encoding=ENCODING))
+
+    # Waits until an account created at start has reached the backup, and records how long it took
+    async def wait_visible(self, username, start, lag):
+        try:
+            while not (await self.lookup(username)).get('exists'):
+                if perf_counter() - start > VISIBILITY_LIMIT:
+                    lag['missing'] += 1
+                    return
+                await asyncio.sleep(POLL_INTERVAL)
+        except ConnectionError:
+            lag['missing'] += 1
+            return
+        lag['visibility'].append(perf_counter() - start)
+
+# Scripted client speaking the client.py menu protocol
+class BenchClient:
+    def __init__(self, client_id, bench):
+        self.client_id = client_id
+        self.username  = 'bench_{}'.format(client_id)
+        self.bench     = bench
+        self.conn      = None
+        self.logged_in = False
+
+    # Runs one operation and records its latency (or counts its failure)
+    async def timed(self, operation, coroutine):
+        start = perf_counter()
+        try:
+            await coroutine
+        except (ConnectionError, OSError) as e:
+            self.bench.errors[operation] = self.bench.errors.get(operation, 0) + 1
+            self.bench.last_error = '{}: {}'.format(operation, e)
+            return False
+        self.bench.results[operation].append(perf_counter() - start)
+        return True
+
+    async def create(self):
+        self.conn = BenchConnection(self.bench.results)
+        await self.conn.open(self.bench.port, self.bench.limit)
+        self.conn.send('1', self.username, 'password')
+        if await self.timed('create', self.conn.expect(MENU_PROMPT)):
+            self.logged_in = True
+            self.bench.created(self.username)
+
+    async def chat(self, rounds, targets):
+        for target in targets[:rounds]:
+            self.conn.send('1', target, 'sent at {}'.format(perf_counter()))
+            await self.timed('send', self.conn.expect(MENU_PROMPT))
+            self.conn.send('2')
+            await self.timed('list', self.conn.expect(MENU_PROMPT))
+
+    async def login(self):
+        self.conn.close()
+        self.conn = BenchConnection(self.bench.results)
+        await self.conn.open(self.bench.port, self.bench.limit)
+        self.conn.send('2', self.username, 'password')
+        await self.timed('login', self.conn.expect(MENU_PROMPT))
+
+    # The server closes the connection once the account is deleted
+    async def delete(self):
+        self.conn.send('3', 'confirm')
+        await self.timed('delete', self.conn.expect_close())
+        self.conn.close()
+
+# One benchmark run: its clients, the backups it samples, and everything it measures
+class LoadBenchmark:
+    def __init__(self, args, processes):
+        self.port      = args.port
+        self.args      = args
+        self.processes = processes # leader, then backups
+        self.results   = {operation: [] for operation in OPERATIONS} # operation -> latencies (in seconds)
+        self.elapsed   = {} # operation -> seconds its phase took
+        self.errors    = {} # operation -> number of failures
+        self.last_error = None
+        self.backups   = [ReadClient(args.port + READ_OFFSET + machine_num) for machine_num in range(1, args.replicas + 1)]
+        self.lag       = [{'visibility': [], 'age': [], 'missing': 0} for _ in self.backups]
+        self.rss       = [{'start': None, 'peak': 0, 'end': None} for _ in processes] # in KB
+        self.streams   = [None for _ in self.backups] # replication stream of every backup (see stream_stats())
+        self.lag_tasks = []
+        self.creates   = 0
+
+    # An account creation was confirmed by the leader: measure when (some of) them reach the backups
+    def created(self, username):
+        self.creates += 1
+        if self.creates % VISIBILITY_EVERY == 0:
+            start = perf_counter()
+            for backup, lag in zip(self.backups, self.lag):
+                self.lag_tasks.append(asyncio.ensure_future(backup.wait_visible(username, start, lag)))
+
+    def sample_rss(self, key):
+        for process, rss in zip(self.processes, self.rss):
+            if process.poll() is not None:
+                continue # exited (the report lists it)
+            kb = process_stats(process.pid)['VmRSS']
+            rss[key] = kb
+            rss['peak'] = max(rss['peak'], kb)
+
+    # Samples the replication age of every backup and the RSS of every server until cancelled
+    async def sample(self):
+        while True:
+            self.sample_rss('end')
+            for backup, lag in zip(self.backups, self.lag):
+                if backup.lost:
+                    continue
+                try:
+                    answer = await backup.lookup('bench_0')
+                except ConnectionError:
+                    continue
+                if 'age' in answer and 'error' not in answer:
+                    lag['age'].append(answer['age'])
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    # Runs one phase of the benchmark (every client at once) and records how long it took
+    async def phase(self, name, coroutines, operations):
+        start = perf_counter()
+        await asyncio.gather(*coroutines)
+        elapsed = perf_counter() - start
+        for operation in operations:
+            self.elapsed[operation] = elapsed
+        print('{:<7} phase: {:.2f}s'.format(name, elapsed))
+
+    # Waits (at most DELIVERY_LIMIT seconds) until expected messages have reached their recipients, before the login phase closes their connections
+    async def wait_deliveries(self, expected):
+        deadline = perf_counter() + DELIVERY_LIMIT
+        while len(self.results['deliver']) < expected and perf_counter() < deadline:
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def run(self):
+        self.limit = asyncio.Semaphore(CONNECT_RATE)
+        for backup in self.backups:
+            await backup.open()
+        self.sample_rss('start')
+        sampler = asyncio.ensure_future(self.sample())
+
+        random = Random(SEED)
+        num_clients = self.args.clients
+        clients = [BenchClient(client_id, self) for client_id in range(num_clients)]
+        targets = [['bench_{}'.format(random.randrange(num_clients)) for _ in range(self.args.rounds)] for _ in clients]
+        await self.phase('create', [client.create() for client in clients], ['create'])
+        clients = [client for client in clients if client.logged_in]
+        await self.phase('chat', [client.chat(self.args.rounds, targets[client.client_id]) for client in clients], ['send', 'list', 'deliver'])
+        await self.wait_deliveries(len(self.results['send']))
+        await self.phase('login', [client.login() for client in clients], ['login'])
+        await self.phase('delete', [client.delete() for client in clients], ['delete'])
+
+        await asyncio.gather(*self.lag_tasks)
+        sampler.cancel()
+        self.sample_rss('end')
+        for machine_num in range(1, self.args.replicas + 1):
+            try:
+                self.streams[machine_num - 1] = stream_stats(self.port + METRICS_OFFSET + machine_num)
+            except OSError:
+                pass # the backup exited (the report lists it)
+
+    def report(self):
+        return {
+            'config': {key: value for key, value in vars(self.args).items() if key not in ('output', 'compare', 'max_regression')},
+            'operations': {operation: summarize(self.results[operation], self.elapsed.get(operation)) for operation in OPERATIONS},
+            'errors': self.errors,
+            'replication_lag': {'backup_{}'.format(machine_num + 1): {'visibility': summarize(lag['visibility']),
+                                                                      'missing': lag['missing'],
+                                                                      'lost': backup.lost,
+                                                                      'age_s': {'mean': round(sum(lag['age']) / len(lag['age']), 3) if lag['age'] else None,
+                                                                                'max': max(lag['age'], default=None)}}
+                                for machine_num, (backup, lag) in enumerate(zip(self.backups, self.lag))},
+            'exited': [('leader' if machine_num == 0 else 'backup_{}'.format(machine_num)) for machine_num, process in enumerate(self.processes)
+                       if process.poll() is not None],
+            'replication_stream': {'backup_{}'.format(machine_num + 1): stream for machine_num, stream in enumerate(self.streams)},
+            'rss_kb': {('leader' if machine_num == 0 else 'backup_{}'.format(machine_num)): rss for machine_num, rss in enumerate(self.rss)},
+        }
+
+def print_report(report):
+    print('{:<8} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('op', 'count', 'ops/s', 'p50 ms', 'p99 ms', 'p999 ms', 'max ms'))
+    for operation, summary in report['operations'].items():
+        if summary['count']:
+            print('{:<8} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(operation, summary['count'], summary.get('throughput', '-'),
+                                                                        summary['p50_ms'], summary['p99_ms'], summary['p999_ms'], summary['max_ms']))
+    for backup, lag in report['replication_lag'].items():
+        visibility = lag['visibility']
+        print('{}: visibility lag p50 {} ms, p99 {} ms ({} missing); state age mean {} s, max {} s{}'.format(
+            backup, visibility.get('p50_ms', '-'), visibility.get('p99_ms', '-'), lag['missing'], lag['age_s']['mean'], lag['age_s']['max'],
+            ' (DISCONNECTED)' if lag['lost'] else ''))
+    for backup, stream in report['replication_stream'].items():
+        if stream is not None and stream['batches']:
+            print('{}: replication stream {} KB -> {} KB compressed ({}% saved), {} batches of {} operations on average'.format(
+                backup, stream['raw_bytes'] // 1024, stream['wire_bytes'] // 1024, stream['saved_pct'], stream['batches'], stream['ops_per_batch']))
+    for server, rss in report['rss_kb'].items():
+        print('{}: RSS {} KB -> {} KB (peak {} KB)'.format(server, rss['start'], rss['end'], rss['peak']))
+    if report['errors']:
+        print('errors: {}'.format(report['errors']))
+    if report['exited']:
+        print('servers that exited during the run: {}'.format(', '.join(report['exited'])))
+
+# Compares the latencies of a run to a baseline run. Returns the operations whose p99 grew by more than max_regression percent.
+def compare(report, baseline, max_regression):
+    regressions = []
+    print('{:<8} {:>12} {:>12} {:>8} {:>12} {:>12} {:>8}'.format('op', 'base p50', 'p50', 'change', 'base p99', 'p99', 'change'))
+    for operation, summary in report['operations'].items():
+        before = baseline['operations'].get(operation, {})
+        if not summary['count'] or not before.get('count'):
+            continue
+        changes = [100.0 * (summary[key] - before[key]) / before[key] if before[key] else 0.0 for key in ('p50_ms', 'p99_ms')]
+        print('{:<8} {:>12} {:>12} {:>+7.1f}% {:>12} {:>12} {:>+7.1f}%'.format(operation, before['p50_ms'], summary['p50_ms'], changes[0],
+                                                                            before['p99_ms'], summary['p99_ms'], changes[1]))
+        if changes[1] > max_regression:
+            regressions.append(operation)
+    return regressions
+
+def main():
+    parser = ArgumentParser(description='Drive a leader and its backups with scripted clients and report latency, replication lag, and memory.')
+    parser.add_argument('--clients', type=int, default=2000, help='number of scripted clients')
+    parser.add_argument('--rounds', type=int, default=10, help='messages (and user listings) per client')
+    parser.add_argument('--replicas', type=int, default=2, help='number of backup servers')
+    parser.add_argument('--port', type=int, default=PORT, help='base port of the leader')
+    parser.add_argument('--mode', choices=['thread', 'async'], default='async')
+    parser.add_argument('--quorum', default='all', help='number of backups (0, 1, ..., or all) that must acknowledge a state change')
+    parser.add_argument('--output', default='load_results.json', help='file to save the results to (JSON)')
+    parser.add_argument('--compare', help='results of an earlier run (JSON) to compare the latencies to')
+    parser.add_argument('--max-regression', type=float, default=20.0, help='with --compare, exit with status 1 if a p99 latency grew by more than this percentage')
+    replication.add_arguments(parser)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    processes = start_servers(args)
+    try:
+        bench = LoadBenchmark(args, processes)
+        asyncio.run(bench.run())
+        report = bench.report()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    print_report(report)
+    if bench.last_error is not None:
+        print('last error: {}'.format(bench.last_error))
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print('Results saved to {}'.format(args.output))
+
+    if args.compare is not None:
+        with open(args.compare) as baseline:
+            regressions = compare(report, json.load(baseline), args.max_regression)
+        if regressions:
+            print('p99 latency regressed by more than {}%: {}'.format(args.max_regression, ', '.join(regressions)))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
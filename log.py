@@ -0,0 +1,149 @@
+'''
+This file implements the servers' logging: leveled log records written by a background thread.
+
+Logging a record only compares its level with LOG_LEVEL and, if it is enabled, queues the format
+string with its arguments. The writer thread formats and writes the queued records in batches, so a
+record below the configured level costs a function call, and a slow terminal (or disk) only slows
+down the writer thread, never the request path. If QUEUE_SIZE records are already waiting, new
+records are dropped (and counted in log_records_dropped_total) instead of blocking the caller.
+
+Arguments are only formatted when the record is written, so callers pass values (e.g., a sequence
+number), never state that keeps changing (e.g., 'users').
+
+Records that could happen on every request (e.g., every delivered message) are logged with sample():
+only one out of every SAMPLE_RATE of them (per format string) is written.
+'''
+# Import relevant python packages
+from queue import SimpleQueue, Empty
+from threading import Event, Lock, Thread
+from time import localtime, strftime, time
+import atexit
+import sys
+
+import metrics
+
+# Constants/configurations
+ENCODING      = 'utf-8' # encoding of the log file
+DEBUG         = 10 # every connection, request and delivered message (sampled)
+INFO          = 20 # changes of leader, backups joining and catching up, storage snapshots
+WARNING       = 30 # failed peers and dropped connections
+ERROR         = 40 # failures the server cannot recover from
+LEVELS        = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LOG_LEVEL     = INFO # records below this level are not logged
+SAMPLE_RATE   = 1 # sample() writes one out of every SAMPLE_RATE records (per format string)
+LOG_FILE      = None # file the records are appended to (None: standard output)
+QUEUE_SIZE    = 100000 # records waiting for the writer after which new records are dropped
+WRITE_BATCH   = 1000 # records written (and flushed) at once
+FLUSH_TIMEOUT = 1.0 # seconds to wait for the writer to write the remaining records at exit
+
+DROPPED = metrics.Counter('log_records_dropped_total', 'Log records dropped because the writer thread fell behind')
+
+records     = SimpleQueue() # (level, time, format string, arguments) of records to write, or an Event to set once they are written
+samples     = {} # format string -> number of records logged with it by sample()
+writer      = None # writer thread (started by the first record)
+writer_lock = Lock()
+
+# Overrides the module configuration (from command line options)
+def configure(level=None, sample_rate=None, path=None):
+    global LOG_LEVEL
+    global SAMPLE_RATE
+    global LOG_FILE
+    if level is not None:
+        LOG_LEVEL = LEVELS[level] if isinstance(level, str) else level
+    if sample_rate is not None:
+        SAMPLE_RATE = max(1, sample_rate)
+    LOG_FILE = path
+
+# Adds the logging command line options to an ArgumentParser
+def add_arguments(parser):
+    parser.add_argument('--log-level', choices=list(LEVELS), default='info',
+                        help='lowest level of the records that are logged (default: info; debug logs every connection and message)')
+    parser.add_argument('--log-sample', type=int, default=SAMPLE_RATE,
+                        help='at debug level, only log one out of every LOG_SAMPLE records of each per-message event (default: {})'.format(SAMPLE_RATE))
+    parser.add_argument('--log-file', help='append the log to this file (default: standard output)')
+
+# Whether records of this level are logged (to skip computing expensive arguments)
+def enabled(level):
+    return level >= LOG_LEVEL
+
+# Queues a record for the writer thread (text is formatted with text.format(*args) once it is written)
+def log(level, text, *args):
+    if level < LOG_LEVEL:
+        return
+    if writer is None:
+        start_writer()
+    if records.qsize() >= QUEUE_SIZE:
+        DROPPED.inc()
+        return
+    records.put((level, time(), text, args))
+
+def debug(text, *args):
+    if DEBUG >= LOG_LEVEL:
+        log(DEBUG, text, *args)
+
+def info(text, *args):
+    if INFO >= LOG_LEVEL:
+        log(INFO, text, *args)
+
+def warning(text, *args):
+    log(WARNING, text, *args)
+
+def error(text, *args):
+    log(ERROR, text, *args)
+
+# Logs one out of every SAMPLE_RATE records with this format string
+def sample(level, text, *args):
+    if level < LOG_LEVEL:
+        return
+    seen = samples.get(text, 0) # (a lost update under a race only shifts the sample)
+    samples[text] = seen + 1
+    if seen % SAMPLE_RATE == 0:
+        log(level, text, *args)
+
+def start_writer():
+    global writer
+    with writer_lock:
+        if writer is None:
+            writer = Thread(target=write_loop, daemon=True)
+            writer.start()
+            atexit.register(flush)
+
+# Formats one record as a line: time, level, and message
+def format_record(level, when, text, args):
+    try:
+        message = text.format(*args) if args else text
+    except (IndexError, KeyError, ValueError) as e:
+        message = '{} {!r} (could not format: {})'.format(text, args, e)
+    name = next((name.upper() for name, value in LEVELS.items() if value == level), str(level))
+    return '{}.{:03d} {:<7} {}'.format(strftime('%H:%M:%S', localtime(when)), int(when * 1000) % 1000, name, message)
+
+# Writer thread: formats and writes the queued records, one batch per write
+def write_loop():
+    stream = open(LOG_FILE, 'a', encoding=ENCODING) if LOG_FILE is not None else sys.stdout
+    reported = 0 # dropped records already reported
+    while True:
+        batch = [records.get()]
+        try:
+            while len(batch) < WRITE_BATCH:
+                batch.append(records.get_nowait())
+        except Empty:
+            pass
+        lines = [format_record(*record) for record in batch if not isinstance(record, Event)]
+        dropped = DROPPED.value()
+        if dropped > reported:
+            lines.append(format_record(WARNING, time(), 'LOG: dropped {} records (the writer fell behind)', (dropped - reported,)))
+            reported = dropped
+        if lines:
+            stream.write('\n'.join(lines) + '\n')
+            stream.flush()
+        for record in batch:
+            if isinstance(record, Event):
+                record.set()
+
+# Waits until every record logged so far has been written (at most FLUSH_TIMEOUT seconds)
+def flush():
+    if writer is None:
+        return
+    written = Event()
+    records.put(written)
+    written.wait(FLUSH_TIMEOUT)
@@ -0,0 +1,100 @@
+'''
+This file benchmarks the memory used by the 'users' state: the compact store (store.py) against the
+previous layout, where each user was a dict and each queued message a formatted '<sender> body' str.
+
+Each layout is built in a fresh Python process: USERS accounts are created, then MESSAGES messages of
+BODY_SIZE characters are queued for random users from random senders. We report the growth of the
+process's resident memory (RSS) per user and per queued message.
+
+Usage: python3 memory_benchmark.py [--users USERS] [--messages MESSAGES] [--body-size BODY_SIZE]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+from random import Random
+import gc
+import json
+import subprocess
+import sys
+
+from replication import apply_op, OP_CREATE_USER, OP_APPEND_MAIL
+
+# Constants/configurations
+LAYOUTS = ['dict', 'compact']
+SEED    = 262 # random recipients and senders are the same for every layout
+
+# Resident memory of this process (in bytes)
+def rss():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+# Previous layout: username -> dict, mailbox -> list of formatted str
+def create_dict_user(users, username, password):
+    users[username]['password'] = password
+    users[username]['mailbox']  = []
+    users[username]['drained']  = 0
+    users[username]['sessions'] = {}
+
+def append_dict_mail(users, username, body, sender):
+    users[username]['mailbox'].append('<{}> {}'.format(sender, body))
+
+# Compact layout: the replication log operations applied by the servers
+def create_compact_user(users, username, password):
+    apply_op(users, [OP_CREATE_USER, username, password])
+
+def append_compact_mail(users, username, body, sender):
+    apply_op(users, [OP_APPEND_MAIL, username, body, sender])
+
+# Builds one layout and returns the RSS growth after creating the users and after queuing the messages
+def measure(layout, num_users, num_messages, body_size):
+    if layout == 'dict':
+        from collections import defaultdict
+        users, create_user, append_mail = defaultdict(dict), create_dict_user, append_dict_mail
+    else:
+        users, create_user, append_mail = {}, create_compact_user, append_compact_mail
+    # Usernames exist in both layouts (as keys), so they are allocated before measuring
+    usernames = ['user_{}'.format(i) for i in range(num_users)]
+    random = Random(SEED)
+    gc.collect()
+
+    start = rss()
+    for i, username in enumerate(usernames):
+        create_user(users, username, 'password_{}'.format(i))
+    gc.collect()
+    after_users = rss()
+    for i in range(num_messages):
+        body = '{:0{}d}'.format(i, body_size)[-body_size:]
+        append_mail(users, usernames[random.randrange(num_users)], body, usernames[random.randrange(num_users)])
+    gc.collect()
+    after_messages = rss()
+    return {'layout': layout, 'users': after_users - start, 'messages': after_messages - after_users}
+
+def main():
+    parser = ArgumentParser(description='Benchmark memory per user and per queued message of the users state.')
+    parser.add_argument('--users', type=int, default=100000, help='number of accounts')
+    parser.add_argument('--messages', type=int, default=1000000, help='number of queued messages')
+    parser.add_argument('--body-size', type=int, default=32, help='characters per message body')
+    parser.add_argument('--layout', choices=LAYOUTS, help='measure a single layout in this process (used internally)')
+    args = parser.parse_args()
+
+    if args.layout is not None:
+        print(json.dumps(measure(args.layout, args.users, args.messages, args.body_size)))
+        return
+
+    print('{} users, {} queued messages of {} characters'.format(args.users, args.messages, args.body_size))
+    results = {}
+    for layout in LAYOUTS:
+        output = subprocess.run([sys.executable, __file__, '--layout', layout, '--users', str(args.users),
+                                 '--messages', str(args.messages), '--body-size', str(args.body_size)],
+                                check=True, capture_output=True, text=True).stdout
+        results[layout] = json.loads(output)
+        per_user = results[layout]['users'] / max(1, args.users)
+        per_message = results[layout]['messages'] / max(1, args.messages)
+        total = (results[layout]['users'] + results[layout]['messages']) / 2**20
+        print('{:>8}: {:8.1f} bytes/user {:8.1f} bytes/message {:8.1f} MB total'.format(layout, per_user, per_message, total))
+    for key, label in [('users', 'user'), ('messages', 'message')]:
+        print('compact uses {:.1f}x less memory per {}'.format(results['dict'][key] / max(1, results['compact'][key]), label))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+'''
+This file implements the server's metrics (counters and latency histograms of its hot paths) and a
+plain-text endpoint that serves them over HTTP in the Prometheus text format.
+
+Recording a value on a hot path only takes an uncontended lock and increments a bucket (found with
+bisect in the fixed bucket bounds): nothing is formatted or aggregated until the metrics are read.
+Values that would cost something to track on every change (e.g., the depth of every mailbox, or
+the replication lag of each backup) are gauges, computed by a function only when they are read.
+
+Server MACHINE_NUM serves its metrics on port METRICS_PORT+MACHINE_NUM if it is started with
+--metrics-port, to any HTTP client (e.g., curl or a Prometheus scraper), or to this file's stats command.
+
+Usage: python3 metrics.py IP PORT [NAME_PREFIX ...]
+'''
+# Import relevant python packages
+from argparse import ArgumentParser
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from math import inf
+from threading import Lock, Thread
+from urllib.request import urlopen
+
+# Constants/configurations
+ENCODING        = 'utf-8' # encoding of the served metrics
+METRICS_PORT    = None # server MACHINE_NUM serves its metrics on port METRICS_PORT+MACHINE_NUM (None: not served)
+FETCH_TIMEOUT   = 5.0 # seconds the stats command waits for the server
+CONTENT_TYPE    = 'text/plain; version=0.0.4; charset=utf-8' # Prometheus text format
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # seconds
+SIZE_BUCKETS    = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576) # bytes
+COUNT_BUCKETS   = (0, 1, 10, 100, 1000, 10000, 100000) # e.g., messages queued in a mailbox
+
+REGISTRY = [] # every metric, in the order they are served
+
+# Overrides the module configuration (from command line options)
+def configure(port=None):
+    global METRICS_PORT
+    METRICS_PORT = port
+
+# Adds the metrics command line options to an ArgumentParser
+def add_arguments(parser):
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='serve plain-text metrics over HTTP on port METRICS_PORT+MACHINE_NUM (default: not served)')
+
+# Formats the labels of a sample: its label (None if the metric has none) and an extra 'name="value"' pair
+def format_labels(label_name, label, extra=None):
+    pairs = ['{}="{}"'.format(label_name, label)] if label is not None else []
+    if extra is not None:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_header(metric, kind):
+    return ['# HELP {} {}'.format(metric.name, metric.help), '# TYPE {} {}'.format(metric.name, kind)]
+
+# Sample lines of one histogram series: counts has one count per bucket, and a last one for values above every bucket
+def histogram_lines(metric, label, counts, total):
+    labels = format_labels(metric.label_name, label)
+    lines = []
+    cumulative = 0
+    for bound, count in zip(metric.buckets + (inf,), counts):
+        cumulative += count
+        le = 'le="{}"'.format('+Inf' if bound == inf else bound)
+        lines.append('{}_bucket{} {}'.format(metric.name, format_labels(metric.label_name, label, le), cumulative))
+    lines.append('{}_sum{} {}'.format(metric.name, labels, total))
+    lines.append('{}_count{} {}'.format(metric.name, labels, cumulative))
+    return lines
+
+# Monotonically increasing count, optionally split by the value of one label
+class Counter:
+    def __init__(self, name, help, label_name=None):
+        self.name       = name
+        self.help       = help
+        self.label_name = label_name
+        self.values     = {} # label value (None without a label) -> count
+        self.lock       = Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, label=None):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def value(self, label=None):
+        return self.values.get(label, 0)
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items(), key=lambda item: str(item[0]))
+        lines = format_header(self, 'counter')
+        lines.extend('{}{} {}'.format(self.name, format_labels(self.label_name, label), value) for label, value in values)
+        return lines
+
+# Distribution of observed values (e.g., latencies) in fixed buckets, optionally split by the value of one label
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, label_name=None):
+        self.name       = name
+        self.help       = help
+        self.buckets    = tuple(buckets) # upper bounds of the buckets, in increasing order
+        self.label_name = label_name
+        self.series     = {} # label value (None without a label) -> [count per bucket (the last one is +Inf), sum of values]
+        self.lock       = Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, label=None):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label)
+            if series is None:
+                series = self.series[label] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        with self.lock:
+            series = sorted(((label, list(values)) for label, values in self.series.items()), key=lambda item: str(item[0]))
+        lines = format_header(self, 'histogram')
+        for label, values in series:
+            lines.extend(histogram_lines(self, label, values[:-1], values[-1]))
+        return lines
+
+# Value computed when the metrics are read: function returns a number, a dict label value -> number, or None (nothing to report)
+class Gauge:
+    def __init__(self, name, help, function, label_name=None):
+        self.name       = name
+        self.help       = help
+        self.function   = function
+        self.label_name = label_name
+        REGISTRY.append(self)
+
+    def render(self):
+        value = self.function()
+        if value is None:
+            return []
+        values = sorted(value.items(), key=lambda item: str(item[0])) if isinstance(value, dict) else [(None, value)]
+        lines = format_header(self, 'gauge')
+        lines.extend('{}{} {}'.format(self.name, format_labels(self.label_name, label), number) for label, number in values)
+        return lines
+
+# Histogram computed when the metrics are read, from the values returned by function (e.g., the depth of every mailbox)
+class Distribution:
+    def __init__(self, name, help, function, buckets=COUNT_BUCKETS):
+        self.name       = name
+        self.help       = help
+        self.function   = function
+        self.buckets    = tuple(buckets)
+        self.label_name = None
+        REGISTRY.append(self)
+
+    def render(self):
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0
+        for value in self.function():
+            counts[bisect_left(self.buckets, value)] += 1
+            total += value
+        return format_header(self, 'histogram') + histogram_lines(self, None, counts, total)
+
+# Current value of every metric in the Prometheus text format
+def render():
+    lines = []
+    for metric in list(REGISTRY):
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# Answers every GET /metrics request with the current metrics
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode(encoding=ENCODING)
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Requests are not logged (scrapers read the metrics every few seconds)
+    def log_message(self, format, *args):
+        pass
+
+# Serves the metrics on (ip, port) from a background thread. Returns the HTTP server (call shutdown() to stop it).
+def serve(ip, port):
+    server = ThreadingHTTPServer((ip, port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Reads the metrics served on (ip, port)
+def fetch(ip, port):
+    with urlopen('http://{}:{}/metrics'.format(ip, port), timeout=FETCH_TIMEOUT) as response:
+        return response.read().decode(encoding=ENCODING)
+
+# Stats command: prints the metrics of a server (only the metrics whose names start with one of the prefixes, if any)
+def main():
+    parser = ArgumentParser(description='Prints the metrics of a chat server started with --metrics-port.')
+    parser.add_argument('ip', metavar='IP')
+    parser.add_argument('port', metavar='PORT', type=int, help='metrics port of the server (METRICS_PORT+MACHINE_NUM)')
+    parser.add_argument('prefixes', metavar='NAME_PREFIX', nargs='*', help='only print the metrics whose names start with one of these')
+    args = parser.parse_args()
+    for line in fetch(args.ip, args.port).splitlines():
+        name = line.split(' ')[2] if line.startswith('#') else line
+        if not args.prefixes or any(name.startswith(prefix) for prefix in args.prefixes):
+            print(line)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+'''
+This file implements bounded per-connection outbound queues for the leader's client connections.
+
+Every frame sent to a client (its own replies and messages delivered by other sessions) goes through
+its connection's queue, and a single writer sends the queue, so frames from different sessions
+never interleave and a session never blocks on another client's TCP window.
+
+A message for an online user first reserves room in the recipient's queue. If the queue already holds
+OUTBOUND_LIMIT bytes, the OUTBOUND_POLICY decides what happens:
+    - mailbox: the message goes to the recipient's mailbox instead (default)
+    - drop: the recipient's connection is dropped, and the message goes to its mailbox
+    - block: the message is queued anyway, and the sender waits until the recipient has caught up
+'''
+# Import relevant python packages
+from collections import deque
+from socket import SHUT_RDWR, MSG_DONTWAIT
+from threading import Condition, Thread
+
+from protocol import FramedSocket, encode_frame
+import log
+
+# Constants/configurations
+OUTBOUND_LIMIT  = 256 * 1024 # bytes queued for a connection before it is considered full
+POLICY_MAILBOX  = 'mailbox'
+POLICY_DROP     = 'drop'
+POLICY_BLOCK    = 'block'
+OUTBOUND_POLICY = POLICY_MAILBOX # what to do with a message for a full connection
+
+# Overrides the module configuration (from command line options)
+def configure(limit=None, policy=None):
+    global OUTBOUND_LIMIT
+    global OUTBOUND_POLICY
+    if limit is not None:
+        OUTBOUND_LIMIT = limit
+    if policy is not None:
+        OUTBOUND_POLICY = policy
+
+# Adds the outbound queue command line options to an ArgumentParser
+def add_arguments(parser):
+    parser.add_argument('--outbound-limit', type=int, default=OUTBOUND_LIMIT,
+                        help='bytes queued for a client connection before it is full (default: {})'.format(OUTBOUND_LIMIT))
+    parser.add_argument('--outbound-policy', choices=[POLICY_MAILBOX, POLICY_DROP, POLICY_BLOCK], default=OUTBOUND_POLICY,
+                        help='message for a full connection: spill it to the mailbox, drop the connection, or block the sender (default: {})'.format(OUTBOUND_POLICY))
+
+# Client connection (thread-per-client mode) whose sends are queued and written by a single writer.
+# The first send to an idle connection is written directly (without blocking); only what the socket
+# does not accept right away is left to a writer thread, which exits once the queue is empty.
+class QueuedSocket(FramedSocket):
+    def __init__(self, sock, limit=None, policy=None):
+        super().__init__(sock)
+        self.limit     = OUTBOUND_LIMIT if limit is None else limit
+        self.policy    = OUTBOUND_POLICY if policy is None else policy
+        self.pending   = deque() # encoded frames waiting to be written
+        self.queued    = 0 # bytes pending or reserved
+        self.writing   = False # a writer currently owns the socket
+        self.closed    = False
+        self.condition = Condition()
+
+    # Queues frames (the session's own replies are never refused, see wait_for_room)
+    def send_frames(self, frames):
+        data = b''.join(encode_frame(msg_type, payload) for msg_type, payload in frames)
+        with self.condition:
+            if self.closed:
+                raise OSError('connection closed')
+            self.queued += len(data)
+        self.enqueue(data)
+
+    # Reserves room for a message from another session. Returns False if the message has to go to the mailbox instead.
+    def reserve(self, size):
+        with self.condition:
+            if self.closed:
+                return False
+            if self.queued > 0 and self.queued + size > self.limit:
+                if self.policy == POLICY_MAILBOX:
+                    return False
+                if self.policy == POLICY_DROP:
+                    self.drop()
+                    return False
+            self.queued += size
+            return True
+
+    # Queues an encoded message for which room was reserved (a broadcast queues the same bytes on every connection)
+    def send_reserved(self, data):
+        with self.condition:
+            if self.closed:
+                return
+        self.enqueue(data)
+
+    def enqueue(self, data):
+        with self.condition:
+            self.pending.append(data)
+            if self.writing:
+                return
+            self.writing = True
+            data = b''.join(self.pending)
+            self.pending.clear()
+        # Write directly what the socket accepts without blocking
+        try:
+            sent = self.sock.send(data, MSG_DONTWAIT)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.close()
+            return
+        with self.condition:
+            self.queued -= sent
+            self.condition.notify_all()
+            if sent < len(data):
+                self.pending.appendleft(data[sent:])
+            if not self.pending:
+                self.writing = False
+                return
+        Thread(target=self.write_loop, daemon=True).start()
+
+    # Writer thread: sends everything queued (pipelined into a single syscall) until the queue is empty
+    def write_loop(self):
+        while True:
+            with self.condition:
+                if not self.pending or self.closed:
+                    self.writing = False
+                    self.condition.notify_all()
+                    return
+                data = b''.join(self.pending)
+                self.pending.clear()
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.close()
+                return
+            with self.condition:
+                self.queued -= len(data)
+                self.condition.notify_all()
+
+    # Blocks the calling session until fewer than limit bytes are queued (or the connection is closed)
+    def wait_for_room(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or self.queued <= self.limit)
+
+    # Disconnects a client that is not reading fast enough (its session thread sees the disconnect)
+    def drop(self):
+        log.warning('LEADER: dropping slow connection with {} bytes queued', self.queued)
+        try:
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.pending.clear()
+            self.condition.notify_all()
+        self.sock.close()
@@ -0,0 +1,164 @@
+'''
+This file implements the framed wire protocol shared by the chat application servers and clients.
+
+Every message is sent as a frame: a fixed 5-byte header (4-byte big-endian payload length and
+1-byte message type) followed by the payload. Frames can be sent back-to-back in a single
+syscall and are reassembled by the reader regardless of how TCP splits or coalesces them.
+'''
+# Import relevant python packages
+from select import poll, POLLIN
+from struct import Struct
+from threading import Lock
+
+# Constants/configurations
+ENCODING       = 'utf-8' # message encoding
+RECV_SIZE      = 65536 # number of bytes requested per recv syscall
+MAX_FRAME_SIZE = 64 * 1024 * 1024 # reject frames larger than 64MB (corrupted stream)
+HEADER         = Struct('!IB') # payload length, message type
+
+# Message types
+MSG_TEXT = 0 # human-readable text (prompts, chat messages, and user input)
+MSG_INIT = 1 # comma-separated list of server IP addresses sent on connection
+MSG_OP   = 2 # replication log operation (JSON encoded) from leader to backup
+MSG_ACK  = 3 # highest applied replication log sequence number from backup to leader
+MSG_JOIN = 4 # backup's machine number, last applied position and the compressions it accepts (JSON encoded) sent when joining the leader
+
+# Catch-up snapshot sent from leader to a joining backup that is too far behind for the log tail
+MSG_SNAPSHOT_BEGIN = 5 # sequence number the snapshot starts at
+MSG_SNAPSHOT       = 6 # chunk of users (JSON encoded [[username, seq, record], ...], see User.record() in store.py)
+MSG_SNAPSHOT_END   = 7 # sequence number the backup is consistent at once it has been applied
+
+MSG_HEARTBEAT = 8 # empty keep-alive sent over idle connections (see heartbeat.py)
+
+# Resumable client sessions (see chat.py)
+MSG_SESSION   = 9 # session token (JSON encoded {username, token}) from leader to client after login
+MSG_RESUME    = 10 # client -> leader: session to resume (JSON encoded {username, token}); leader -> client: JSON encoded {ok}
+MSG_INPUT     = 11 # line of client input with an idempotency ID (JSON encoded [id, text])
+MSG_INPUT_ACK = 12 # ID of a committed line of client input and whether the session is back at a menu (JSON encoded [id, idle])
+
+# Paginated mailbox delivery (see chat.py)
+MSG_MAIL     = 13 # page of queued messages (JSON encoded {username, start, messages, remaining})
+MSG_MAIL_ACK = 14 # cursor up to which the client has recieved its queued messages (i.e., start + number of messages of a page)
+
+# Paginated user directory (see directory.py)
+MSG_LIST = 15 # client -> leader: JSON encoded {prefix, cursor, size}; leader -> client: JSON encoded {version, users, offset, total, cursor}
+
+# Sharded deployments (see sharding.py)
+MSG_REDIRECT = 16 # leader -> client: home shard of the username the client entered (JSON encoded {shard, ip, port})
+MSG_FORWARD  = 17 # leader -> leader of another shard: JSON encoded request {id, type, ...} (the first one authenticates, see sharding.py); answer: JSON encoded {id, status}
+
+# Read-only requests, also served by backups (see read_replica.py)
+MSG_LOOKUP = 18 # client -> server: JSON encoded {username}; server -> client: JSON encoded {username, exists}
+
+# Structured requests of programmatic clients (see chat.py and async_client.py)
+MSG_REQUEST = 19 # client -> leader: JSON encoded {id, op, ...}; leader -> client: JSON encoded {id, status, ...}
+
+# Compressed replication stream (see replication.py)
+MSG_BATCH = 20 # leader -> backup: frames (operations and snapshot chunks) compressed by the zlib stream of the connection
+
+# Multi-process leader (see workers.py)
+MSG_WORKER = 21 # leader process <-> worker process, and worker -> worker: JSON encoded {type, ...}
+
+# Encodes a single frame
+def encode_frame(msg_type, payload):
+    return HEADER.pack(len(payload), msg_type) + payload
+
+# Reassembles frames from bytes recieved in arbitrary chunks
+class FrameBuffer:
+    def __init__(self):
+        self.buffer = bytearray() # recieved bytes that have not been parsed into frames yet
+        self.offset = 0 # start of the first unparsed frame in buffer
+
+    def feed(self, data):
+        # Compact the buffer before growing it so it does not keep already parsed frames around
+        if self.offset:
+            del self.buffer[:self.offset]
+            self.offset = 0
+        self.buffer += data
+
+    # Returns the next complete (msg_type, payload) frame in the buffer, or None if there is none yet
+    def next_frame(self):
+        if len(self.buffer) - self.offset < HEADER.size:
+            return None
+        length, msg_type = HEADER.unpack_from(self.buffer, self.offset)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError('Frame of {} bytes exceeds MAX_FRAME_SIZE'.format(length))
+        start = self.offset + HEADER.size
+        if len(self.buffer) - start < length:
+            return None
+        self.offset = start + length
+        return msg_type, bytes(self.buffer[start:self.offset])
+
+    # Returns True if a complete frame is already buffered (i.e., recv_frame will not block)
+    def has_frame(self):
+        if len(self.buffer) - self.offset < HEADER.size:
+            return False
+        length, _ = HEADER.unpack_from(self.buffer, self.offset)
+        return len(self.buffer) - self.offset - HEADER.size >= length
+
+    # Yields all complete frames currently in the buffer (does not block)
+    def frames(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+# Socket wrapper that sends and recieves whole frames
+class FramedSocket(FrameBuffer):
+    def __init__(self, sock):
+        super().__init__()
+        self.sock      = sock
+        self.send_lock = Lock() # frames from different threads must not interleave
+
+    # Allows FramedSocket to be used directly with select()
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    # Sends several frames with a single syscall
+    def send_frames(self, frames):
+        data = b''.join(encode_frame(msg_type, payload) for msg_type, payload in frames)
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def send_frame(self, msg_type, payload):
+        self.send_frames([(msg_type, payload)])
+
+    def send_text(self, text):
+        self.send_frame(MSG_TEXT, text.encode(encoding=ENCODING))
+
+    # Reads once from the socket into the buffer. Returns False if the peer has disconnected.
+    def fill(self):
+        data = self.sock.recv(RECV_SIZE)
+        if not data:
+            return False
+        self.feed(data)
+        return True
+
+    # Waits up to timeout seconds for data (or a disconnect) to be available to recv
+    def readable(self, timeout):
+        poller = poll() # unlike select(), works with file descriptors above 1024
+        poller.register(self.sock, POLLIN)
+        return len(poller.poll(timeout * 1000)) > 0
+
+    # Blocks until a complete frame is recieved. Returns None if the peer has disconnected.
+    # If timeout is set, raises TimeoutError once no data has been recieved for timeout seconds.
+    def recv_frame(self, timeout=None):
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            if timeout is not None and not self.readable(timeout):
+                raise TimeoutError('no data recieved for {} seconds'.format(timeout))
+            if not self.fill():
+                return None
+
+    # Blocks until a complete frame is recieved and decodes its payload. Returns None if the peer has disconnected.
+    def recv_text(self):
+        frame = self.recv_frame()
+        if frame is None:
+            return None
+        return frame[1].decode(encoding=ENCODING)
@@ -0,0 +1,137 @@
+'''
+This file implements read-only client connections served by backup servers, so that read-heavy load
+(listing users and checking whether a username exists) is spread over every server instead of the leader.
+
+A backup accepts these connections on its read port (PORT+READ_OFFSET+MACHINE_NUM), which is separate
+from its client port: clients find the leader by the fact that only the leader answers on the client port.
+Backups answer from their replicated state:
+    - MSG_LIST: one page of the user directory (see directory.py)
+    - MSG_LOOKUP: whether a username exists
+Every answer is tagged with how stale the backup's state may be (see BackupState.staleness()): the
+sequence number of the last operation applied, the leader it came from (epoch), and the age in seconds
+such that every operation the leader had sent that long ago is reflected. A backup that is catching up
+from a snapshot answers with an error instead.
+
+Any other request is a write (or needs a logged in session): the connection is forwarded to the current
+leader, i.e., its frames are relayed in both directions from then on, starting with that request.
+Once the backup takes over as leader, it stops serving read-only connections.
+'''
+# Import relevant python packages
+from socket import socket, create_connection, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SOMAXCONN, SHUT_RDWR
+from threading import Lock, Thread
+import json
+
+from directory import LIST_PAGE_SIZE
+from protocol import FramedSocket, MSG_HEARTBEAT, MSG_LIST, MSG_LOOKUP
+import heartbeat
+import log
+
+# Constants/configurations
+ENCODING    = 'utf-8' # message encoding
+READ_OFFSET = 200 # server MACHINE_NUM accepts read-only clients on port PORT+READ_OFFSET+MACHINE_NUM
+
+# Answer to a read-only request (JSON encoded), tagged with the staleness of the backup's state
+def read_answer(backup, msg_type, request):
+    staleness = backup.staleness()
+    if backup.catching_up():
+        return json.dumps(dict(staleness, error='catching up')).encode(encoding=ENCODING)
+    if msg_type == MSG_LOOKUP:
+        username = request['username']
+        return json.dumps(dict(staleness, username=username, exists=username in backup.users)).encode(encoding=ENCODING)
+    # The cached page is a JSON object: add the staleness fields to it without decoding it
+    page = backup.directory.list_page(request.get('prefix', ''), request.get('cursor'), request.get('size', LIST_PAGE_SIZE))
+    return page[:-1] + b', ' + json.dumps(staleness).encode(encoding=ENCODING)[1:]
+
+# Closes a connection, waking up any thread blocked reading from it
+def shutdown(sock):
+    try:
+        sock.sock.shutdown(SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+# Relays frames from one connection to the other until either side disconnects
+def relay(source, destination):
+    try:
+        while True:
+            frame = source.recv_frame()
+            if frame is None:
+                break
+            destination.send_frame(*frame)
+    except OSError:
+        pass
+    shutdown(source)
+    shutdown(destination)
+
+# Server for read-only client connections on a backup
+class ReadServer:
+    def __init__(self, ip, port, backup, leader_address):
+        self.backup         = backup # BackupState whose replicated state is read
+        self.leader_address = leader_address # function returning the (IP address, port) clients of the current leader connect to
+        self.connections    = set() # open client connections (closed once the backup takes over as leader)
+        self.lock           = Lock()
+        self.server         = socket(AF_INET, SOCK_STREAM)
+        self.server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.server.bind((ip, port))
+        self.server.listen(SOMAXCONN)
+
+    def start(self):
+        Thread(target=self.accept_loop, daemon=True).start()
+
+    # Stops serving read-only connections (the backup has taken over as leader)
+    def stop(self):
+        self.server.close()
+        with self.lock:
+            connections, self.connections = self.connections, set()
+        for sock in connections:
+            shutdown(sock)
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, addr = self.server.accept()
+            except OSError:
+                return
+            sock = FramedSocket(sock)
+            with self.lock:
+                self.connections.add(sock)
+            Thread(target=self.client_thread, args=(sock, addr), daemon=True).start()
+
+    # Thread answering the read-only requests of one client
+    def client_thread(self, sock, addr):
+        try:
+            while True:
+                frame = sock.recv_frame()
+                if frame is None:
+                    break
+                msg_type, payload = frame
+                if msg_type in (MSG_LIST, MSG_LOOKUP):
+                    sock.send_frame(msg_type, read_answer(self.backup, msg_type, json.loads(payload.decode(encoding=ENCODING))))
+                elif msg_type == MSG_HEARTBEAT:
+                    sock.send_frame(MSG_HEARTBEAT, b'')
+                else:
+                    self.forward_to_leader(sock, addr, frame)
+                    return
+        except (OSError, ValueError, KeyError) as e:
+            log.debug('BACKUP: closing read-only connection {}:{} ({})', addr[0], addr[1], e)
+        self.close(sock)
+
+    # Relays the rest of the connection to the current leader, starting with frame
+    def forward_to_leader(self, sock, addr, frame):
+        try:
+            leader = FramedSocket(create_connection(self.leader_address(), timeout=heartbeat.FAILURE_TIMEOUT))
+            leader.sock.settimeout(None)
+            leader.send_frame(*frame)
+        except OSError as e:
+            log.warning('BACKUP: could not forward {}:{} to the leader ({})', addr[0], addr[1], e)
+            self.close(sock)
+            return
+        log.debug('BACKUP: forwarding {}:{} to the leader @ {}:{}', addr[0], addr[1], *self.leader_address())
+        Thread(target=relay, args=(leader, sock), daemon=True).start()
+        relay(sock, leader)
+        self.close(sock)
+
+    def close(self, sock):
+        with self.lock:
+            self.connections.discard(sock)
+        shutdown(sock)
@@ -0,0 +1,713 @@
+'''
+This file implements the replication log that the leader server sends to backup servers.
+
+Every mutation of the 'users' state is a typed operation (a JSON list whose first element is the
+operation type) that backups apply incrementally in the order they are recieved.
+
+On the leader, sessions never apply operations themselves: each commit is queued as a command, and a
+single applier at a time (whichever session finds no applier running) applies every queued command
+in order, appends them to the log, and hands them to storage and to the backups as one batch. The
+leader and the backups therefore apply the same operation stream with the same apply_op(), and
+sessions waiting to commit hand their commands to the applier instead of contending for the lock.
+Sessions read the live state rather than immutable snapshots of it: they only look up single users, and
+mailboxes and the user directory publish immutable versions of themselves (see store.py and directory.py).
+
+The leader assigns each operation a sequence number and hands it to one sender thread per backup,
+so a slow backup never blocks client handling. Backups acknowledge the highest sequence number
+they have applied, and clients can wait until a configurable quorum of backups has acknowledged
+their operations (0, 1, ..., or all backups). If the leader persists its state (see storage.py),
+operations are also only committed once they are durable in the leader's own write-ahead log.
+
+A backup that joins (or rejoins) a leader reports the position of the last operation it applied.
+The leader streams it either the missing tail of the log (if it is still in memory) or a chunked
+snapshot of 'users' followed by all operations after the snapshot started. The backup only counts
+towards the quorum once it has caught up.
+
+The leader sends a heartbeat to every idle backup, and backups answer every batch of frames with an
+acknowledgement, so each side detects a hung or partitioned peer with a FailureDetector (see heartbeat.py).
+
+Each backup's sender sends every operation queued for its backup together (up to BATCH_SIZE bytes), after
+waiting up to BATCH_DELAY seconds for more of them (none by default: the wait adds to every commit, while the
+zlib stream already compresses small batches well). Backups offer zlib compression when they join (MSG_JOIN), and
+the leader then sends them batches of frames (operations and snapshot chunks) as MSG_BATCH frames,
+compressed by one zlib stream per backup: later batches reuse the text of earlier ones (e.g., the same
+usernames and message prefixes), so even small batches compress well. Backups report the batch sizes
+and the bytes saved as metrics, to tune the window against the latency it adds.
+'''
+# Import relevant python packages
+from collections import deque
+from queue import Queue, Empty
+from threading import Condition, Lock, Thread
+from time import monotonic, perf_counter
+import asyncio
+import json
+import zlib
+
+from directory import Directory, Groups
+from protocol import FrameBuffer, encode_frame, MSG_OP, MSG_ACK, MSG_SNAPSHOT_BEGIN, MSG_SNAPSHOT, MSG_SNAPSHOT_END, MSG_HEARTBEAT, MSG_BATCH
+from store import User, BODIES
+import heartbeat
+import log
+import metrics
+
+# Constants/configurations
+ENCODING       = 'utf-8' # message encoding
+ALL_REPLICAS   = 'all' # quorum that waits for every connected backup
+LOG_TAIL_SIZE  = 100000 # number of recent operations kept in memory for catching up backups
+SNAPSHOT_CHUNK = 1000 # number of users per snapshot frame
+NO_EPOCH       = -1 # epoch of a backup that does not know which leader its state came from
+MAX_SESSIONS   = 8 # resumable sessions kept per user (the oldest is dropped)
+
+# Replication stream (leader -> backup)
+BATCH_DELAY       = 0.0 # seconds a sender waits for more operations before sending a batch to its backup (0: only what is already queued)
+BATCH_SIZE        = 65536 # bytes of operations after which a batch is sent without waiting (and the most sent in one frame)
+NO_COMPRESSION    = 'none'
+COMPRESSIONS      = ['zlib', NO_COMPRESSION] # compressions of the replication stream (zlib is offered by backups unless disabled)
+COMPRESSION       = 'zlib' # compression this server offers as a backup and accepts as a leader
+COMPRESSION_LEVEL = 6 # zlib level (1: fastest, 9: smallest)
+
+# Replication log operation types (leader -> backup)
+OP_CREATE_USER    = 'create'  # [OP_CREATE_USER, username, password]
+OP_DELETE_USER    = 'delete'  # [OP_DELETE_USER, username]
+OP_APPEND_MAIL    = 'mail'    # [OP_APPEND_MAIL, username, body, sender] (without sender: a formatted message)
+OP_DRAIN_MAIL     = 'drain'   # [OP_DRAIN_MAIL, username, cursor] (without cursor: the whole mailbox)
+OP_CREATE_SESSION = 'session' # [OP_CREATE_SESSION, username, token]
+OP_SENT           = 'sent'    # [OP_SENT, username, token, input ID of last message sent by the session]
+OP_ADOPT_USER     = 'adopt'   # [OP_ADOPT_USER, username, record] (user handed over by another shard, see User.record() and sharding.py)
+OP_JOIN_GROUP     = 'join'    # [OP_JOIN_GROUP, username, group]
+OP_LEAVE_GROUP    = 'leave'   # [OP_LEAVE_GROUP, username, group]
+OP_BROADCAST      = 'broadcast' # [OP_BROADCAST, sender, body, group (None: all users), usernames the leader delivered it to directly]
+
+# Metrics (see metrics.py): a state update is a batch of commands applied by the leader, or a frame from the leader applied by a backup
+STATE_UPDATE_SECONDS = metrics.Histogram('state_update_seconds', 'Seconds spent applying a state update (and handing it to storage and to the backups)', label_name='role')
+STATE_UPDATE_BYTES   = metrics.Histogram('state_update_bytes', 'Encoded bytes of the operations of a state update', metrics.SIZE_BUCKETS, label_name='role')
+BATCH_DELAY_SECONDS  = metrics.Histogram('replication_batch_delay_seconds', 'Seconds a sender waited for more operations before sending a batch to its backup (leader only)')
+BATCH_FRAMES         = metrics.Histogram('replication_batch_frames', 'Frames completed by each compressed batch recieved from the leader (backups only)', metrics.COUNT_BUCKETS)
+BATCH_BYTES          = metrics.Histogram('replication_batch_bytes', 'Compressed bytes of each batch recieved from the leader (backups only)', metrics.SIZE_BUCKETS)
+STREAM_BYTES         = metrics.Counter('replication_stream_bytes_total', 'Bytes of the compressed batches recieved from the leader, as sent (wire) and decompressed (raw)', label_name='size')
+BYTES_SAVED          = metrics.Counter('replication_bytes_saved_total', 'Bytes compression saved on the replication stream from the leader (backups only)')
+
+# Overrides the module configuration (from command line options)
+def configure(batch_delay=None, batch_size=None, compression=None, compression_level=None):
+    global BATCH_DELAY
+    global BATCH_SIZE
+    global COMPRESSION
+    global COMPRESSION_LEVEL
+    if batch_delay is not None:
+        BATCH_DELAY = batch_delay
+    if batch_size is not None:
+        BATCH_SIZE = batch_size
+    if compression is not None:
+        COMPRESSION = compression
+    if compression_level is not None:
+        COMPRESSION_LEVEL = compression_level
+
+# Adds the replication stream command line options to an ArgumentParser
+def add_arguments(parser):
+    parser.add_argument('--batch-delay', type=float, default=BATCH_DELAY,
+                        help='seconds the leader waits for more operations before sending a batch to a backup (default: {})'.format(BATCH_DELAY))
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='bytes of operations after which the leader sends a batch without waiting (default: {})'.format(BATCH_SIZE))
+    parser.add_argument('--compression', choices=COMPRESSIONS, default=COMPRESSION,
+                        help='compression of the replication stream, offered as a backup and accepted as a leader (default: {})'.format(COMPRESSION))
+    parser.add_argument('--compression-level', type=int, choices=range(1, 10), default=COMPRESSION_LEVEL, metavar='1-9',
+                        help='zlib compression level of the replication stream (default: {})'.format(COMPRESSION_LEVEL))
+
+# Compressions a backup offers in its MSG_JOIN
+def offered_compressions():
+    return [] if COMPRESSION == NO_COMPRESSION else [COMPRESSION]
+
+# Compression the leader uses for a backup that offered these (None: uncompressed MSG_OP frames)
+def choose_compression(offered):
+    return COMPRESSION if COMPRESSION in offered else None
+
+# Parses the --quorum command line option ('all' or a number of backups)
+def parse_quorum(quorum):
+    if quorum == ALL_REPLICAS:
+        return ALL_REPLICAS
+    quorum = int(quorum)
+    if quorum < 0:
+        raise ValueError('quorum must be non-negative')
+    return quorum
+
+# Encodes an operation with its sequence number as a MSG_OP payload
+def encode_op(seq, op):
+    return json.dumps([seq, op]).encode(encoding=ENCODING)
+
+# Decodes a MSG_OP payload into (sequence number, operation)
+def decode_op(payload):
+    seq, op = json.loads(payload.decode(encoding=ENCODING))
+    return seq, op
+
+# Recipients of a broadcast: every member of the group (every user if group is None) except the sender and
+# the users it was delivered to directly, i.e., the users whose mailbox it is queued in
+def broadcast_recipients(users, sender, group, delivered):
+    delivered = set(delivered)
+    return [username for username, user in users.items()
+            if username != sender and username not in delivered and (group is None or (user.groups is not None and group in user.groups))]
+
+# Applies a replication log operation to local users state (username -> User, see store.py).
+# If seq is given, the user remembers the sequence number of the last operation applied to it (User.seq).
+# A broadcast is only queued for the recipients for which reflected(username) is False (default: all of them).
+def apply_op(users, op, seq=None, reflected=None):
+    op_type, username = op[0], op[1]
+    if op_type == OP_BROADCAST:
+        recipients = broadcast_recipients(users, op[1], op[3], op[4])
+        if reflected is not None:
+            recipients = [recipient for recipient in recipients if not reflected(recipient)]
+        if recipients:
+            body_id = BODIES.add(op[2], op[1], len(recipients)) # stored once for all recipients
+            for recipient in recipients:
+                users[recipient].mailbox.append_shared(body_id)
+                if seq is not None:
+                    users[recipient].seq = seq
+        return
+    if op_type == OP_CREATE_USER:
+        users[username] = User(op[2])
+    elif op_type == OP_ADOPT_USER:
+        users[username] = User.from_record(op[2])
+    elif op_type == OP_DELETE_USER:
+        user = users.pop(username, None)
+        if user is not None:
+            user.mailbox.drain(len(user.mailbox)) # releases its broadcast messages
+        return
+    elif op_type == OP_APPEND_MAIL:
+        users[username].mailbox.append(op[2], op[3] if len(op) > 3 else None)
+    # Removes the messages before cursor, i.e., those the client has acknowledged (acknowledging twice is harmless)
+    elif op_type == OP_DRAIN_MAIL:
+        user = users[username]
+        cursor = op[2] if len(op) > 2 else user.drained + len(user.mailbox)
+        if cursor > user.drained:
+            user.mailbox.drain(cursor - user.drained)
+            user.drained = cursor
+    elif op_type == OP_CREATE_SESSION:
+        user = users[username]
+        if user.sessions is None:
+            user.sessions = {}
+        user.sessions[op[2]] = 0
+        if len(user.sessions) > MAX_SESSIONS:
+            del user.sessions[next(iter(user.sessions))]
+    elif op_type == OP_SENT:
+        sessions = users[username].sessions
+        if sessions is not None and op[2] in sessions:
+            sessions[op[2]] = op[3]
+    elif op_type == OP_JOIN_GROUP:
+        user = users[username]
+        if user.groups is None:
+            user.groups = set()
+        user.groups.add(op[2])
+    elif op_type == OP_LEAVE_GROUP:
+        user = users[username]
+        if user.groups is not None:
+            user.groups.discard(op[2])
+            if not user.groups:
+                user.groups = None
+    else:
+        log.warning('BACKUP: Ignoring unknown replication operation {}', op_type)
+        return
+    if seq is not None:
+        users[username].seq = seq
+
+# Updates a directory and group index (see directory.py) once an operation has been applied to users
+# (deleted: the user deleted by an OP_DELETE_USER operation, whose groups are gone from users)
+def index_op(directory, groups, users, op, deleted=None):
+    op_type, username = op[0], op[1]
+    if op_type in (OP_CREATE_USER, OP_ADOPT_USER):
+        directory.add(username)
+        for group in users[username].groups or ():
+            groups.join(group, username)
+    elif op_type == OP_DELETE_USER:
+        directory.remove(username)
+        for group in (deleted.groups if deleted is not None else None) or ():
+            groups.leave(group, username)
+    elif op_type == OP_JOIN_GROUP:
+        groups.join(op[2], username)
+    elif op_type == OP_LEAVE_GROUP:
+        groups.leave(op[2], username)
+
+# Operations committed together by a session, queued for the applier (see Replicator.replicate_commands())
+class Command:
+    __slots__ = ('ops', 'seq', 'done', 'error', 'wakeup')
+
+    def __init__(self, ops):
+        self.ops    = ops
+        self.seq    = None # sequence number of the last operation once applied
+        self.done   = False
+        self.error  = None # exception raised while applying the operations
+        self.wakeup = None # if the command is queued: released by the applier once it is done (or to make its session the next applier)
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.seq
+
+# Leader-side connection to one backup: a sender thread drains the queue, an ack thread reads acknowledgements
+class ReplicaSender:
+    def __init__(self, sock, addr, replicator, compression=None, voting=True):
+        self.sock         = sock
+        self.addr         = addr
+        self.replicator   = replicator
+        self.voting       = voting # counts towards the quorum once caught up (worker processes follow the stream without voting, see workers.py)
+        self.compressor   = zlib.compressobj(COMPRESSION_LEVEL) if compression == 'zlib' else None # one stream for the whole connection
+        self.queue        = Queue() # lists of (seq, frame payload) waiting to be sent
+        self.sent_seq     = 0 # highest sequence number sent
+        self.acked_seq    = 0 # highest sequence number acknowledged
+        self.send_times   = deque() # (seq, time queued) of unacknowledged operations
+        self.alive        = True
+        self.snapshot_seq = None # if not None, stream a snapshot taken after this sequence number first
+        self.catchup_seq  = None # backup has caught up once it acknowledges this sequence number
+
+    # Whether this backup counts towards the quorum
+    def in_quorum(self):
+        return self.voting and self.alive and self.catchup_seq is not None and self.acked_seq >= self.catchup_seq
+
+    def start(self):
+        Thread(target=self.send_loop, daemon=True).start()
+        Thread(target=self.ack_loop, daemon=True).start()
+
+    # Sends frames with a single syscall, or as compressed MSG_BATCH frames if the backup accepted compression. Large frames
+    # (e.g., snapshot chunks) are compressed and sent BATCH_SIZE bytes at a time, so the backup keeps hearing from the leader.
+    def send_frames(self, frames):
+        if self.compressor is None:
+            self.sock.send_frames(frames)
+            return
+        data = memoryview(b''.join(encode_frame(msg_type, payload) for msg_type, payload in frames))
+        for start in range(0, len(data), BATCH_SIZE):
+            self.sock.send_frame(MSG_BATCH, self.compressor.compress(data[start:start+BATCH_SIZE]) + self.compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    # Streams users in chunks. Only one chunk at a time is read under the replicator lock, so clients are not stalled.
+    def send_snapshot(self):
+        replicator = self.replicator
+        with replicator.lock:
+            usernames = list(replicator.users)
+        log.info('LEADER: streaming snapshot of {} users to backup @ {}', len(usernames), self.addr)
+        self.sock.send_frame(MSG_SNAPSHOT_BEGIN, str(self.snapshot_seq).encode(encoding=ENCODING))
+        for start in range(0, len(usernames), SNAPSHOT_CHUNK):
+            records = []
+            with replicator.lock:
+                for username in usernames[start:start+SNAPSHOT_CHUNK]:
+                    user = replicator.users.get(username)
+                    if user is not None:
+                        records.append([username, user.seq, user.record()])
+            self.send_frames([(MSG_SNAPSHOT, json.dumps(records).encode(encoding=ENCODING))])
+
+        # Operations up to end_seq may or may not be reflected in the snapshot (the backup skips those already
+        # reflected using each user's 'seq'). The backup is consistent once it has applied end_seq.
+        with replicator.lock:
+            end_seq = replicator.seq
+            self.catchup_seq = end_seq
+        self.sock.send_frame(MSG_SNAPSHOT_END, str(end_seq).encode(encoding=ENCODING))
+
+    # Sends queued operations in batches: everything queued within BATCH_DELAY seconds (up to BATCH_SIZE bytes) is sent together
+    def send_loop(self):
+        try:
+            if self.snapshot_seq is not None:
+                self.send_snapshot()
+        except OSError:
+            self.replicator.replica_failed(self)
+            return
+        while self.alive:
+            try:
+                batch = list(self.queue.get(timeout=heartbeat.HEARTBEAT_INTERVAL))
+            except Empty:
+                # Let the backup know the leader is alive while there is nothing to replicate
+                try:
+                    self.sock.send_frame(MSG_HEARTBEAT, b'')
+                except OSError:
+                    self.replicator.replica_failed(self)
+                    return
+                continue
+            if not self.alive:
+                return
+            start = monotonic()
+            size = sum(len(payload) for _, payload in batch)
+            try:
+                while size < BATCH_SIZE:
+                    entries = self.queue.get(timeout=max(0.0, start + BATCH_DELAY - monotonic()))
+                    batch.extend(entries)
+                    size += sum(len(payload) for _, payload in entries)
+            except Empty:
+                pass
+            if not batch:
+                continue
+            BATCH_DELAY_SECONDS.observe(monotonic() - start)
+            try:
+                # A large catch-up tail is sent in frames of about BATCH_SIZE bytes
+                chunk, chunk_size = [], 0
+                for _, payload in batch:
+                    chunk.append((MSG_OP, payload))
+                    chunk_size += len(payload)
+                    if chunk_size >= BATCH_SIZE:
+                        self.send_frames(chunk)
+                        chunk, chunk_size = [], 0
+                if chunk:
+                    self.send_frames(chunk)
+            except OSError:
+                self.replicator.replica_failed(self)
+                return
+            self.sent_seq = batch[-1][0]
+
+    # Recieves cumulative acknowledgements (highest applied sequence number) from the backup,
+    # and stops replicating to it once it has been silent for too long
+    def ack_loop(self):
+        detector = heartbeat.new_detector()
+        while self.alive:
+            try:
+                frame = self.sock.recv_frame(timeout=heartbeat.HEARTBEAT_INTERVAL)
+            except TimeoutError:
+                if detector.suspect():
+                    log.warning('LEADER: backup @ {} suspected after {:.3f}s of silence', self.addr, detector.silence())
+                    self.replicator.replica_failed(self)
+                    return
+                continue
+            except OSError:
+                frame = None
+            if frame is None:
+                self.replicator.replica_failed(self)
+                return
+            detector.heartbeat()
+            if frame[0] == MSG_ACK:
+                self.replicator.replica_acked(self, int(frame[1]))
+
+    # Number of operations and seconds this backup is behind the leader
+    def lag(self):
+        with self.replicator.lock:
+            oldest = self.send_times[0][1] if self.send_times else None
+            return {
+                'addr':      self.addr,
+                'alive':     self.alive,
+                'caught_up': self.in_quorum(),
+                'sent_seq':  self.sent_seq,
+                'acked_seq': self.acked_seq,
+                'lag_ops':   self.replicator.seq - self.acked_seq,
+                'lag_secs':  monotonic() - oldest if oldest is not None else 0.0,
+            }
+
+# Leader-side replication log: applies operations to users, assigns sequence numbers, fans out to backups and tracks the commit point
+class Replicator:
+    def __init__(self, users, quorum=ALL_REPLICAS, seq=0, epoch=0, storage=None):
+        self.users     = users
+        self.quorum    = quorum
+        self.seq       = seq # sequence number of last operation in the log
+        self.epoch     = epoch # server ID of the leader that owns this log
+        self.start_seq = seq # operations up to start_seq were inherited from previous leaders
+        self.committed = seq # highest sequence number acknowledged by the quorum
+        self.storage   = storage # write-ahead log of the leader (optional)
+        self.durable   = seq # highest sequence number in the leader's write-ahead log
+        self.log_tail  = deque(maxlen=LOG_TAIL_SIZE) # (seq, payload) of recent operations
+        self.replicas  = []
+        self.lock      = Lock()
+        self.condition = Condition(self.lock)
+        self.waiters   = [] # (seq, loop, future) of asyncio sessions waiting for commits
+        self.commands  = [] # Commands queued by sessions for the applier
+        self.applying  = False # a session is applying a batch of commands (or has been woken up to)
+        self.commands_lock = Lock() # guards commands and applying
+        self.directory = Directory(users) # sorted usernames for listing users
+        self.groups    = Groups(users) # members of every group
+        if storage is not None:
+            storage.on_sync = self.log_synced
+
+    # Whether a backup that last applied operation seq from the given epoch has a prefix of this log (call with lock held)
+    def consistent_position(self, epoch, seq):
+        if epoch == self.epoch:
+            return seq <= self.seq
+        return epoch < self.epoch and seq <= self.start_seq
+
+    # Starts replicating to a newly (re)connected backup, catching it up from its last applied position
+    def add_replica(self, sock, addr, epoch=NO_EPOCH, seq=0, compression=None, voting=True):
+        replica = ReplicaSender(sock, addr, self, compression, voting)
+        with self.lock:
+            first_in_tail = self.log_tail[0][0] if self.log_tail else self.seq + 1
+            # Send the missing tail of the log
+            if seq >= 0 and self.consistent_position(epoch, seq) and seq >= first_in_tail - 1:
+                replica.queue.put([(op_seq, payload) for op_seq, payload in self.log_tail if op_seq > seq])
+                replica.acked_seq   = seq
+                replica.catchup_seq = self.seq
+                log.info('LEADER: catching up backup @ {} from log tail ({} -> {})', addr, seq, self.seq)
+            # Send a snapshot (the sender thread streams it before the operations queued from now on)
+            else:
+                replica.snapshot_seq = self.seq
+            self.replicas.append(replica)
+        replica.start()
+        return replica
+
+    # Applies an operation, appends it to the log and queues it for every backup. Returns its sequence number.
+    def replicate(self, op):
+        return self.replicate_many([op])
+
+    # Applies several operations (atomically with respect to other commands). Returns the sequence number of the last one.
+    def replicate_many(self, ops):
+        return self.replicate_commands([ops])[0].result()
+
+    # Applies several commands in order, each atomically with respect to other commands (e.g., the commands of the sessions
+    # of a worker process, see workers.py). Returns the applied Commands.
+    # The commands are queued; if no other session is applying commands, this session becomes the applier and applies
+    # every queued command as one batch, otherwise it sleeps until the applier has applied its commands (or hands it
+    # the applier role for the commands queued in the meantime).
+    def replicate_commands(self, ops_list):
+        commands = [Command(ops) for ops in ops_list]
+        command = commands[-1] # woken up once all of them are applied (they are queued and taken together)
+        with self.commands_lock:
+            applier = not self.applying
+            if applier:
+                self.applying = True
+            else:
+                command.wakeup = Lock()
+                command.wakeup.acquire()
+                self.commands.extend(commands)
+        if applier:
+            batch = commands
+        else:
+            command.wakeup.acquire()
+            if command.done:
+                return commands
+            with self.commands_lock:
+                batch, self.commands = self.commands, []
+        try:
+            self.apply_batch(batch)
+        except Exception as error:
+            # The batch was not logged (e.g., the write-ahead log failed): none of its commands succeeded
+            for other in batch:
+                other.error = error
+            raise
+        finally:
+            for other in batch:
+                if other is not command:
+                    other.done = True
+                    if other.wakeup is not None:
+                        other.wakeup.release()
+            with self.commands_lock:
+                if self.commands:
+                    next(other for other in self.commands if other.wakeup is not None).wakeup.release() # next applier
+                else:
+                    self.applying = False
+        return commands
+
+    # Applies a batch of commands in order, and appends their operations to the log, the write-ahead log,
+    # and every backup's queue at once (called by the single applier)
+    def apply_batch(self, batch):
+        with self.lock:
+            start = perf_counter()
+            now = monotonic()
+            entries = []
+            for command in batch:
+                try:
+                    for op in command.ops:
+                        # Groups of a deleted user are needed to update the index once it is gone
+                        user = self.users.get(op[1]) if op[0] == OP_DELETE_USER else None
+                        apply_op(self.users, op, self.seq + 1)
+                        self.seq += 1
+                        index_op(self.directory, self.groups, self.users, op, user)
+                        entries.append((self.seq, encode_op(self.seq, op))) # encoded once, shared by all backups
+                except Exception as error:
+                    command.error = error # raised in the session that committed it (operations before it were applied)
+                command.seq = self.seq
+            self.log_tail.extend(entries)
+            if self.storage is not None:
+                self.storage.append_many(entries)
+            for replica in self.replicas:
+                if replica.alive:
+                    replica.send_times.extend((seq, now) for seq, _ in entries)
+                    replica.queue.put(entries)
+            self.update_committed()
+            STATE_UPDATE_SECONDS.observe(perf_counter() - start, 'leader')
+            STATE_UPDATE_BYTES.observe(sum(len(payload) for _, payload in entries), 'leader')
+
+    # Number of backups that have to acknowledge an operation before it is committed
+    def required_acks(self):
+        in_quorum = sum(1 for replica in self.replicas if replica.in_quorum())
+        if self.quorum == ALL_REPLICAS:
+            return in_quorum
+        return min(self.quorum, in_quorum)
+
+    # Recomputes the commit point and wakes up waiting clients (call with lock held)
+    def update_committed(self):
+        required = self.required_acks()
+        if required == 0:
+            committed = self.seq
+        else:
+            acked = sorted((replica.acked_seq for replica in self.replicas if replica.in_quorum()), reverse=True)
+            committed = acked[required-1]
+        if self.storage is not None:
+            committed = min(committed, self.durable)
+        if committed <= self.committed:
+            return
+        self.committed = committed
+        self.condition.notify_all()
+        remaining = []
+        for seq, loop, future in self.waiters:
+            if seq <= committed:
+                loop.call_soon_threadsafe(set_future_result, future)
+            else:
+                remaining.append((seq, loop, future))
+        self.waiters = remaining
+
+    # Called by the storage writer thread once operations up to seq are durable
+    def log_synced(self, seq):
+        with self.lock:
+            self.durable = seq
+            self.update_committed()
+
+    def replica_acked(self, replica, seq):
+        with self.lock:
+            caught_up = replica.in_quorum()
+            replica.acked_seq = max(replica.acked_seq, seq)
+            while replica.send_times and replica.send_times[0][0] <= seq:
+                replica.send_times.popleft()
+            if not caught_up and replica.in_quorum():
+                log.info('LEADER: backup @ {} caught up @ {}', replica.addr, seq)
+            self.update_committed()
+
+    # Stops replicating to a disconnected backup (it no longer counts towards the quorum)
+    def replica_failed(self, replica):
+        with self.lock:
+            if not replica.alive:
+                return
+            replica.alive = False
+            replica.send_times.clear()
+            replica.queue.put([]) # wake up sender thread so it can exit
+            self.update_committed()
+        replica.sock.close()
+        log.warning('LEADER: backup @ {} disconnected, stopped replicating to it', replica.addr)
+
+    # Blocks until the operation with sequence number seq has been acknowledged by the quorum
+    def wait(self, seq):
+        with self.lock:
+            self.condition.wait_for(lambda: self.committed >= seq)
+
+    # Waits (without blocking the event loop) until seq has been acknowledged by the quorum
+    async def wait_async(self, seq):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.committed >= seq:
+                return
+            future = loop.create_future()
+            self.waiters.append((seq, loop, future))
+        await future
+
+    # Per-backup replication lag
+    def lag(self):
+        return [replica.lag() for replica in list(self.replicas)]
+
+def set_future_result(future):
+    if not future.done():
+        future.set_result(None)
+
+# Backup-side state: applies the leader's stream (log operations and catch-up snapshots) to users
+class BackupState:
+    def __init__(self, users, storage=None, seq=0):
+        self.users          = users
+        self.storage        = storage # write-ahead log of this backup (optional)
+        self.applied_seq    = seq # sequence number of last operation applied
+        self.epoch          = storage.epoch if storage is not None else NO_EPOCH # server ID of the leader that sent the last applied operation
+        self.snapshot_seqs  = None # while catching up from a snapshot: username -> 'seq' of user in snapshot
+        self.snapshot_end   = None # while catching up from a snapshot: consistent once this seq is applied
+        self.directory      = Directory(users) # sorted usernames for read-only clients (see read_replica.py)
+        self.groups         = Groups(users) # members of every group (for the sessions of worker processes, see workers.py)
+        self.last_heard     = monotonic() # time the last frame from the leader was handled
+        self.start_stream()
+
+    # Starts decompressing a new replication stream (after connecting to a leader)
+    def start_stream(self):
+        self.decompressor = zlib.decompressobj()
+        self.batch_frames = FrameBuffer() # frames of the compressed batches that have not been applied yet
+
+    # Position reported to a leader when (re)joining it (a backup interrupted while catching up from a snapshot needs a new snapshot)
+    def position(self):
+        if self.catching_up():
+            return {'epoch': NO_EPOCH, 'seq': -1}
+        return {'epoch': self.epoch, 'seq': self.applied_seq}
+
+    # Whether the backup is catching up from a snapshot (its state is not consistent yet)
+    def catching_up(self):
+        return self.snapshot_seqs is not None
+
+    # Records that a frame from the leader (an operation or a heartbeat) has been handled
+    def heard(self):
+        self.last_heard = monotonic()
+
+    # How stale the state may be: every operation the leader had sent more than age seconds ago is applied,
+    # since the leader sends operations in order and only sends heartbeats once it has sent everything
+    def staleness(self):
+        return {'seq': self.applied_seq, 'epoch': self.epoch, 'age': round(monotonic() - self.last_heard, 3)}
+
+    # Applies one frame recieved from the leader
+    def handle_frame(self, msg_type, payload, leader):
+        if msg_type == MSG_HEARTBEAT:
+            return
+        if msg_type == MSG_BATCH:
+            self.handle_batch(payload, leader)
+            return
+        start = perf_counter()
+        if msg_type == MSG_SNAPSHOT_BEGIN:
+            self.epoch = leader
+            for user in self.users.values():
+                user.mailbox.drain(len(user.mailbox)) # releases its broadcast messages
+            self.users.clear()
+            self.directory = Directory()
+            self.groups    = Groups()
+            self.snapshot_seqs = {}
+            self.snapshot_end  = None
+            self.applied_seq   = int(payload)
+        elif msg_type == MSG_SNAPSHOT:
+            for username, seq, record in json.loads(payload.decode(encoding=ENCODING)):
+                self.users[username] = User.from_record(record)
+                self.snapshot_seqs[username] = seq
+                self.directory.add(username)
+                for group in self.users[username].groups or ():
+                    self.groups.join(group, username)
+        elif msg_type == MSG_SNAPSHOT_END:
+            self.snapshot_end = int(payload)
+            self.finish_catch_up()
+        elif msg_type == MSG_OP:
+            seq, op = decode_op(payload)
+            # Skip operations that are already reflected in the snapshot (or whose user was deleted before it was read)
+            if op[0] == OP_BROADCAST and self.catching_up():
+                apply_op(self.users, op, reflected=lambda username: seq <= self.snapshot_seqs.get(username, 0))
+            elif not self.catching_up() or (seq > self.snapshot_seqs.get(op[1], 0) and (op[0] in (OP_CREATE_USER, OP_ADOPT_USER) or op[1] in self.users)):
+                user = self.users.get(op[1]) if op[0] == OP_DELETE_USER else None
+                apply_op(self.users, op)
+                index_op(self.directory, self.groups, self.users, op, user)
+            self.applied_seq = seq
+            self.epoch = leader
+            if self.catching_up():
+                self.finish_catch_up()
+            elif self.storage is not None:
+                self.storage.append(seq, payload)
+        STATE_UPDATE_SECONDS.observe(perf_counter() - start, 'backup')
+        STATE_UPDATE_BYTES.observe(len(payload), 'backup')
+
+    # Applies every frame of a compressed batch
+    def handle_batch(self, payload, leader):
+        data = self.decompressor.decompress(payload)
+        BATCH_BYTES.observe(len(payload))
+        STREAM_BYTES.inc(len(payload), 'wire')
+        STREAM_BYTES.inc(len(data), 'raw')
+        BYTES_SAVED.inc(len(data) - len(payload))
+        self.batch_frames.feed(data)
+        frames = 0
+        for msg_type, frame_payload in self.batch_frames.frames():
+            self.handle_frame(msg_type, frame_payload, leader)
+            frames += 1
+        if frames:
+            BATCH_FRAMES.observe(frames) # (a batch holding only part of a large frame completes no frame)
+
+    # Once the snapshot and all operations up to snapshot_end have been applied, the state is consistent
+    def finish_catch_up(self):
+        if self.snapshot_end is None or self.applied_seq < self.snapshot_end:
+            return
+        self.snapshot_seqs = None
+        self.snapshot_end  = None
+        if self.storage is not None:
+            self.storage.reset(self.applied_seq, self.users)
+        log.info('BACKUP: caught up from snapshot @ {} ({} users)', self.applied_seq, len(self.users))
+
+    # Sequence number to acknowledge (None while catching up from a snapshot), once it is durable
+    def ack_seq(self):
+        if self.catching_up():
+            return None
+        if self.storage is not None:
+            self.storage.wait(self.applied_seq)
+            if self.storage.epoch != self.epoch:
+                self.storage.save_epoch(self.epoch)
+        return self.applied_seq
@@ -1,279 +1,202 @@
 '''
 This file implements server functionality of chat application.
 
-Usage: python3 server.py LEADER_IP MACHINE_NUM
+Usage: python3 server.py LEADER_IP MACHINE_NUM [--mode thread|async] [--ip SERVER_IP] [--port PORT] [--replicas REPLICAS] [--quorum 0|1|all] [--data-dir DATA_DIR]
+                         [--heartbeat-interval SECONDS] [--failure-timeout SECONDS] [--phi-threshold PHI]
+                         [--outbound-limit BYTES] [--outbound-policy mailbox|drop|block]
+                         [--shards NAME=IP:PORT,NAME=IP:PORT,... --shard NAME --shard-secret SECRET]
+                         [--batch-delay SECONDS] [--batch-size BYTES] [--compression zlib|none] [--compression-level 1-9]
+                         [--workers WORKERS]
 '''
 # Import relevant python packages
-from collections import defaultdict
-from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+from argparse import ArgumentParser
+from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SO_REUSEPORT, SOMAXCONN
 from threading import Thread
-import sys
+from time import monotonic
+import json
+import os
+
+from chat import ChatSession, CLOSED
+from protocol import FramedSocket, MSG_INIT, MSG_OP, MSG_ACK, MSG_JOIN, MSG_HEARTBEAT, MSG_BATCH
+from replication import Replicator, BackupState, ALL_REPLICAS, parse_quorum, offered_compressions, choose_compression, NO_COMPRESSION
+from storage import Storage
+from outbound import QueuedSocket
+from read_replica import ReadServer, READ_OFFSET
+import async_server
+import heartbeat
+import log
+import metrics
+import outbound
+import replication
+import sharding
+import workers
 
 # Constants/configurations
 ENCODING    = 'utf-8' # message encoding
-BUFFER_SIZE = 2048 # fixed 2KB buffer size
 PORT        = 1234 # base application port for leader server
 
-SERVER_IP      = '100.90.130.16' # REPLACE ME with output of ipconfig getifaddr en0
-MAX_CLIENTS    = 100
-LOGIN_ATTEMPTS = 3
+REPLICATION_OFFSET = 100 # server MACHINE_NUM accepts backups on port PORT+REPLICATION_OFFSET+MACHINE_NUM
+
+SERVER_IP   = '100.90.130.16' # REPLACE ME with output of ipconfig getifaddr en0
+MAX_CLIENTS = SOMAXCONN # length of queue of pending client connections
 
 # Fault-tolerance (parameters and global variables)
-STATE_SIZE   = 3 # state length (username, password, and mailbox length)
 TIMEOUT_TIME = 0.1 # time for waiting for potential backup to connect (in seconds)
 replicas     = 2 # 2-fault tolerant system
 leader       = 0 # server ID for leader
 server_addrs = [] # list of server IP addresses
 
-# Remove sock from active sockets
-def remove_connection(sock, addr, active_sockets):
-    assert sock in active_sockets, 'ERROR: remove_connection encountered corrupted active_sockets'
-    active_sockets.remove(sock)
-    sock.close()
-    print('Removed {}:{} from active sockets'.format(addr[0], addr[1]))
-
-# Handles user creation for new users
-def create_user(sock, addr, users, active_sockets):
-    # Solicit username
-    sock.send('\nPlease enter a username: '.encode(encoding=ENCODING))
-    username = sock.recv(BUFFER_SIZE)
-    if not username:
-        remove_connection(sock, addr, active_sockets)
-        return
-    username = username.decode(encoding=ENCODING).strip() # get the username in string without \n
-    
-    # New username
-    if username not in users:
-        # Solicit password
-        sock.send('Please enter a password.'.encode(encoding=ENCODING))
-        password = sock.recv(BUFFER_SIZE)
-        if not password:
-            remove_connection(sock, addr, active_sockets)
-            return
-        password = password.decode(encoding=ENCODING).strip()
-
-        # Update user information
-        users[username]['socket']   = sock
-        users[username]['password'] = password
-        users[username]['mailbox']  = []
-
-        # Confirm success of account creation
-        print('{}:{} successfully created account with username: {}'.format(addr[0], addr[1], username))
-        sock.send('\nSuccessfully created account with username: {}\n'.format(username).encode(encoding=ENCODING))
-        
-        return username
-    # Username has already been taken (re-enter)
-    else:
-        sock.send('{} is already taken. Please enter a unique username.\n'.format(username).encode(encoding=ENCODING))
-        return create_user(sock, addr, users, active_sockets)
-    
-# Handles login for existing user
-def login(sock, addr, users, active_sockets, backup_sockets, attempt_num):
-    # Solicit username
-    sock.send('\nPlease enter your username.'.encode(encoding=ENCODING))
-    username = sock.recv(BUFFER_SIZE)
-    if not username:
-        remove_connection(sock, addr, active_sockets)
-        return
-    username = username.decode(encoding=ENCODING).strip() # get the username in string without \n
-
-    # Username exists
-    if username in users:
-        # Solicit password
-        sock.send('Please enter your password.'.encode(encoding=ENCODING))
-        password = sock.recv(BUFFER_SIZE)
-        if not password:
-            remove_connection(sock, addr, active_sockets)
-            return
-        password = password.decode(encoding=ENCODING).strip()
-
-        # Entered correct password
-        if password == users[username]['password']:
-            # update user's active socket
-            users[username]['socket'] = sock
-
-            print('{} successfully logged via {}:{}'.format(username, addr[0], addr[1]))
-            sock.send('\nSuccessfully logged in\n'.encode(encoding=ENCODING))
-
-            # No mail to send
-            if len(users[username]['mailbox']) == 0:
-                sock.send('\nYou do not have any queued messages.'.encode(encoding=ENCODING))
-            # Send mail and clear mailbox
-            else:
-                sock.send('\nWelcome back, {}. Unread messages:\n'.format(username).encode(encoding=ENCODING))
-                for message in users[username]['mailbox']:
-                    users[username]['socket'].send(message.encode(encoding=ENCODING))
-                users[username]['mailbox'] = []
-        
-            return username
-        # Entered incorrect password
-        else:
-            sock.send('\nIncorrect password.\n'.encode(encoding=ENCODING))
-            if attempt_num < LOGIN_ATTEMPTS:
-                sock.send('Failed to login. You have {} remaining attempts.\n'.format(LOGIN_ATTEMPTS-attempt_num).encode(encoding=ENCODING))
-                return login(sock, addr, users, active_sockets, backup_sockets, attempt_num+1)
-            else:
-                sock.send('Failed to login. Returning to the welcome page.\n'.encode(encoding=ENCODING))
-                return welcome(sock, addr, users, active_sockets, backup_sockets)
-    
-    # Username does not exist
-    else:
-        sock.send('\n{} is not a valid username.\n'.format(username.strip()).encode(encoding=ENCODING))
-        if attempt_num < LOGIN_ATTEMPTS:
-            sock.send('Failed to login. You have {} remaining attempt(s).\n'.format(LOGIN_ATTEMPTS-attempt_num).encode(encoding=ENCODING))
-            return login(sock, addr, users, active_sockets, backup_sockets, attempt_num+1)
-        else:
-            sock.send('Failed to login. Returning to the welcome page.\n'.encode(encoding=ENCODING))
-            return welcome(sock, addr, users, active_sockets, backup_sockets)
-
-# Handles 1) user creation and 2) login for users
-def welcome(sock, addr, users, active_sockets, backup_sockets):
-    message = '\nPlease enter 1 or 2 :\n1. Create account.\n2. Login'
-    sock.send(message.encode(encoding=ENCODING))
-
-    choice = sock.recv(BUFFER_SIZE)
-    if not choice:
-        remove_connection(sock, addr, active_sockets)
-        return
-    choice = int(choice.decode(encoding=ENCODING))
-
-    if choice == 1:
-        username = create_user(sock, addr, users, active_sockets)
-    elif choice == 2:
-        username = login(sock, addr, users, active_sockets, backup_sockets, attempt_num=1)
-    else:
-        sock.send('{} is not a valid option. Please enter either 1 or 2!'.format(choice).encode(encoding=ENCODING))
-        welcome(sock, addr, users, active_sockets, backup_sockets)
-
-    update_state(backup_sockets, users)
-    return username
-
 # Thread for server socket to interact with each client user in chat application
-def client_thread(sock, addr, users, active_sockets, backup_sockets):
-     # Handle 1) user creation and 2) login
-    print('*** started client thread!')
+def client_thread(sock, addr, users, active_sockets, replicator):
+    log.debug('*** started client thread!')
 
     # For initialization, send to client all backup IPs
     message = ''
     for server_address in server_addrs[1:]:
         message += server_address
         message += ','
-    message += '@'
-    sock.send(message.encode(encoding=ENCODING))
-    
-    src_username = welcome(sock, addr, users, active_sockets, backup_sockets)
-
-    # Let user know all other users available for messaging
-    sock.send('\nWelcome to chatroom!\nAll users:\n'.encode(encoding=ENCODING))
-    for index, username in enumerate(users):
-        sock.send('{}. {}\n'.format(index, username).encode(encoding=ENCODING))
-
-    while True:
-        try:
-            sock.send('\nPlease enter 1, 2, or 3:\n1. Send message.\n2. List all users.\n3. Delete your account.'.encode(encoding=ENCODING))
-            choice = sock.recv(BUFFER_SIZE)
-            if not choice:
-                remove_connection(sock, addr, active_sockets)
-                print('{} logged off.'.format(src_username))
-                return
-            choice = int(choice.decode(encoding=ENCODING))
-
-            # Send message to another user
-            if choice == 1:
-                # Solicit target user
-                sock.send('\nEnter username of message recipient:'.encode(encoding=ENCODING))
-                dst_username = sock.recv(BUFFER_SIZE)
-                if not dst_username:
-                    remove_connection(sock, addr, active_sockets)
-                    print('{} logged off.'.format(src_username))
-                    return
-                dst_username = dst_username.decode(encoding=ENCODING).strip()
-                
-                # Client specified target user that does not exist - return to general chat application loop
-                if dst_username not in users:
-                    sock.send('Target user {} does not exist!\n'.format(dst_username).encode(encoding=ENCODING))
-                    continue
-                
-                # Solicit message
-                sock.send('Enter your message: '.encode(encoding=ENCODING))
-                message = sock.recv(BUFFER_SIZE)
-                if not message:
-                    remove_connection(sock, addr, active_sockets)
-                    print('{} logged off.'.format(src_username))
-                    return
-                message = '<{}> {}'.format(src_username, message.decode(encoding=ENCODING))
-
-                # Target user is online so deliver message immediately
-                if users[dst_username]['socket'] in active_sockets:
-                    users[dst_username]['socket'].send(message.encode(encoding=ENCODING))
-                    sock.send('\nMessage delivered to active user.\n'.encode(encoding=ENCODING))
-                    print('(DELIVERED TO USER) <to {}> {}'.format(dst_username, message))
-
-                # Target user is currently offline so deliver message to mailbox
-                else:
-                    users[dst_username]['mailbox'].append(message)
-                    sock.send('\nMessage delivered to mailbox.\n'.encode(encoding=ENCODING))
-                    print('(DELIVERED TO MAILBOX) <to {}> {}'.format(dst_username, message))
-
-            elif choice == 2:
-                sock.send('\nAll users:\n'.encode(encoding=ENCODING))
-                for index, username in enumerate(users):
-                    sock.send('{}. {}\n'.format(index, username).encode(encoding=ENCODING))
-
-            elif choice == 3:
-                sock.send('\nType confirm to delete your current account'.encode(encoding=ENCODING))
-                confirm = sock.recv(BUFFER_SIZE)
-                if not confirm:
-                    remove_connection(sock, addr, active_sockets)
-                    print('{} logged off.'.format(src_username))
-                    return
-                confirm = confirm.decode(encoding=ENCODING).strip()
-                if confirm == 'confirm':
-                    del users[src_username]
-                    remove_connection(sock, addr, active_sockets)
-                    print('{} deleted account.'.format(src_username))
-                    return
-
-            else:
-                sock.send('\n{} is not a valid option. Please enter either 1, 2, or 3.'.format(choice).encode(encoding=ENCODING))
-            update_state(backup_sockets, users)
-        # If we're unable to send a message, close connection.  
-        except:
-            remove_connection(sock, addr, active_sockets)
-            print('{} logged off.'.format(src_username))
-            return
-
-# Updates backup server states based
-def update_state(backup_sockets, users):
-    print("LEADER: Updating states in backup replica servers")
-    for username in users:
-        for sock in backup_sockets:
-            message = '{}.{}.{}.'.format(username, users[username]['password'], len(users[username]['mailbox']))
-            if len(users[username]['mailbox']) != 0:
-                for mail in users[username]['mailbox']:
-                    message += '{}.'.format(mail)
-            sock.send(message.encode(encoding=ENCODING))
-
-# Creates a client socket for backup server to connect to leader server
-def connect_with_leader(my_machine_num):
-    leader_port = PORT + leader
+    sock.send_frame(MSG_INIT, message.encode(encoding=ENCODING))
+
+    # Handle 1) user creation and 2) login, then the chatroom menu
+    session = ChatSession(sock, addr, users, active_sockets, replicator)
+    try:
+        session.start()
+        session.flush()
+        while session.state != CLOSED:
+            frame = sock.recv_frame()
+            if frame is None:
+                break
+            session.handle_frames(frame, sock.next_frame)
+            # Wait for another shard to answer a forwarded message
+            if session.forward is not None:
+                session.forwarded(sharding.wait(session.forward))
+            # Reply once the replication quorum has acknowledged the state changes
+            replicator.wait(session.commit_seq)
+            # Apply backpressure if the client (or, with the block policy, a recipient) is not reading
+            for connection in session.flush():
+                connection.wait_for_room()
+    # If we're unable to send a message, close connection.
+    except Exception as e:
+        log.debug('LEADER: closing {}:{} ({})', addr[0], addr[1], e)
+    session.disconnect()
+
+# Address clients of the current leader connect to
+def leader_address():
+    return (server_addrs[leader], PORT + leader)
+
+# Creates a client socket for backup server to connect to leader server, and reports the last applied operation
+def connect_with_leader(my_machine_num, position):
+    leader_port = PORT + REPLICATION_OFFSET + leader
     client = socket(family=AF_INET, type=SOCK_STREAM) # creates client socket with IPv4 and TCP
+    client.settimeout(heartbeat.FAILURE_TIMEOUT) # do not wait for TCP to give up on an unreachable leader
     client.connect((server_addrs[leader], leader_port)) # connect to server socket
-    print('BACKUP: ({}-{}) LEADER-BACKUP socket established @ {}:{}.'.format(leader, my_machine_num, server_addrs[leader], leader_port))
+    client.settimeout(None)
+    log.info('BACKUP: ({}-{}) LEADER-BACKUP socket established @ {}:{}.', leader, my_machine_num, server_addrs[leader], leader_port)
+    client = FramedSocket(client)
+    join = {'machine_num': my_machine_num, 'epoch': position['epoch'], 'seq': position['seq'], 'compression': offered_compressions()}
+    client.send_frame(MSG_JOIN, json.dumps(join).encode(encoding=ENCODING))
     return client
 
+# Reads the position a joining backup reports (None if it disconnected, or did not report it within FAILURE_TIMEOUT,
+# e.g., because it failed right after connecting: a new leader must not wait for it)
+def recv_join(sock):
+    try:
+        frame = sock.recv_frame(timeout=heartbeat.FAILURE_TIMEOUT)
+    except (OSError, TimeoutError):
+        return None
+    if frame is None or frame[0] != MSG_JOIN:
+        return None
+    return json.loads(frame[1].decode(encoding=ENCODING))
+
+# Sends the list of backup IP addresses to a backup and starts catching it up
+def start_backup(sock, addr, join, replicator):
+    message = ''
+    for server_address in server_addrs[1:]:
+        message += server_address
+        message += ','
+    sock.send_frame(MSG_INIT, message.encode(encoding=ENCODING))
+    log.info('LEADER: Finished sending backup IP addresses to backup @ {}', addr)
+    # Backups that do not offer a compression we accept (e.g., started with --compression none) get uncompressed operations
+    compression = choose_compression(join.get('compression', []))
+    log.info('LEADER: replicating to backup @ {} with compression {}', addr, compression or NO_COMPRESSION)
+    replicator.add_replica(sock, addr, join['epoch'], join['seq'], compression)
+
+# Thread for leader to accept backups that join (or rejoin after a restart) once clients are being served
+def accept_backups(replication_server, replicator):
+    replication_server.settimeout(None)
+    while True:
+        sock, backup_addr = replication_server.accept()
+        sock = FramedSocket(sock)
+        join = recv_join(sock)
+        if join is None:
+            sock.close()
+            continue
+        log.info('LEADER: backup {} joined @ {} (epoch {}, seq {})', join['machine_num'], backup_addr[0], join['epoch'], join['seq'])
+        if backup_addr[0] not in server_addrs[1:]:
+            server_addrs.append(backup_addr[0])
+        start_backup(sock, backup_addr[0], join, replicator)
+
+# Registers the gauges of this server's state, computed whenever the metrics are read (current_replicator() is None on backups)
+def register_gauges(users, active_sockets, backup, current_replicator):
+    def replica_lags(key):
+        replicator = current_replicator()
+        if replicator is None:
+            return None
+        return {index: lag[key] for index, lag in enumerate(replicator.lag())}
+
+    def applied_seq():
+        replicator = current_replicator()
+        return replicator.seq if replicator is not None else backup.applied_seq
+
+    metrics.Gauge('active_connections', 'Open client connections', lambda: len(active_sockets))
+    metrics.Gauge('users', 'User accounts', lambda: len(users))
+    metrics.Distribution('mailbox_depth', 'Messages queued in the mailbox of each user', lambda: [len(user.mailbox) for user in list(users.values())])
+    metrics.Gauge('applied_seq', 'Sequence number of the last operation applied', applied_seq)
+    metrics.Gauge('replica_lag_ops', 'Operations each backup (in the order they joined) has not acknowledged', lambda: replica_lags('lag_ops'), label_name='replica')
+    metrics.Gauge('replica_lag_seconds', 'Seconds since the oldest operation each backup has not acknowledged was sent', lambda: replica_lags('lag_secs'), label_name='replica')
+    metrics.Gauge('backup_staleness_seconds', 'Seconds since the last frame from the leader was applied (backups only)',
+                  lambda: backup.staleness()['age'] if current_replicator() is None else None)
+
 def main():
     # Global variables that have to be updated throughout
     global leader
     global replicas
     global server_addrs
-
-    if len(sys.argv) != 3:
-        print('Usage: python3 server.py LEADER_IP MACHINE_NUM')
-        sys.exit('server.py exiting')
-    
-    leader_ip   = str(sys.argv[1])
-    machine_num = int(sys.argv[2])
+    global SERVER_IP
+    global PORT
+
+    parser = ArgumentParser(description='Chat application server (leader or backup replica).')
+    parser.add_argument('leader_ip', metavar='LEADER_IP')
+    parser.add_argument('machine_num', metavar='MACHINE_NUM', type=int)
+    parser.add_argument('--mode', choices=['thread', 'async'], default='thread',
+                        help='leader client handling: one thread per client (default) or a single asyncio event loop')
+    parser.add_argument('--ip', default=SERVER_IP, help='local IP address to bind (default: SERVER_IP)')
+    parser.add_argument('--port', type=int, default=PORT, help='base application port (default: PORT)')
+    parser.add_argument('--replicas', type=int, default=replicas, help='number of backup servers (default: 2)')
+    parser.add_argument('--quorum', type=parse_quorum, default=ALL_REPLICAS,
+                        help='number of backups (0, 1, ..., or all) that must acknowledge a state change before the client is answered (default: all)')
+    parser.add_argument('--data-dir', help='persist users and mailboxes in DATA_DIR/server_MACHINE_NUM (default: in memory only)')
+    heartbeat.add_arguments(parser)
+    outbound.add_arguments(parser)
+    sharding.add_arguments(parser)
+    replication.add_arguments(parser)
+    workers.add_arguments(parser)
+    metrics.add_arguments(parser)
+    log.add_arguments(parser)
+    args = parser.parse_args()
+    heartbeat.configure(args.heartbeat_interval, args.failure_timeout, args.phi_threshold)
+    outbound.configure(args.outbound_limit, args.outbound_policy)
+    sharding.configure(args.shards, args.shard, args.shard_secret)
+    replication.configure(args.batch_delay, args.batch_size, args.compression, args.compression_level)
+    workers.configure(args.workers)
+    metrics.configure(args.metrics_port)
+    log.configure(args.log_level, args.log_sample, args.log_file)
+
+    leader_ip   = args.leader_ip
+    machine_num = args.machine_num
+    SERVER_IP   = args.ip
+    PORT        = args.port
+    replicas    = args.replicas
     assert machine_num <= replicas, 'Model machine number greater than expected total number of model machines'
     
     server_addrs = [leader_ip] # initialize list of server IPs with leader IP address
@@ -281,75 +204,138 @@ def main():
     # Creates server socket with IPv4 and TCP
     server = socket(AF_INET, SOCK_STREAM)
     server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1) # allow for multiple clients
+    # With worker processes, the workers also listen on the client port (see workers.py)
+    if workers.WORKERS > 1:
+        server.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
 
     # Remember to run 'ipconfig getifaddr en0' and update SERVER_IP
     server.bind((SERVER_IP, PORT+machine_num))
-    server.listen(MAX_CLIENTS) # accept up to MAX_CLIENTS active connections
+    # Backups listen too: clients that connect during a failover wait in the backlog until this server takes over
+    server.listen(MAX_CLIENTS)
 
-    # If you are a replica, connect to the leader server
-    if machine_num != leader:
-        backup_client_socket = connect_with_leader(machine_num)
-    
-    active_sockets = [] # running list of active client sockets
+    # Separate server socket for backups to join this server once it is the leader
+    replication_server = socket(AF_INET, SOCK_STREAM)
+    replication_server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    replication_server.bind((SERVER_IP, PORT+REPLICATION_OFFSET+machine_num))
+    replication_server.listen(MAX_CLIENTS)
+
+    active_sockets = set() # running set of active client sockets
     '''
     'users' is a hashmap to store all client data
         - key: username
-        - values: 'password', 'socket', 'mailbox'
+        - value: User record with password, socket, and mailbox (see store.py)
     '''
-    users = defaultdict(dict)
-    backup_init = True
+    users = {}
+    applied_seq = 0 # sequence number of last replication log operation applied by this server
+
+    # Recover users from the write-ahead log and snapshot on disk
+    storage = None
+    if args.data_dir is not None:
+        storage = Storage(os.path.join(args.data_dir, 'server_{}'.format(machine_num)))
+        applied_seq = storage.recover(users)
+    backup = BackupState(users, storage, seq=applied_seq)
+    replicator = None # replication log, once this server is the leader
+
+    # Serve the metrics (see metrics.py)
+    if metrics.METRICS_PORT is not None:
+        register_gauges(users, active_sockets, backup, lambda: replicator)
+        metrics.serve(SERVER_IP, metrics.METRICS_PORT+machine_num)
+        log.info('Serving metrics @ http://{}:{}/metrics', SERVER_IP, metrics.METRICS_PORT+machine_num)
+
+    # If you are a replica, connect to the leader server, and serve read-only clients from the replicated state
+    read_server = None
+    if machine_num != leader:
+        backup_client_socket = connect_with_leader(machine_num, backup.position())
+        backup.start_stream()
+        read_server = ReadServer(SERVER_IP, PORT+READ_OFFSET+machine_num, backup, leader_address)
+        read_server.start()
+    detector   = heartbeat.new_detector() # failure detector for the leader server
+    last_heard = None # time the failed leader was last heard from (to measure failover time)
 
     info_count = 0
 
     while True:
         # Leader Execution
         if machine_num == leader:
+            # Read-only clients have to connect to the new leader's client port instead
+            if read_server is not None:
+                read_server.stop()
+                read_server = None
             # If you are an initializing leader, create a clean slate of backup server sockets and IP addresses
-            backup_sockets = []
-            server_addrs   = [SERVER_IP] # first IP is your own (leader's local IP)
+            backups      = []
+            server_addrs = [SERVER_IP] # first IP is your own (leader's local IP)
+            # Continue the log where the old leader left off
+            replicator   = Replicator(users, args.quorum, seq=backup.applied_seq, epoch=leader, storage=storage)
             
             # If you are a new leader, set timeout for waiting for each potential backup server.
             if leader != 0:
-                server.settimeout(TIMEOUT_TIME)
+                replication_server.settimeout(TIMEOUT_TIME)
 
             # Attempt to connect to replicas number of backup servers
             for backup_num in range(replicas):
                 try:
-                    sock, backup_addr = server.accept()
-                    backup_sockets.append(sock)
+                    sock, backup_addr = replication_server.accept()
+                    sock = FramedSocket(sock)
+                    join = recv_join(sock)
+                    assert join is not None, 'backup disconnected before joining'
+                    backups.append((sock, backup_addr[0], join))
                     server_addrs.append(backup_addr[0])
-                    print('LEADER: {}/{} LEADER-backup socket established @ {}'.format(backup_num+1, replicas, backup_addr[0]))
+                    log.info('LEADER: {}/{} LEADER-backup socket established @ {} (epoch {}, seq {})', backup_num+1, replicas, backup_addr[0], join['epoch'], join['seq'])
                 except:
                     replicas -= 1 # could not connect to this backup due to timeout
                     pass
-            print('LEADER: server_addrs: {}'.format(server_addrs))
-
-            # Send to each backup complete list of backup IP_addresses
-            if replicas > 0:
-                message = ''
-                for addr in server_addrs[1:]:
-                    message += addr
-                    message += ','
-                for backup_socket in backup_sockets:
-                    backup_socket.send(message.encode(encoding=ENCODING))
-                    print('LEADER: Finished sending backup IP addresses to backup @ {}'.format(backup_socket))
+            log.info('LEADER: server_addrs: {}', list(server_addrs))
+
+            # Send to each backup complete list of backup IP_addresses, then catch it up (log tail or snapshot)
+            for sock, addr, join in backups:
+                start_backup(sock, addr, join, replicator)
+            Thread(target=accept_backups, args=(replication_server, replicator), daemon=True).start()
+            # Hand users whose home shard changed (e.g., a shard was added) over to their new shard
+            if sharding.SHARDS is not None:
+                Thread(target=sharding.hand_off_users, args=(users, replicator), daemon=True).start()
+            if last_heard is not None:
+                log.info('LEADER: took over as leader {:.3f}s after the old leader was last heard from', monotonic() - last_heard)
             
-            # Main leader server loop
+            # Main leader server loop (worker processes, each an asyncio event loop): this process only applies their state changes
+            if workers.WORKERS > 1:
+                workers.serve(replicator, server, server_addrs)
+                log.error('LEADER: every worker process exited')
+                log.flush()
+                raise SystemExit(1)
+
+            # Main leader server loop (asyncio mode)
+            if args.mode == 'async':
+                async_server.serve(server, users, active_sockets, replicator, server_addrs)
+
+            # Main leader server loop (thread-per-client mode)
             while True:
                 server.settimeout(None)
                 sock, client_addr = server.accept()
-                active_sockets.append(sock) # update active sockets list
-                print ('LEADER: {}:{} connected'.format(client_addr[0], client_addr[1]))
+                sock = QueuedSocket(sock)
+                active_sockets.add(sock) # update active sockets set
+                log.debug('LEADER: {}:{} connected', client_addr[0], client_addr[1])
                 # Start new thread for each client user
-                Thread(target=client_thread, args=(sock, client_addr, users, active_sockets, backup_sockets)).start()
+                Thread(target=client_thread, args=(sock, client_addr, users, active_sockets, replicator)).start()
         
         # Backup Execution
         else:
-            message = backup_client_socket.recv(BUFFER_SIZE)
+            try:
+                frame = backup_client_socket.recv_frame(timeout=heartbeat.HEARTBEAT_INTERVAL)
+            except TimeoutError:
+                if not detector.suspect():
+                    continue
+                # Leader is hung or partitioned away: give up on it without waiting for TCP
+                log.warning('BACKUP: Leader server @ {}:{} suspected after {:.3f}s of silence', server_addrs[leader], PORT+leader, detector.silence())
+                backup_client_socket.close()
+                frame = None
+            except OSError:
+                frame = None
 
             # Leader server socket has disconnected
-            if not message:
-                print('BACKUP: Leader server @ {}:{} disconnected!'.format(server_addrs[leader], PORT+leader))
+            if frame is None:
+                log.warning('BACKUP: Leader server @ {}:{} disconnected!', server_addrs[leader], PORT+leader)
+                if last_heard is None:
+                    last_heard = detector.last
 
                 # Attempt to connect to new leader (if you are new leader, you will exit this block)
                 backup_success = False
@@ -359,8 +345,9 @@ def main():
                     try:
                         # If I am a replica, try to connect to new leader
                         if machine_num != leader:
-                            backup_client_socket = connect_with_leader(machine_num)
-                            backup_init = True # ensure backup initialization phase
+                            backup_client_socket = connect_with_leader(machine_num, backup.position())
+                            backup.start_stream()
+                            detector = heartbeat.new_detector()
                             backup_success = True
                         # If I am new leader, exit this loop and start leader initialization
                         else:
@@ -370,27 +357,32 @@ def main():
 
             # Recieved message from leader server socket
             else:
-                # Backup initialization phase: recieve all backup IPs
-                if backup_init:
-                    server_addrs = [server_addrs[leader]]
-                    addr_list = message.decode(encoding=ENCODING).split(',')[:-1]
-                    for addr in addr_list:
-                        server_addrs.append(addr)
-                    print('BACKUP: All server IP addresses: {}'.format(server_addrs))
-                    backup_init = False
-                # Normal backup loop: recieve updates from leader server
+                detector.heartbeat()
+                if last_heard is not None:
+                    log.info('BACKUP: following new leader {:.3f}s after the old leader was last heard from', monotonic() - last_heard)
+                    last_heard = None
+                msg_type, message = frame
+                # Backup initialization phase: recieve all backup IPs (indexed by machine number, so only from the first leader)
+                if msg_type == MSG_INIT:
+                    if len(server_addrs) == 1:
+                        addr_list = message.decode(encoding=ENCODING).split(',')[:-1]
+                        for addr in addr_list:
+                            server_addrs.append(addr)
+                    log.info('BACKUP: All server IP addresses: {}', list(server_addrs))
+                # Normal backup loop: recieve updates (and catch-up snapshots) from leader server
                 else:
-                    leader_msg = message.decode(encoding=ENCODING).split('.')
-
-                    username                    = leader_msg[0]
-                    users[username]['password'] = leader_msg[1]
-                    mailbox_len                 = int(leader_msg[2])
-
-                    users[username]['mailbox'] = []
-                    if mailbox_len != 0:
-                        for mail_idx in range(mailbox_len):
-                            users[username]['mailbox'].append(leader_msg[STATE_SIZE + mail_idx])
-                    print('<msg from LEADER>: {}'.format(users))
+                    backup.handle_frame(msg_type, message, leader)
+                    backup.heard()
+                    if msg_type in (MSG_OP, MSG_BATCH):
+                        log.sample(log.DEBUG, 'BACKUP: applied operation {} from LEADER', backup.applied_seq)
+                    # Acknowledge once all operations recieved so far have been applied and persisted (cumulative ack)
+                    if not backup_client_socket.has_frame():
+                        ack_seq = backup.ack_seq()
+                        if ack_seq is not None:
+                            backup_client_socket.send_frame(MSG_ACK, str(ack_seq).encode(encoding=ENCODING))
+                        # Still catching up from a snapshot: let the leader know we are alive
+                        else:
+                            backup_client_socket.send_frame(MSG_HEARTBEAT, b'')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
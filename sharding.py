@@ -0,0 +1,298 @@
+'''
+This file implements sharded deployments: several independent replica groups (shards), each with its
+own leader and backups, serve the chat application together, so total throughput grows with the
+number of shards instead of being capped by a single leader.
+
+Every user has a home shard, chosen by consistent hashing of the username: each shard owns VNODES
+points on a hash ring, and a username belongs to the shard owning the first point after its hash.
+Adding a shard only moves the usernames that now hash next to one of its points (about 1/N of them
+with N shards); every other user keeps its home shard.
+
+A shard is addressed by the IP address and base port of its first leader (its servers listen on
+PORT+MACHINE_NUM as usual), and every server of every shard is started with the same shard map:
+    - a client that logs in to (or creates an account on) another shard is redirected (MSG_REDIRECT)
+      to the home shard of the username
+    - a message for a user of another shard is forwarded (MSG_FORWARD) to that shard's leader, which
+      delivers it or queues it in the recipient's mailbox, and answers once the change is committed
+    - a message for a group (or all users) is forwarded to every other shard, for the members it has
+    - once a new leader has started, it hands the users whose home shard changed (e.g., after a shard
+      was added) over to their new shard
+
+Leaders of other shards connect to the client port like clients do, so a connection only gets to forward
+requests once its first one (FORWARD_HELLO) has proven that it comes from a server of the deployment, with
+the secret every server is started with (--shard-secret). Any other forwarded request is rejected.
+
+Forwarded requests are retransmitted if the other shard's leader fails before answering, so a message
+may be delivered twice if that leader failed after committing it.
+'''
+# Import relevant python packages
+from bisect import bisect_right
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from hashlib import md5
+from hmac import compare_digest
+from threading import Lock, Thread
+import asyncio
+import json
+
+from leader_probe import probe_leaders, PROBE_TIMEOUT
+from protocol import MSG_INIT, MSG_HEARTBEAT, MSG_FORWARD
+from replication import OP_DELETE_USER
+import heartbeat
+import log
+
+# Constants/configurations
+ENCODING        = 'utf-8' # message encoding
+VNODES          = 128 # points per shard on the hash ring (more points spread users more evenly)
+FORWARD_TIMEOUT = 10.0 # seconds to wait for another shard to answer a forwarded request
+SHARDS          = None # ShardMap of the deployment (None if there is a single replica group)
+LOCAL_SHARD     = None # name of this server's shard
+SECRET          = None # secret shared by every server of the deployment, which authenticates the leaders of other shards
+
+# Forwarded request types (server -> leader of another shard)
+FORWARD_HELLO = 'hello' # {type, shard, secret}: first request of every connection, authenticates the leader of another shard
+FORWARD_MAIL  = 'mail'  # {type, username, body, sender}: deliver a message to a user of that shard
+FORWARD_ADOPT = 'adopt' # {type, username, record}: take over a user whose home shard it is
+FORWARD_BROADCAST = 'broadcast' # {type, group, body, sender}: send a message to the members of a group (None: all users) of that shard
+
+# Forwarded request statuses (answers)
+DELIVERED = 'delivered' # message delivered to the online recipient (broadcasts: also {delivered, queued} numbers of recipients)
+MAILBOX   = 'mailbox' # message queued in the recipient's mailbox
+UNKNOWN   = 'unknown' # no such user
+ADOPTED   = 'adopted' # user taken over
+EXISTS    = 'exists' # user already taken over (e.g., by an earlier hand-off that did not finish)
+ACCEPTED  = 'accepted' # connection authenticated (answer to FORWARD_HELLO)
+REJECTED  = 'rejected' # not from a server of the deployment (wrong secret, no FORWARD_HELLO, or not sharded)
+
+# Parses the --shards command line option (NAME=IP:PORT,NAME=IP:PORT,...)
+def parse_shards(text):
+    shards = []
+    for entry in text.split(','):
+        name, _, address = entry.partition('=')
+        ip, _, port = address.rpartition(':')
+        if not name or not ip:
+            raise ValueError('shards must be given as NAME=IP:PORT,NAME=IP:PORT,...')
+        shards.append((name, ip, int(port)))
+    return shards
+
+# Overrides the module configuration (from command line options)
+def configure(shards=None, shard=None, secret=None):
+    global SHARDS
+    global LOCAL_SHARD
+    global SECRET
+    SHARDS = ShardMap(shards) if shards else None
+    LOCAL_SHARD = shard
+    SECRET = secret
+    if SHARDS is not None and shard not in SHARDS.addresses:
+        raise ValueError('--shard must be one of the shards in --shards')
+    if SHARDS is not None and not secret:
+        raise ValueError('--shards requires --shard-secret')
+
+# Adds the sharding command line options to an ArgumentParser
+def add_arguments(parser):
+    parser.add_argument('--shards', type=parse_shards,
+                        help='every shard of a sharded deployment as NAME=IP:PORT,NAME=IP:PORT,... (IP and base port of its first leader)')
+    parser.add_argument('--shard', help='name of the shard this server belongs to (with --shards)')
+    parser.add_argument('--shard-secret', help='secret shared by every server of every shard (with --shards), which authenticates forwarded requests')
+
+# Position of a key on the hash ring
+def ring_hash(key):
+    return int.from_bytes(md5(key.encode(encoding=ENCODING)).digest()[:8], 'big')
+
+# Consistent-hash placement of usernames on shards
+class ShardMap:
+    def __init__(self, shards, vnodes=VNODES):
+        self.addresses = {name: (ip, port) for name, ip, port in shards} # name -> (IP address, base port)
+        points = sorted((ring_hash('{}#{}'.format(name, point)), name) for name in self.addresses for point in range(vnodes))
+        self.hashes = [position for position, _ in points] # sorted positions of the points on the ring
+        self.names  = [name for _, name in points] # shard owning each point
+
+    # Name of the home shard of a username
+    def home(self, username):
+        index = bisect_right(self.hashes, ring_hash(username))
+        return self.names[index % len(self.names)]
+
+# Whether a FORWARD_HELLO request comes from a server of this deployment
+def authenticate(request):
+    if SHARDS is None or request.get('type') != FORWARD_HELLO or request.get('shard') not in SHARDS.addresses:
+        return False
+    return compare_digest(str(request.get('secret', '')).encode(encoding=ENCODING), SECRET.encode(encoding=ENCODING))
+
+# Name of the home shard of a username if it is not this server's shard (None if it is, or if the deployment is not sharded)
+def remote_home(username):
+    if SHARDS is None:
+        return None
+    shard = SHARDS.home(username)
+    return shard if shard != LOCAL_SHARD else None
+
+# Connection to the leader of another shard, shared by all sessions. Requests are pipelined, and a reader thread
+# resolves their futures as the answers come back. Every connection starts with a FORWARD_HELLO request (ID 0), and
+# if the leader rejects it, every pending request fails like it would if the shard were unavailable. If the leader fails, the reader finds the shard's new leader
+# (like a client, see probe_leaders()) and retransmits every request that was not answered.
+class Forwarder:
+    def __init__(self, shard, address):
+        self.shard   = shard
+        self.servers = [address[0]] # IP addresses of the shard's servers (indexed by machine number, from MSG_INIT)
+        self.port    = address[1] # base port of the shard
+        self.sock    = None # FramedSocket to the shard's leader (None while there is no reader thread)
+        self.pending = {} # request ID -> (payload, Future) of requests that were not answered yet
+        self.next_id = 0
+        self.lock    = Lock()
+
+    # Sends a request to the shard's leader. Returns a Future of the (decoded) answer.
+    def request(self, request):
+        future = Future()
+        with self.lock:
+            self.next_id += 1
+            payload = json.dumps(dict(request, id=self.next_id)).encode(encoding=ENCODING)
+            self.pending[self.next_id] = (payload, future)
+            if self.sock is None:
+                self.sock = False # reader thread starting (it connects and sends every pending request)
+                Thread(target=self.read_loop, daemon=True).start()
+            elif self.sock:
+                try:
+                    self.sock.send_frame(MSG_FORWARD, payload)
+                except OSError:
+                    pass # retransmitted once the reader has reconnected
+        return future
+
+    # Connects to the shard's leader and (re)sends every pending request. Returns False if no server answered.
+    def connect(self):
+        candidates = [(index, (address, self.port + index)) for index, address in enumerate(self.servers)]
+        winner = probe_leaders(candidates, PROBE_TIMEOUT)
+        with self.lock:
+            if winner is None:
+                pending, self.pending, self.sock = self.pending, {}, None
+                for _, future in pending.values():
+                    future.set_exception(ConnectionError('shard {} is unavailable'.format(self.shard)))
+                return False
+            self.sock = winner[1]
+            log.info('Forwarding to shard {} @ {}:{}', self.shard, self.servers[winner[0]], self.port + winner[0])
+            hello = json.dumps({'id': 0, 'type': FORWARD_HELLO, 'shard': LOCAL_SHARD, 'secret': SECRET}).encode(encoding=ENCODING)
+            try:
+                self.sock.send_frames([(MSG_FORWARD, hello)] + [(MSG_FORWARD, payload) for payload, _ in self.pending.values()])
+            except OSError:
+                pass # the reader notices the disconnect
+        return True
+
+    # Fails every pending request, and closes the connection (the next request connects again)
+    def reject(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.sock.close()
+            self.sock = None
+        for _, future in pending.values():
+            future.set_exception(ConnectionError('shard {} rejected this server'.format(self.shard)))
+
+    # Reads answers until no server of the shard can be reached
+    def read_loop(self):
+        if not self.connect():
+            return
+        detector = heartbeat.new_detector()
+        while True:
+            try:
+                frame = self.sock.recv_frame(timeout=heartbeat.HEARTBEAT_INTERVAL)
+            except TimeoutError:
+                if not detector.suspect():
+                    try:
+                        self.sock.send_frame(MSG_HEARTBEAT, b'') # the leader answers, so an idle connection is not suspected
+                    except OSError:
+                        pass
+                    continue
+                frame = None
+            except OSError:
+                frame = None
+            if frame is None:
+                log.warning('Shard {} leader disconnected!', self.shard)
+                self.sock.close()
+                if not self.connect():
+                    return
+                detector = heartbeat.new_detector()
+                continue
+            detector.heartbeat()
+            msg_type, message = frame
+            # Backup IP addresses of the shard (indexed by machine number, so only from its first leader)
+            if msg_type == MSG_INIT and len(self.servers) == 1:
+                self.servers.extend(message.decode(encoding=ENCODING).split(',')[:-1])
+            elif msg_type == MSG_FORWARD:
+                answer = json.loads(message.decode(encoding=ENCODING))
+                if answer['status'] == REJECTED:
+                    log.warning('Shard {} rejected this server (is --shard-secret the same on every server?)', self.shard)
+                    self.reject()
+                    return
+                with self.lock:
+                    _, future = self.pending.pop(answer['id'], (None, None))
+                if future is not None:
+                    future.set_result(answer)
+
+forwarders      = {} # shard name -> Forwarder
+forwarders_lock = Lock()
+
+# Forwarder to the leader of a shard
+def forwarder(shard):
+    with forwarders_lock:
+        if shard not in forwarders:
+            forwarders[shard] = Forwarder(shard, SHARDS.addresses[shard])
+        return forwarders[shard]
+
+# Forwards a request to the leader of a shard. Returns a Future of its answer.
+def forward(shard, request):
+    return forwarder(shard).request(request)
+
+# Forwards a request to the leader of every other shard. Returns a Future of the combined answer
+# ({delivered, queued, unavailable shards}), or None if there are no other shards.
+def forward_all(request):
+    if SHARDS is None or len(SHARDS.addresses) == 1:
+        return None
+    shards = [shard for shard in SHARDS.addresses if shard != LOCAL_SHARD]
+    combined = Future()
+    answer = {'delivered': 0, 'queued': 0, 'unavailable': []}
+    remaining = [len(shards)]
+    lock = Lock()
+
+    def done(shard, future):
+        with lock:
+            try:
+                result = future.result()
+                answer['delivered'] += result.get('delivered', 0)
+                answer['queued'] += result.get('queued', 0)
+            except ConnectionError:
+                answer['unavailable'].append(shard)
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            combined.set_result(answer)
+
+    for shard in shards:
+        forward(shard, request).add_done_callback(lambda future, shard=shard: done(shard, future))
+    return combined
+
+# Waits for the answer to a forwarded request. Returns None if the shard did not answer.
+def wait(future):
+    try:
+        return future.result(timeout=FORWARD_TIMEOUT)
+    except (ConnectionError, FutureTimeoutError):
+        return None
+
+async def wait_async(future):
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), FORWARD_TIMEOUT)
+    except (ConnectionError, asyncio.TimeoutError):
+        return None
+
+# Hands every user whose home shard is another one over to it, one user at a time: the user's record is adopted by its
+# home shard before the user is deleted here (users that could not be handed over are tried again at the next start)
+def hand_off_users(users, replicator):
+    moved = 0
+    for username in [username for username in list(users) if remote_home(username) is not None]:
+        user = users.get(username)
+        if user is None:
+            continue
+        shard = remote_home(username)
+        answer = wait(forward(shard, {'type': FORWARD_ADOPT, 'username': username, 'record': user.record()}))
+        if answer is None or answer['status'] not in (ADOPTED, EXISTS):
+            log.warning('LEADER: could not hand {} over to shard {}', username, shard)
+            continue
+        replicator.wait(replicator.replicate_many([[OP_DELETE_USER, username]]))
+        moved += 1
+    if moved:
+        log.info('LEADER: handed {} users over to their home shards', moved)
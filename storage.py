@@ -0,0 +1,251 @@
+'''
+This file implements on-disk persistence of the 'users' state (accounts and mailboxes).
+
+Every replication log operation is appended to a write-ahead log before it is acknowledged.
+A single writer thread batches all pending operations into one write and one fsync (group commit).
+The log is split into segments; once a segment holds SNAPSHOT_EVERY operations, a new segment is
+started and a background thread compacts the old snapshot and the closed segments into a new
+snapshot. On startup, recover() loads the snapshot and replays the log segments after it.
+
+A backup that catches up from a leader's snapshot replaces its whole log with reset().
+
+Files in the data directory:
+    - snapshot.json: {"seq": N, "users": {username: [password, mailbox, sessions, drained, groups]}} with all operations up to N (see User.record())
+    - wal-<first seq>.log: replication log operations as MSG_OP frames (see protocol.py)
+    - epoch: server ID of the leader whose operations a backup last persisted (see replication.py)
+'''
+# Import relevant python packages
+from queue import Queue, Empty
+from threading import Condition, Lock, Thread
+import json
+import os
+
+from protocol import encode_frame, HEADER, MSG_OP
+from replication import apply_op, decode_op
+from store import User
+import log
+
+# Constants/configurations
+ENCODING       = 'utf-8' # message encoding
+SNAPSHOT_EVERY = 100000 # number of logged operations after which a new snapshot is written
+SNAPSHOT_FILE  = 'snapshot.json'
+SEGMENT_FORMAT = 'wal-{:020d}.log'
+EPOCH_FILE     = 'epoch'
+NO_EPOCH       = -1 # no epoch has been persisted
+
+# Yields (seq, op) for every complete operation in a log segment (a torn write at the end is ignored)
+def read_segment(path):
+    with open(path, 'rb') as segment:
+        data = segment.read()
+    offset = 0
+    while len(data) - offset >= HEADER.size:
+        length, _ = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        if len(data) - start < length:
+            break
+        yield decode_op(data[start:start+length])
+        offset = start + length
+
+# Loads a snapshot into users. Returns the sequence number of the last operation it contains.
+def load_snapshot(path, users):
+    if not os.path.exists(path):
+        return 0
+    with open(path, encoding=ENCODING) as snapshot:
+        snapshot = json.load(snapshot)
+    for username, record in snapshot['users'].items():
+        users[username] = User.from_record(record)
+    return snapshot['seq']
+
+# Copy of the users state that can be JSON encoded
+def snapshot_state(users):
+    return {username: user.record() for username, user in users.items()}
+
+# Releases the broadcast messages (see BODIES in store.py) held by a users state that is thrown away
+def discard_state(users):
+    for user in users.values():
+        user.mailbox.drain(len(user.mailbox))
+
+# Atomically replaces the snapshot file with the given users state (see snapshot_state())
+def write_snapshot(path, seq, state):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding=ENCODING) as snapshot:
+        json.dump({'seq': seq, 'users': state}, snapshot, separators=(',', ':'))
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(tmp_path, path)
+
+class Storage:
+    def __init__(self, data_dir, snapshot_every=SNAPSHOT_EVERY):
+        self.data_dir       = data_dir
+        self.snapshot_every = snapshot_every
+        self.queue          = Queue() # lists of (seq, MSG_OP payload) waiting to be written
+        self.segment        = None # open file of the current log segment
+        self.segment_ops    = 0 # number of operations in the current log segment
+        self.closed         = [] # paths of full log segments that have not been compacted yet
+        self.compacting     = False
+        self.durable        = 0 # sequence number of last operation written and fsynced
+        self.epoch          = NO_EPOCH # leader that the persisted operations came from (backups only)
+        self.lock           = Lock()
+        self.condition      = Condition(self.lock)
+        self.on_sync        = None # called with the new durable sequence number after each fsync
+        os.makedirs(data_dir, exist_ok=True)
+
+    def path(self, filename):
+        return os.path.join(self.data_dir, filename)
+
+    def segment_paths(self):
+        return sorted(self.path(name) for name in os.listdir(self.data_dir) if name.startswith('wal-') and name.endswith('.log'))
+
+    # Loads the snapshot and replays the log into users, then starts the writer thread.
+    # Returns the sequence number of the last recovered operation.
+    def recover(self, users):
+        seq = load_snapshot(self.path(SNAPSHOT_FILE), users)
+        snapshot_seq, replayed = seq, 0
+        for path in self.segment_paths():
+            # Segment that was created right before a crash
+            if os.path.getsize(path) == 0:
+                os.remove(path)
+                continue
+            for op_seq, op in read_segment(path):
+                if op_seq > seq:
+                    apply_op(users, op)
+                    seq = op_seq
+                    replayed += 1
+            self.closed.append(path)
+        log.info('STORAGE: recovered {} users from snapshot @ {} and {} logged operations (last seq {})', len(users), snapshot_seq, replayed, seq)
+
+        if os.path.exists(self.path(EPOCH_FILE)):
+            with open(self.path(EPOCH_FILE), encoding=ENCODING) as epoch:
+                self.epoch = int(epoch.read())
+
+        self.durable = seq
+        self.open_segment(seq + 1)
+        Thread(target=self.write_loop, daemon=True).start()
+        if self.closed:
+            self.start_compaction()
+        return seq
+
+    # Queues an operation to be appended to the log (call wait() to know when it is durable)
+    def append(self, seq, payload):
+        self.queue.put([(seq, payload)])
+
+    # Queues a list of (seq, payload) operations to be appended to the log
+    def append_many(self, entries):
+        self.queue.put(entries)
+
+    # Queues replacing the whole log with a snapshot of users at sequence number seq (after catching up from a leader's snapshot)
+    def reset(self, seq, users):
+        self.queue.put([(seq, snapshot_state(users))])
+
+    # Atomically records the leader that the persisted operations came from.
+    # Only call once an operation from that leader is durable, so a crash in between never claims operations it does not have.
+    def save_epoch(self, epoch):
+        tmp_path = self.path(EPOCH_FILE) + '.tmp'
+        with open(tmp_path, 'w', encoding=ENCODING) as epoch_file:
+            epoch_file.write(str(epoch))
+            epoch_file.flush()
+            os.fsync(epoch_file.fileno())
+        os.replace(tmp_path, self.path(EPOCH_FILE))
+        self.epoch = epoch
+
+    # Blocks until the operation with sequence number seq has been fsynced
+    def wait(self, seq):
+        with self.lock:
+            self.condition.wait_for(lambda: self.durable >= seq)
+
+    def open_segment(self, first_seq):
+        self.segment = open(self.path(SEGMENT_FORMAT.format(first_seq)), 'ab')
+        self.segment_ops = 0
+
+    # Writes everything queued with a single write and fsync (group commit)
+    def write_loop(self):
+        while True:
+            batch = list(self.queue.get())
+            try:
+                while True:
+                    batch.extend(self.queue.get_nowait())
+            except Empty:
+                pass
+            ops = []
+            for seq, payload in batch:
+                # Snapshot queued by reset()
+                if isinstance(payload, dict):
+                    self.write_batch(ops)
+                    self.write_reset(seq, payload)
+                    ops = []
+                else:
+                    ops.append((seq, payload))
+            self.write_batch(ops)
+
+    def write_batch(self, batch):
+        if not batch:
+            return
+        self.segment.write(b''.join(encode_frame(MSG_OP, payload) for _, payload in batch))
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.segment_ops += len(batch)
+        self.synced(batch[-1][0])
+
+        # Start a new segment and compact the full one in the background
+        if self.segment_ops >= self.snapshot_every:
+            self.segment.close()
+            with self.lock:
+                self.closed.append(self.segment.name)
+            self.open_segment(batch[-1][0] + 1)
+            self.start_compaction()
+
+    def synced(self, seq):
+        with self.lock:
+            self.durable = seq
+            self.condition.notify_all()
+        if self.on_sync is not None:
+            self.on_sync(seq)
+
+    # Replaces the snapshot and all log segments with the given state
+    def write_reset(self, seq, state):
+        self.segment.close()
+        with self.lock:
+            # A running compaction would overwrite the new snapshot with the old state
+            self.condition.wait_for(lambda: not self.compacting)
+            self.compacting = True
+        write_snapshot(self.path(SNAPSHOT_FILE), seq, state)
+        for path in self.segment_paths():
+            os.remove(path)
+        log.info('STORAGE: replaced log with snapshot @ {}', seq)
+        with self.lock:
+            self.closed = []
+            self.compacting = False
+        self.open_segment(seq + 1)
+        self.synced(seq)
+
+    def start_compaction(self):
+        with self.lock:
+            if self.compacting:
+                return
+            self.compacting = True
+            segments = list(self.closed)
+        Thread(target=self.compact, args=(segments,), daemon=True).start()
+
+    # Folds the closed log segments into a new snapshot, then deletes them
+    def compact(self, segments):
+        users = {}
+        seq = load_snapshot(self.path(SNAPSHOT_FILE), users)
+        for path in segments:
+            for op_seq, op in read_segment(path):
+                if op_seq > seq:
+                    apply_op(users, op)
+                    seq = op_seq
+        write_snapshot(self.path(SNAPSHOT_FILE), seq, snapshot_state(users))
+        discard_state(users)
+        for path in segments:
+            os.remove(path)
+        log.info('STORAGE: wrote snapshot @ {} and removed {} log segment(s)', seq, len(segments))
+
+        with self.lock:
+            self.closed = [path for path in self.closed if path not in segments]
+            self.compacting = False
+            self.condition.notify_all()
+            more = len(self.closed) > 0
+        # Segments that filled up while we were compacting
+        if more:
+            self.start_compaction()
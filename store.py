@@ -0,0 +1,204 @@
+'''
+This file implements the compact in-memory representation of the 'users' state (accounts and mailboxes).
+
+'users' maps each username to a User record with fixed attributes (__slots__) instead of a dict.
+A user's mailbox does not hold one Python str per queued message: the UTF-8 encoded bodies of all its
+messages are kept back to back in a single bytearray, and an array holds the end offset of each body
+and the ID of its sender. Sender names are interned once in SENDERS, so a queued message
+costs its encoded body plus 8 bytes, and messages are only formatted as '<sender> body' when read.
+A message broadcast to many users is stored once in BODIES, and each recipient's mailbox only holds
+its ID (the message then costs 8 bytes per recipient); it is freed once every recipient has removed it.
+
+Removing delivered messages from the front of a mailbox only advances its head; the buffers are
+compacted once at least half of them (and COMPACT_AFTER messages) have been removed.
+
+Records are only changed by the replicator's applier (see replication.py). Sessions read mailboxes
+without locking: a mailbox's buffers are published as one tuple, so a reader always sees one version.
+'''
+# Import relevant python packages
+from array import array
+from threading import Lock
+
+# Constants/configurations
+ENCODING      = 'utf-8' # message encoding
+COMPACT_AFTER = 1024 # removed messages after which a mailbox may be compacted
+NO_SENDER     = 0 # sender ID of messages stored without a sender (formatted in full)
+SHARED_BODY   = 1 << 31 # flag in the sender ID field of a message whose body is shared (the other bits are its ID in BODIES)
+
+# Interned sender names: each name is stored once and referred to by a small integer ID
+class Senders:
+    def __init__(self):
+        self.names = [None] # ID -> name (ID NO_SENDER is reserved)
+        self.ids   = {} # name -> ID
+        self.lock  = Lock()
+
+    def intern(self, name):
+        if name is None:
+            return NO_SENDER
+        sender_id = self.ids.get(name)
+        if sender_id is None:
+            with self.lock:
+                sender_id = self.ids.get(name)
+                if sender_id is None:
+                    sender_id = len(self.names)
+                    self.names.append(name)
+                    self.ids[name] = sender_id
+        return sender_id
+
+    def name(self, sender_id):
+        return self.names[sender_id]
+
+SENDERS = Senders()
+
+# Bodies of broadcast messages, shared by the mailboxes of all their recipients and freed once the last one removes them
+class Bodies:
+    def __init__(self):
+        self.entries = {} # ID -> [sender ID, UTF-8 encoded body, number of mailboxes holding the message]
+        self.next_id = 0
+        self.lock    = Lock()
+
+    # Stores a body for count recipients and returns its ID
+    def add(self, body, sender, count):
+        with self.lock:
+            body_id = self.next_id
+            self.next_id = (self.next_id + 1) % SHARED_BODY
+            self.entries[body_id] = [SENDERS.intern(sender), body.encode(encoding=ENCODING), count]
+        return body_id
+
+    # Returns (sender ID, encoded body)
+    def get(self, body_id):
+        sender_id, body, _ = self.entries[body_id]
+        return sender_id, body
+
+    # A mailbox removed the message
+    def release(self, body_id):
+        with self.lock:
+            entry = self.entries[body_id]
+            entry[2] -= 1
+            if entry[2] == 0:
+                del self.entries[body_id]
+
+    def __len__(self):
+        return len(self.entries)
+
+BODIES = Bodies()
+
+# Formats a queued message for the recipient
+def format_message(sender, body):
+    if sender is None:
+        return body
+    return '<{}> {}'.format(sender, body)
+
+# Queued messages of one user, oldest first. The buffers are only allocated once the first message is queued.
+# Messages are only appended by the applier, and buffers never change under a reader: appending only adds
+# bytes after those of existing messages, and removing messages publishes a new (data, index, head) tuple.
+class Mailbox:
+    __slots__ = ('buffers',)
+
+    def __init__(self, records=()):
+        # None, or (bytearray of UTF-8 encoded bodies, array of [end offset of the body in data, sender ID (see SENDERS)]
+        # per message, number of removed messages still in the buffers)
+        self.buffers = None
+        for record in records:
+            # A record is [sender, body], or a formatted message (snapshots written before senders were stored separately)
+            if isinstance(record, str):
+                self.append(record)
+            else:
+                self.append(record[1], record[0])
+
+    def __len__(self):
+        buffers = self.buffers
+        return len(buffers[1]) // 2 - buffers[2] if buffers is not None else 0
+
+    def __iter__(self):
+        return iter(self.messages())
+
+    # Queues a message
+    def append(self, body, sender=None):
+        if self.buffers is None:
+            self.buffers = (bytearray(), array('I'), 0)
+        data, index, _ = self.buffers
+        data += body.encode(encoding=ENCODING)
+        index.append(len(data))
+        index.append(SENDERS.intern(sender))
+
+    # Queues a broadcast message stored in BODIES (the caller holds one of its references for this mailbox)
+    def append_shared(self, body_id):
+        if self.buffers is None:
+            self.buffers = (bytearray(), array('I'), 0)
+        data, index, _ = self.buffers
+        index.append(len(data))
+        index.append(SHARED_BODY | body_id)
+
+    # Returns [sender, body] of the messages from start up to (not including) stop
+    def records(self, start=0, stop=None):
+        buffers = self.buffers
+        if buffers is None:
+            return []
+        data, index, head = buffers
+        count = len(index) // 2 - head
+        stop = count if stop is None else min(stop, count)
+        records = []
+        for position in range(head + start, head + stop):
+            sender_id = index[2*position+1]
+            if sender_id & SHARED_BODY:
+                sender_id, body = BODIES.get(sender_id & ~SHARED_BODY)
+            else:
+                begin = index[2*position-2] if position > 0 else 0
+                body = data[begin:index[2*position]]
+            records.append([SENDERS.name(sender_id), body.decode(encoding=ENCODING)])
+        return records
+
+    # Returns the formatted messages from start up to (not including) stop
+    def messages(self, start=0, stop=None):
+        return [format_message(sender, body) for sender, body in self.records(start, stop)]
+
+    # Removes the count oldest messages
+    def drain(self, count):
+        if self.buffers is None:
+            return
+        data, index, old_head = self.buffers
+        total = len(index) // 2
+        head = min(old_head + count, total)
+        for position in range(old_head, head):
+            if index[2*position+1] & SHARED_BODY:
+                BODIES.release(index[2*position+1] & ~SHARED_BODY)
+        if head == total:
+            self.buffers = None
+        elif head >= COMPACT_AFTER and 2 * head >= total:
+            cut = index[2*head-2]
+            index = index[2*head:]
+            for position in range(0, len(index), 2):
+                index[position] -= cut
+            self.buffers = (data[cut:], index, 0)
+        else:
+            self.buffers = (data, index, head)
+
+# Account of one user
+class User:
+    __slots__ = ('password', 'mailbox', 'drained', 'sessions', 'groups', 'seq', 'socket')
+
+    def __init__(self, password, mailbox=None, drained=0, sessions=None, groups=None, seq=0):
+        self.password = password
+        self.mailbox  = mailbox if mailbox is not None else Mailbox()
+        self.drained  = drained # number of messages ever removed from the mailbox (cursor of its first message)
+        self.sessions = sessions # session token -> input ID of last message sent (None until the first session)
+        self.groups   = groups # names of the groups the user is a member of (None until the first group)
+        self.seq      = seq # sequence number of the last replication log operation applied to the user
+        self.socket   = None # connection of the logged in user (leader only)
+
+    def __repr__(self):
+        return 'User({} queued, {} drained, {} sessions)'.format(len(self.mailbox), self.drained, len(self.sessions or {}))
+
+    # Copy of the replicated state of the user that can be JSON encoded (in snapshots): [password, mailbox, sessions, drained, groups]
+    # (broadcast messages are copied into the mailbox's records)
+    def record(self):
+        return [self.password, self.mailbox.records(), dict(self.sessions or {}), self.drained, sorted(self.groups or [])]
+
+    @staticmethod
+    def from_record(record):
+        password, mailbox, *rest = record
+        sessions = rest[0] if rest and rest[0] else None
+        drained  = rest[1] if len(rest) > 1 else 0
+        groups   = set(rest[2]) if len(rest) > 2 and rest[2] else None
+        return User(password, Mailbox(mailbox), drained, sessions, groups)
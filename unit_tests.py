@@ -4,10 +4,34 @@ This file implements unit tests for fault-tolerance functions
 Usage: python3 unit_tests.py
 '''
 # Import relevant python packages
-from collections import defaultdict
-from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
-from threading import Thread
-import sys
+from socket import socket, socketpair, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SO_REUSEPORT
+from threading import Event, Thread
+from time import sleep, monotonic
+from tempfile import TemporaryDirectory
+import asyncio
+import json
+
+from async_client import ChatClient
+from async_server import client_session
+from chat import ChatSession, MENU_PROMPT, CLOSED, MAIL_PAGE_SIZE, MAIL_WINDOW, CREATED, TAKEN, LOGGED_IN, LOGIN_FAILED, DUPLICATE, NOT_LOGGED_IN
+from leader_probe import probe_leaders
+from directory import Directory, Groups, LIST_PAGE_SIZE
+from heartbeat import FailureDetector
+from outbound import QueuedSocket
+from storage import Storage
+from store import User, Mailbox, BODIES
+from protocol import FramedSocket, encode_frame, MSG_TEXT, MSG_INIT, MSG_HEARTBEAT, MSG_OP, MSG_ACK, MSG_SESSION, MSG_RESUME, MSG_INPUT, MSG_INPUT_ACK, MSG_MAIL_ACK, MSG_LIST, MSG_REDIRECT, MSG_FORWARD, MSG_LOOKUP, MSG_SNAPSHOT_BEGIN, MSG_JOIN
+from replication import Replicator, BackupState, choose_compression, offered_compressions, apply_op, index_op, decode_op, encode_op, NO_EPOCH, OP_CREATE_USER, OP_DELETE_USER, OP_APPEND_MAIL, OP_DRAIN_MAIL, OP_CREATE_SESSION, OP_SENT, OP_JOIN_GROUP, OP_BROADCAST
+from read_replica import ReadServer
+from server import client_thread, recv_join
+from sharding import ShardMap, FORWARD_HELLO, FORWARD_MAIL, FORWARD_ADOPT, MAILBOX, UNKNOWN, ACCEPTED, REJECTED
+from workers import WorkerPool
+import chat
+import heartbeat
+import log
+import metrics
+import replication
+import sharding
 
 # Constants/configurations
 ENCODING    = 'utf-8' # message encoding
@@ -18,32 +42,1249 @@ SERVER_IP      = '100.90.130.16' # REPLACE ME with output of ipconfig getifaddr
 MAX_CLIENTS    = 100
 LOGIN_ATTEMPTS = 3
 
-# Updates backup server states based
-def update_state(backup_sockets, users):
-    print("LEADER: Updating states in backup replica servers")
-    for username in users:
-        for sock in backup_sockets:
-            message = '{}.{}.{}.'.format(username, users[username]['password'], len(users[username]['mailbox']))
-            if len(users[username]['mailbox']) != 0:
-                for mail in users[username]['mailbox']:
-                    message += '{}.'.format(mail)
-            sock.send(message.encode(encoding=ENCODING))
-
 # Creates a client socket for backup server to connect to leader server
 def connect_with_leader(my_machine_num):
     leader_port = PORT + leader
     client = socket(family=AF_INET, type=SOCK_STREAM) # creates client socket with IPv4 and TCP
     client.connect((server_addrs[leader], leader_port)) # connect to server socket
     print('BACKUP: ({}-{}) LEADER-BACKUP socket established @ {}:{}.'.format(leader, my_machine_num, server_addrs[leader], leader_port))
-    return client
+    return FramedSocket(client)
 
 
 leader = 0
 server_addrs = [SERVER_IP]
 
+# Replicated state of every user (see User.record()), for comparing users states
+def records(users):
+    return {username: user.record() for username, user in users.items()}
+
+# Replaying a replication log on an empty backup rebuilds the leader's users state
+def test_apply_op():
+    users = {}
+    log = [
+        [OP_CREATE_USER, 'sam', 'yushun'],
+        [OP_CREATE_USER, 'leo', 'pw.with.periods'],
+        [OP_APPEND_MAIL, 'sam', 'hi. how are you?', 'leo'],
+        [OP_APPEND_MAIL, 'sam', 'hello', 'leo'],
+        [OP_APPEND_MAIL, 'leo', '<sam> bye'], # logged before senders were replicated separately
+        [OP_DRAIN_MAIL, 'leo'],
+        [OP_DRAIN_MAIL, 'sam', 1],
+        [OP_DRAIN_MAIL, 'sam', 1], # acknowledged twice
+        [OP_CREATE_USER, 'tmp', 'tmp'],
+        [OP_DELETE_USER, 'tmp'],
+    ]
+    for op in log:
+        apply_op(users, json.loads(json.dumps(op)))
+
+    assert records(users) == {
+        'sam': ['yushun', [['leo', 'hello']], {}, 1, []],
+        'leo': ['pw.with.periods', [], {}, 1, []],
+    }, records(users)
+    assert list(users['sam'].mailbox) == ['<leo> hello']
+    print('test_apply_op passed')
+
+# Mailboxes keep bodies in contiguous buffers: messages survive partial drains and compaction, and senders are interned
+def test_store():
+    mailbox = Mailbox()
+    assert len(mailbox) == 0 and list(mailbox) == [] and mailbox.buffers is None
+    for i in range(3000):
+        mailbox.append('héllo {}'.format(i), 'user_{}'.format(i % 3))
+    mailbox.append('no sender')
+    assert len(mailbox) == 3001 and mailbox.messages(0, 2) == ['<user_0> héllo 0', '<user_1> héllo 1']
+
+    # Removing less than half of the messages only advances the head, removing more compacts the buffers
+    mailbox.drain(1000)
+    assert mailbox.buffers[2] == 1000 and mailbox.messages(0, 1) == ['<user_1> héllo 1000']
+    mailbox.drain(1000)
+    assert mailbox.buffers[2] == 0 and len(mailbox.buffers[1]) == 2 * 1001 and mailbox.records(999) == [['user_2', 'héllo 2999'], [None, 'no sender']]
+    assert len(mailbox.buffers[0]) == sum(len('héllo {}'.format(i).encode(encoding=ENCODING)) for i in range(2000, 3000)) + len('no sender')
+    mailbox.drain(5000)
+    assert len(mailbox) == 0 and mailbox.buffers is None
+
+    # A user's record round-trips through JSON (snapshots)
+    user = User('pw', Mailbox([['alice', 'hi'], '<bob> formatted']), drained=7, sessions={'token': 3}, groups={'team'})
+    assert User.from_record(json.loads(json.dumps(user.record()))).record() == ['pw', [['alice', 'hi'], [None, '<bob> formatted']], {'token': 3}, 7, ['team']]
+    print('test_store passed')
+
+# Frames survive being split across recv calls and coalesced into a single recv call
+def test_frame_reader():
+    sender, reciever = socketpair()
+    reader = FramedSocket(reciever)
+    messages = ['hi. how are you?', 'x' * 5000, '', 'bye']
+
+    # Coalesced: all frames in a single send
+    FramedSocket(sender).send_frames([(MSG_TEXT, m.encode(encoding=ENCODING)) for m in messages])
+    for message in messages:
+        assert reader.recv_text() == message
+
+    # Partial: one frame dribbled one byte at a time
+    data = encode_frame(MSG_OP, 'sam.yushun'.encode(encoding=ENCODING))
+    for i in range(len(data)):
+        sender.send(data[i:i+1])
+    assert reader.recv_frame() == (MSG_OP, b'sam.yushun')
+
+    # Disconnect
+    sender.close()
+    assert reader.recv_frame() is None
+    reciever.close()
+    print('test_frame_reader passed')
+
+# Records everything a ChatSession sends instead of writing to a socket
+class FakeConnection:
+    def __init__(self):
+        self.sent   = []
+        self.policy = 'mailbox'
+
+    def send_frames(self, frames):
+        self.sent.extend(payload.decode(encoding=ENCODING) for _, payload in frames)
+
+    def reserve(self, size):
+        return True
+
+    def send_reserved(self, data):
+        reader = FramedSocket(None)
+        reader.buffer += data
+        self.send_frames(list(reader.frames()))
+
+    def send_text(self, text):
+        self.sent.append(text)
+
+    def close(self):
+        pass
+
+# Applies operations and records the replication log instead of sending it to backups
+class FakeReplicator:
+    def __init__(self, users):
+        self.users     = users
+        self.log       = []
+        self.directory = Directory(users)
+        self.groups    = Groups(users)
+        self.waits     = 0
+
+    def replicate(self, op):
+        return self.replicate_many([op])
+
+    def replicate_many(self, ops):
+        for op in ops:
+            deleted = self.users.get(op[1]) if op[0] == OP_DELETE_USER else None
+            apply_op(self.users, op)
+            index_op(self.directory, self.groups, self.users, op, deleted)
+            self.log.append(op)
+        return len(self.log)
+
+    def wait(self, seq):
+        pass
+
+    async def wait_async(self, seq):
+        self.waits += 1
+
+# Starts a session over a fake connection (a new FakeConnection by default) and handles the given lines of client input
+def start_session(users, active_sockets, replicator, lines=(), sock=None):
+    sock = sock if sock is not None else FakeConnection()
+    active_sockets.add(sock)
+    session = ChatSession(sock, ('127.0.0.1', 0), users, active_sockets, replicator)
+    session.start()
+    for text in lines:
+        session.handle(text)
+    session.flush()
+    return sock, session
+
+# Account creation, mailbox delivery, login and account deletion through the session state machine
+def test_chat_session():
+    users, active_sockets = {}, set()
+    replicator = FakeReplicator(users)
+
+    def connect():
+        return start_session(users, active_sockets, replicator)
+
+    # Session replies are sent once per line of client input
+    def handle(session, text):
+        session.handle(text)
+        session.flush()
+
+    alice, alice_session = connect()
+    for text in ['1', 'alice\n', 'pw\n']:
+        handle(alice_session, text)
+    bob, bob_session = connect()
+    for text in ['1', 'bob\n', 'pw\n']:
+        handle(bob_session, text)
+    bob_session.disconnect()
+    assert alice.sent[-1] == MENU_PROMPT
+
+    # Offline recipient: message goes to (replicated) mailbox
+    for text in ['1', 'bob\n', 'hi. bob\n']:
+        handle(alice_session, text)
+    assert list(users['bob'].mailbox) == ['<alice> hi. bob\n']
+
+    # Login delivers the mailbox, which is drained once the client acknowledges it
+    bob, bob_session = connect()
+    for text in ['2', 'bob\n', 'wrong\n', 'bob\n', 'pw\n']:
+        handle(bob_session, text)
+    page = json.loads([sent for sent in bob.sent if sent.startswith('{')][-1])
+    assert page['messages'] == ['<alice> hi. bob\n'] and list(users['bob'].mailbox) == ['<alice> hi. bob\n']
+    bob_session.handle_frame(MSG_MAIL_ACK, str(page['start'] + len(page['messages'])).encode(encoding=ENCODING))
+    bob_session.flush()
+    assert list(users['bob'].mailbox) == []
+
+    # Online recipient: message is delivered directly
+    for text in ['1', 'bob\n', 'hello\n']:
+        handle(alice_session, text)
+    assert bob.sent[-1] == '<alice> hello\n'
+
+    for text in ['3', 'confirm\n']:
+        handle(alice_session, text)
+    assert alice_session.state == CLOSED and 'alice' not in users and alice not in active_sockets
+
+    # Backups recieved the same operations, so replaying them gives the same state
+    replica = {}
+    for op in replicator.log:
+        apply_op(replica, op)
+    assert records(replica) == {'bob': ['pw', [], {}, 1, []]}
+    print('test_chat_session passed')
+
+# Records frames (not only text) that a ChatSession sends
+class FakeFramedConnection(FakeConnection):
+    def send_frames(self, frames):
+        self.sent.extend(frames)
+
+    def send_text(self, text):
+        self.sent.append((MSG_TEXT, text.encode(encoding=ENCODING)))
+
+# Frames queued by several sessions at once never interleave, and a full queue spills, drops, or blocks per policy
+def test_outbound():
+    def reader(sock, count, frames):
+        sock = FramedSocket(sock)
+        for _ in range(count):
+            frames.append(sock.recv_frame())
+
+    # Concurrent senders (own replies and deliveries) with a slow reader
+    leader_end, client_end = socketpair()
+    connection, frames = QueuedSocket(leader_end, limit=1 << 30), []
+    def deliver(name):
+        for i in range(500):
+            message = encode_frame(MSG_TEXT, '{} {} '.format(name, i).encode(encoding=ENCODING) * 100)
+            assert connection.reserve(len(message))
+            connection.send_reserved(message)
+    senders = [Thread(target=deliver, args=(name,)) for name in ['alice', 'bob']]
+    for sender in senders:
+        sender.start()
+    connection.send_frames([(MSG_TEXT, b'reply')] * 500)
+    reader(client_end, 1500, frames)
+    for sender in senders:
+        sender.join()
+    for name in ['alice', 'bob']:
+        payloads = [payload for _, payload in frames if payload.startswith(name.encode(encoding=ENCODING))]
+        assert payloads == ['{} {} '.format(name, i).encode(encoding=ENCODING) * 100 for i in range(500)]
+    connection.close()
+    client_end.close()
+
+    # Client that does not read at all
+    def full_connection(policy):
+        leader_end, client_end = socketpair()
+        connection = QueuedSocket(leader_end, limit=64 * 1024, policy=policy)
+        while connection.queued <= connection.limit:
+            connection.send_frames([(MSG_TEXT, b'x' * 16384)])
+        return connection, client_end
+
+    connection, client_end = full_connection('mailbox')
+    assert not connection.reserve(100)
+    # A message for an online user whose connection is full goes to its mailbox
+    users = {}
+    replicator = FakeReplicator(users)
+    replicator.replicate([OP_CREATE_USER, 'bob', 'pw'])
+    users['bob'].socket = connection
+    alice = FakeConnection()
+    session = ChatSession(alice, ('127.0.0.1', 0), users, {alice, connection}, replicator)
+    session.username = 'alice'
+    session.prompt_menu()
+    for text in ['1', 'bob', 'hi. bob']:
+        session.handle(text)
+    assert list(users['bob'].mailbox) == ['<alice> hi. bob']
+    connection.close()
+    client_end.close()
+
+    connection, client_end = full_connection('drop')
+    assert not connection.reserve(100)
+    client_end.settimeout(5)
+    while client_end.recv(1 << 20):
+        pass # queued data, then EOF
+    connection.close()
+    client_end.close()
+
+    connection, client_end = full_connection('block')
+    assert connection.reserve(100)
+    connection.send_reserved(encode_frame(MSG_TEXT, b'y' * 95))
+    def drain():
+        sleep(0.2)
+        while client_end.recv(1 << 20):
+            pass
+    drainer = Thread(target=drain, daemon=True)
+    drainer.start()
+    connection.wait_for_room() # returns once the client has read
+    assert connection.queued <= connection.limit
+    connection.close() # the drainer reads EOF and exits before its socket is closed
+    drainer.join()
+    client_end.close()
+    print('test_outbound passed')
+
+# A large mailbox is delivered in windows of pages, and only acknowledged messages are removed from it
+def test_mailbox_pages():
+    users, active_sockets = {}, set()
+    replicator = FakeReplicator(users)
+    replicator.replicate([OP_CREATE_USER, 'bob', 'pw'])
+    for i in range(1000):
+        replicator.replicate([OP_APPEND_MAIL, 'bob', 'mail {}'.format(i)])
+
+    def login():
+        return start_session(users, active_sockets, replicator, ['2', 'bob\n', 'pw\n'])
+
+    def pages(sock):
+        return [json.loads(sent) for sent in sock.sent if sent.startswith('{')]
+
+    def ack(session, page):
+        session.handle_frame(MSG_MAIL_ACK, str(page['start'] + len(page['messages'])).encode(encoding=ENCODING))
+        session.flush()
+
+    # Only MAIL_WINDOW pages are sent before the client acknowledges any
+    bob, bob_session = login()
+    sent = pages(bob)
+    assert len(sent) == MAIL_WINDOW and [page['start'] for page in sent] == [i * MAIL_PAGE_SIZE for i in range(MAIL_WINDOW)]
+    assert sent[0]['messages'][0] == 'mail 0' and sent[-1]['remaining'] == 1000 - MAIL_WINDOW * MAIL_PAGE_SIZE
+    ack(bob_session, sent[0])
+    ack(bob_session, sent[1])
+    assert len(pages(bob)) == MAIL_WINDOW + 2 and len(users['bob'].mailbox) == 1000 - 2 * MAIL_PAGE_SIZE
+
+    # Connection drops halfway through: the next login continues after the last acknowledged page
+    bob_session.disconnect()
+    bob, bob_session = login()
+    assert pages(bob)[0]['start'] == 2 * MAIL_PAGE_SIZE and pages(bob)[0]['messages'][0] == 'mail {}'.format(2 * MAIL_PAGE_SIZE)
+    while bob_session.mail_cursor is not None:
+        ack(bob_session, pages(bob)[-1])
+    assert list(users['bob'].mailbox) == [] and users['bob'].drained == 1000
+    assert [message for page in pages(bob) for message in page['messages']][-1] == 'mail 999'
+    print('test_mailbox_pages passed')
+
+# The user directory pages through sorted usernames by prefix and cursor, and caches encoded pages until a user is created or deleted
+def test_directory():
+    users = {}
+    replicator = Replicator(users)
+    for i in range(250):
+        replicator.replicate([OP_CREATE_USER, 'user_{:03d}'.format(i), 'pw'])
+    replicator.replicate_many([[OP_CREATE_USER, 'alice', 'pw'], [OP_CREATE_USER, 'al', 'pw']])
+    directory = replicator.directory
+
+    # Cursor paging visits every username once, in order
+    names, cursor = [], None
+    while True:
+        page = json.loads(directory.list_page(cursor=cursor, size=100))
+        names.extend(page['users'])
+        cursor = page['cursor']
+        if cursor is None:
+            break
+    assert names == sorted(users) and page['total'] == 252
+
+    # Prefix filtering, and cached pages are shared until the directory changes
+    assert directory.page('al') == (252, ['al', 'alice'], 0, 2, None)
+    assert directory.page('user_24', cursor='user_245', size=2)[1:] == (['user_246', 'user_247'], 6, 10, 'user_247')
+    first = directory.text_page('All users:\n')
+    assert first is directory.text_page('All users:\n') and first.count(b'\n') == LIST_PAGE_SIZE + 2
+    replicator.replicate([OP_DELETE_USER, 'alice'])
+    assert directory.version == 253 and directory.page('al')[1] == ['al'] and directory.text_page('All users:\n') is not first
+
+    # Sessions answer MSG_LIST requests (once logged in)
+    sock, session = start_session(users, set(), replicator)
+    session.handle_frame(MSG_LIST, json.dumps({'prefix': 'user_1', 'size': 10}).encode(encoding=ENCODING))
+    session.flush()
+    assert json.loads(sock.sent[-1]) == {'error': 'not logged in'}
+    session.username = 'al'
+    session.handle_frame(MSG_LIST, json.dumps({'prefix': 'user_1', 'cursor': 'user_189', 'size': 10}).encode(encoding=ENCODING))
+    session.flush()
+    assert json.loads(sock.sent[-1]) == {'version': 253, 'users': ['user_19{}'.format(i) for i in range(10)], 'offset': 90, 'total': 100, 'cursor': None}
+    print('test_directory passed')
+
+# A resumable client resumes its session on a new leader and retransmits an unacknowledged message exactly once
+def test_resume_session():
+    leader_users, active_sockets = {}, set()
+    leader = FakeReplicator(leader_users)
+
+    def connect(users, replicator):
+        return start_session(users, active_sockets, replicator, sock=FakeFramedConnection())
+
+    def send_input(session, input_id, text):
+        session.handle_frame(MSG_INPUT, json.dumps([input_id, text]).encode(encoding=ENCODING))
+        session.flush()
+
+    def frames(sock, msg_type):
+        return [json.loads(payload.decode(encoding=ENCODING)) for sent_type, payload in sock.sent if sent_type == msg_type]
+
+    bob, bob_session = connect(leader_users, leader)
+    for input_id, text in enumerate(['1', 'bob\n', 'pw\n'], start=1):
+        send_input(bob_session, input_id, text)
+    bob_session.disconnect()
+    alice, alice_session = connect(leader_users, leader)
+    for input_id, text in enumerate(['1', 'alice\n', 'pw\n', '1', 'bob\n', 'hi. bob\n'], start=1):
+        send_input(alice_session, input_id, text)
+    session = frames(alice, MSG_SESSION)[0]
+    assert session['username'] == 'alice' and frames(alice, MSG_INPUT_ACK)[-1] == [6, True]
+    assert list(leader_users['bob'].mailbox) == ['<alice> hi. bob\n']
+
+    # Failover: the new leader has the replicated state, and the client never saw the last acknowledgement
+    users = {}
+    for op in leader.log:
+        apply_op(users, op)
+    replicator = FakeReplicator(users)
+    alice, alice_session = connect(users, replicator)
+    alice_session.handle_frame(MSG_RESUME, json.dumps(session).encode(encoding=ENCODING))
+    alice_session.flush()
+    assert frames(alice, MSG_RESUME) == [{'ok': True}] and alice_session.username == 'alice'
+    for input_id, text in [(4, '1'), (5, 'bob\n'), (6, 'hi. bob\n'), (7, '1'), (8, 'bob\n'), (9, 'bye\n')]:
+        send_input(alice_session, input_id, text)
+    assert list(users['bob'].mailbox) == ['<alice> hi. bob\n', '<alice> bye\n']
+
+    # Online recipient: a retransmitted message is not delivered again
+    bob, bob_session = connect(users, replicator)
+    for input_id, text in enumerate(['2', 'bob\n', 'pw\n'], start=1):
+        send_input(bob_session, input_id, text)
+    for input_id, text in [(10, '1'), (11, 'bob\n'), (12, 'hello\n'), (10, '1'), (11, 'bob\n'), (12, 'hello\n')]:
+        send_input(alice_session, input_id, text)
+    assert [payload for _, payload in bob.sent].count(b'<alice> hello\n') == 1
+
+    # Unknown sessions have to log in again
+    mallory, mallory_session = connect(users, replicator)
+    mallory_session.handle_frame(MSG_RESUME, json.dumps({'username': 'alice', 'token': 'guess'}).encode(encoding=ENCODING))
+    mallory_session.flush()
+    assert frames(mallory, MSG_RESUME) == [{'ok': False}] and mallory_session.username is None
+    print('test_resume_session passed')
+
+# Group messages and broadcasts are encoded once for online members, and replicated and stored once for offline ones
+def test_broadcast():
+    users, active_sockets = {}, set()
+    replicator = FakeReplicator(users)
+    shared_before = len(BODIES)
+
+    # Online users' connections record the encoded bytes queued for them
+    class RecordingConnection(FakeConnection):
+        def send_reserved(self, data):
+            self.sent.append(data)
+
+    def connect(username, sock):
+        return start_session(users, active_sockets, replicator, ['1', username, 'pw'], sock)[1]
+
+    def handle(session, lines):
+        for text in lines:
+            session.handle(text)
+            session.flush()
+
+    alice = connect('alice', FakeConnection())
+    bob, erin = RecordingConnection(), RecordingConnection()
+    bob_session, erin_session = connect('bob', bob), connect('erin', erin)
+    handle(bob_session, ['5', 'team'])
+    handle(erin_session, ['5', 'team'])
+    for username in ['carol', 'dave']:
+        replicator.replicate([OP_CREATE_USER, username, 'pw'])
+    replicator.replicate([OP_JOIN_GROUP, 'carol', 'team'])
+    assert sorted(replicator.groups.members('team')) == ['bob', 'carol', 'erin']
+
+    # One operation per message: online members get the same encoded bytes, offline members a reference to one stored body
+    first = len(replicator.log)
+    handle(alice, ['4', 'team', 'hello team'])
+    handle(alice, ['4', '*', 'hi all'])
+    broadcasts = replicator.log[first:]
+    assert [op[0] for op in broadcasts] == [OP_BROADCAST, OP_BROADCAST]
+    assert sorted(broadcasts[0][4]) == ['bob', 'erin'] and broadcasts[1][3] is None
+    assert bob.sent[-2:] == [encode_frame(MSG_TEXT, b'<alice> hello team'), encode_frame(MSG_TEXT, b'<alice> hi all')]
+    assert bob.sent[-1] is erin.sent[-1]
+    assert list(users['carol'].mailbox) == ['<alice> hello team', '<alice> hi all'] and list(users['dave'].mailbox) == ['<alice> hi all']
+    assert len(users['carol'].mailbox.buffers[0]) == 0 and len(BODIES) == shared_before + 2
+    assert alice.sock.sent[-2] == '\nMessage delivered to 2 active users and 2 mailboxes.\n'
+
+    # Leaving a group stops its messages, and backups replaying the log build the same state
+    handle(erin_session, ['5', 'team'])
+    handle(alice, ['4', 'team', 'bye'])
+    assert erin.sent[-1] != encode_frame(MSG_TEXT, b'<alice> bye') and list(users['carol'].mailbox)[-1] == '<alice> bye'
+    replica = {}
+    for op in replicator.log:
+        apply_op(replica, json.loads(json.dumps(op)))
+    assert records(replica) == records(users)
+
+    # A stored body is freed once every mailbox holding it has removed it
+    for state in [users, replica]:
+        apply_op(state, [OP_DRAIN_MAIL, 'carol', users['carol'].drained + 3])
+        apply_op(state, [OP_DELETE_USER, 'dave'])
+    assert len(BODIES) == shared_before
+    print('test_broadcast passed')
+
+# Users are spread over shards by consistent hashing, and adding a shard only moves users to the new shard
+def test_shard_map():
+    usernames = ['user_{}'.format(i) for i in range(20000)]
+    shards = [('a', '127.0.0.1', 1000), ('b', '127.0.0.1', 2000), ('c', '127.0.0.1', 3000)]
+    before = ShardMap(shards)
+    homes = [before.home(username) for username in usernames]
+    for name, _, _ in shards:
+        assert 0.25 < homes.count(name) / len(usernames) < 0.42, 'unbalanced shard {}'.format(name)
+
+    after = ShardMap(shards + [('d', '127.0.0.1', 4000)])
+    moved = [username for username, home in zip(usernames, homes) if after.home(username) != home]
+    assert all(after.home(username) == 'd' for username in moved)
+    assert 0.18 < len(moved) / len(usernames) < 0.32, 'moved {} users'.format(len(moved))
+    print('test_shard_map passed')
+
+# Logins are redirected to the home shard, messages are forwarded to the recipient's shard, and moved users are handed over
+def test_sharding():
+    # Shard b is a leader on loopback (serving clients and other shards like server.py does)
+    server = socket(AF_INET, SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(MAX_CLIENTS)
+    b_port = server.getsockname()[1]
+    b_users, b_sockets = {}, set()
+    b_replicator = FakeReplicator(b_users)
+
+    def serve():
+        while True:
+            sock, addr = server.accept()
+            sock = QueuedSocket(sock)
+            b_sockets.add(sock)
+            Thread(target=client_thread, args=(sock, addr, b_users, b_sockets, b_replicator), daemon=True).start()
+    Thread(target=serve, daemon=True).start()
+
+    # A server that is not sharded does not take forwarded requests, even with a hello
+    def forward(session, requests):
+        for request in requests:
+            session.handle_frame(MSG_FORWARD, json.dumps(request).encode(encoding=ENCODING))
+        session.flush()
+        return [json.loads(payload.decode(encoding=ENCODING))['status'] for msg_type, payload in session.sock.sent if msg_type == MSG_FORWARD]
+    unsharded = ChatSession(FakeFramedConnection(), ('127.0.0.1', 0), b_users, b_sockets, b_replicator)
+    assert forward(unsharded, [{'id': 0, 'type': FORWARD_HELLO, 'shard': 'a', 'secret': ''}]) == [REJECTED]
+
+    sharding.configure([('a', '127.0.0.1', 1), ('b', '127.0.0.1', b_port)], 'a', 'secret')
+    homes = {}
+    for i in range(100):
+        homes.setdefault(sharding.SHARDS.home('user_{}'.format(i)), []).append('user_{}'.format(i))
+    alice, bob, carol, nobody = homes['a'][0], homes['b'][0], homes['b'][1], homes['b'][2]
+    b_replicator.replicate_many([[OP_CREATE_USER, bob, 'pw']])
+
+    a_users, a_sockets = {}, set()
+    a_replicator = FakeReplicator(a_users)
+    try:
+        # Logging in as a user of shard b redirects the client there
+        sock, session = start_session(a_users, a_sockets, a_replicator, ['2', bob + '\n'], FakeFramedConnection())
+        redirects = [json.loads(payload.decode(encoding=ENCODING)) for msg_type, payload in sock.sent if msg_type == MSG_REDIRECT]
+        assert redirects == [{'shard': 'b', 'ip': '127.0.0.1', 'port': b_port}] and bob not in a_users
+
+        # A message for a user of shard b is committed there before the sender is answered
+        def send(lines):
+            for text in lines:
+                session.handle(text)
+                if session.forward is not None:
+                    session.forwarded(sharding.wait(session.forward))
+                session.flush()
+            return [payload.decode(encoding=ENCODING) for _, payload in sock.sent[-2:]]
+        send(['1', alice + '\n', 'pw\n'])
+        assert send(['1', bob + '\n', 'hi. bob\n']) == ['\nMessage delivered to mailbox.\n', MENU_PROMPT]
+        assert list(b_users[bob].mailbox) == ['<{}> hi. bob\n'.format(alice)]
+        assert send(['1', nobody + '\n', 'hello\n']) == ['Target user {} does not exist!\n'.format(nobody), MENU_PROMPT]
+
+        # A group message is also forwarded to shard b, which sends it to its own members
+        b_replicator.replicate_many([[OP_JOIN_GROUP, bob, 'team']])
+        assert send(['4', 'team\n', 'hello team\n']) == ['\nMessage delivered to 0 active users and 1 mailboxes.\n', MENU_PROMPT]
+        assert list(b_users[bob].mailbox)[-1] == '<{}> hello team\n'.format(alice)
+
+        # A user whose home shard is b (e.g., created before shard b was added) is handed over with its mailbox
+        apply_op(a_users, [OP_CREATE_USER, carol, 'pw'])
+        apply_op(a_users, [OP_APPEND_MAIL, carol, 'kept', alice])
+        record = a_users[carol].record()
+        sharding.hand_off_users(a_users, a_replicator)
+        assert carol not in a_users and alice in a_users and b_users[carol].record() == record
+        assert carol in b_replicator.directory.usernames
+
+        # A client connection cannot forward requests: not without a hello, nor with the wrong secret
+        mail = {'id': 1, 'type': FORWARD_MAIL, 'username': bob, 'body': 'send me your password', 'sender': 'admin'}
+        adopt = {'id': 2, 'type': FORWARD_ADOPT, 'username': 'eve', 'record': a_users[alice].record()}
+        client = ChatSession(FakeFramedConnection(), ('127.0.0.1', 0), b_users, b_sockets, b_replicator)
+        wrong = {'id': 0, 'type': FORWARD_HELLO, 'shard': 'a', 'secret': 'guess'}
+        assert forward(client, [mail, adopt, wrong, mail]) == [REJECTED] * 4
+        assert list(b_users[bob].mailbox)[-1] != '<admin> send me your password' and 'eve' not in b_users
+        peer = ChatSession(FakeFramedConnection(), ('127.0.0.1', 0), b_users, b_sockets, b_replicator)
+        assert forward(peer, [dict(wrong, secret='secret'), mail]) == [ACCEPTED, MAILBOX]
+    finally:
+        sharding.configure()
+        server.close()
+    print('test_sharding passed')
+
+# Backups answer read-only requests with staleness bounds, and forward the connection to the leader on the first write
+def test_read_replica():
+    # Leader on loopback (serving clients like server.py does)
+    server = socket(AF_INET, SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(MAX_CLIENTS)
+    leader_users, leader_sockets = {}, set()
+    leader_replicator = FakeReplicator(leader_users)
+
+    def serve():
+        while True:
+            sock, addr = server.accept()
+            sock = QueuedSocket(sock)
+            leader_sockets.add(sock)
+            Thread(target=client_thread, args=(sock, addr, leader_users, leader_sockets, leader_replicator), daemon=True).start()
+    Thread(target=serve, daemon=True).start()
+
+    backup = BackupState({})
+    for seq, op in enumerate([[OP_CREATE_USER, 'bob', 'pw'], [OP_CREATE_USER, 'alice', 'pw'], [OP_DELETE_USER, 'bob']], start=1):
+        backup.handle_frame(MSG_OP, encode_op(seq, op), 0)
+    backup.heard()
+    reads = ReadServer('127.0.0.1', 0, backup, lambda: server.getsockname())
+    reads.start()
+    client = socket(AF_INET, SOCK_STREAM)
+    client.connect(reads.server.getsockname())
+    client = FramedSocket(client)
+
+    def request(msg_type, request):
+        client.send_frame(msg_type, json.dumps(request).encode(encoding=ENCODING))
+        frame = client.recv_frame()
+        assert frame[0] == msg_type
+        return json.loads(frame[1].decode(encoding=ENCODING))
+
+    try:
+        answer = request(MSG_LOOKUP, {'username': 'alice'})
+        assert answer['exists'] and answer['seq'] == 3 and answer['epoch'] == 0 and 0 <= answer['age'] < 1
+        assert not request(MSG_LOOKUP, {'username': 'bob'})['exists']
+        page = request(MSG_LIST, {'prefix': ''})
+        assert page['users'] == ['alice'] and page['total'] == 1 and page['seq'] == 3
+
+        # A backup catching up from a snapshot does not answer from its inconsistent state
+        backup.handle_frame(MSG_SNAPSHOT_BEGIN, b'3', 1)
+        assert request(MSG_LOOKUP, {'username': 'alice'})['error'] == 'catching up'
+
+        # The first write turns the connection into one to the leader
+        client.send_frame(MSG_INPUT, json.dumps([1, '1']).encode(encoding=ENCODING))
+        texts = []
+        while 'Please enter a username' not in ''.join(texts):
+            msg_type, payload = client.recv_frame()
+            if msg_type == MSG_TEXT:
+                texts.append(payload.decode(encoding=ENCODING))
+
+        # The backup stops serving read-only clients once it takes over as leader
+        reads.stop()
+        while client.recv_frame() is not None:
+            pass
+    finally:
+        client.close()
+        server.close()
+    print('test_read_replica passed')
+
+# Backup that applies and acknowledges operations (unless paused) on its end of a socketpair
+def run_backup(sock, users, paused):
+    while True:
+        frame = sock.recv_frame()
+        if frame is None:
+            return
+        if frame[0] == MSG_OP:
+            seq, op = decode_op(frame[1])
+            apply_op(users, op)
+        while paused[0]:
+            sleep(0.01)
+        if not sock.has_frame():
+            sock.send_frame(MSG_ACK, str(seq).encode(encoding=ENCODING))
+
+# Quorum waits for the configured number of acknowledgements, and a stalled backup only shows up as lag
+def test_replicator():
+    replicator = Replicator({}, quorum=1)
+    replicas = []
+    for name in ['fast', 'slow']:
+        leader_end, backup_end = socketpair()
+        users, paused = {}, [name == 'slow']
+        Thread(target=run_backup, args=(FramedSocket(backup_end), users, paused), daemon=True).start()
+        replicator.add_replica(FramedSocket(leader_end), name)
+        replicas.append((users, paused, leader_end))
+
+    # Quorum of 1 commits with the fast backup while the slow backup is paused
+    for i in range(100):
+        seq = replicator.replicate([OP_CREATE_USER, 'user_{}'.format(i), 'pw'])
+    replicator.wait(seq)
+    assert len(replicas[0][0]) == 100
+    lag = {replica['addr']: replica for replica in replicator.lag()}
+    assert lag['fast']['lag_ops'] == 0 and lag['slow']['lag_ops'] > 0
+
+    # Quorum of all waits for the slow backup to catch up
+    replicator.quorum = 'all'
+    replicas[1][1][0] = False
+    seq = replicator.replicate([OP_DELETE_USER, 'user_0'])
+    replicator.wait(seq)
+    assert len(replicas[1][0]) == 99 and all(replica['lag_ops'] == 0 for replica in replicator.lag())
+
+    # Disconnected backups no longer count towards the quorum
+    replicas[1][2].close()
+    replicator.replicate([OP_DELETE_USER, 'user_1'])
+    seq = replicator.replicate([OP_DELETE_USER, 'user_2'])
+    replicator.wait(seq)
+    print('test_replicator passed')
+
+# Backup that applies the leader's stream (log operations and snapshots) with BackupState on its end of a socketpair
+def run_catch_up_backup(sock, state):
+    while True:
+        frame = sock.recv_frame()
+        if frame is None:
+            return
+        state.handle_frame(frame[0], frame[1], 0)
+        if not sock.has_frame():
+            ack_seq = state.ack_seq()
+            if ack_seq is not None:
+                sock.send_frame(MSG_ACK, str(ack_seq).encode(encoding=ENCODING))
+
+# Sessions committing concurrently are serialized by the applier: every command gets its own consecutive sequence numbers,
+# readers never see a torn mailbox, and a backup applying the same operation stream ends up with the same state
+def test_command_applier():
+    users = {}
+    replicator = Replicator(users, quorum=1)
+    leader_end, backup_end = socketpair()
+    backup = BackupState({})
+    Thread(target=run_catch_up_backup, args=(FramedSocket(backup_end), backup), daemon=True).start()
+    replicator.add_replica(FramedSocket(leader_end), 'backup', **backup.position())
+    for i in range(8):
+        replicator.replicate([OP_CREATE_USER, 'user_{}'.format(i), 'pw'])
+
+    seqs, errors, stop = [], [], [False]
+    # A message and the drain of the recipient's oldest message are committed together
+    def ops(i, j):
+        return [[OP_APPEND_MAIL, 'user_{}'.format(j % 8), 'message {} {}'.format(i, j), 'user_{}'.format(i)],
+                [OP_DRAIN_MAIL, 'user_{}'.format(j % 8), users['user_{}'.format(j % 8)].drained + 1]]
+    def session(i):
+        for j in range(300):
+            seqs.append(replicator.replicate_many(ops(i, j)))
+    # Like the sessions of a worker process: several commands at once, applied in order
+    def worker(i):
+        for j in range(0, 300, 3):
+            commands = replicator.replicate_commands([ops(i, j + k) for k in range(3)])
+            batch = [command.result() for command in commands]
+            if batch != list(range(batch[0], batch[0] + 6, 2)):
+                errors.append(batch)
+            seqs.extend(batch)
+    def reader():
+        while not stop[0]:
+            for user in list(users.values()):
+                for message in user.mailbox:
+                    if not message.startswith('<user_'):
+                        errors.append(message)
+    threads = [Thread(target=session if i % 2 == 0 else worker, args=(i,)) for i in range(8)]
+    reader_thread = Thread(target=reader)
+    reader_thread.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop[0] = True
+    reader_thread.join()
+
+    assert not errors and sorted(seqs) == list(range(10, 8 + 2 * 8 * 300 + 1, 2))
+    # A command that fails does not fail the others applied with it
+    commands = replicator.replicate_commands([[[OP_APPEND_MAIL, 'user_0', 'before', 'user_1']], [[OP_APPEND_MAIL, 'nobody', 'lost', 'user_1']],
+                                              [[OP_APPEND_MAIL, 'user_0', 'after', 'user_1']]])
+    assert commands[2].result() == commands[0].result() + 1 and list(users['user_0'].mailbox)[-2:] == ['<user_1> before', '<user_1> after']
+    try:
+        commands[1].result()
+        assert False, 'applied an operation for a user that does not exist'
+    except KeyError:
+        pass
+    replicator.wait(replicator.seq)
+    while backup.applied_seq < replicator.seq:
+        sleep(0.01)
+    assert records(backup.users) == records(users)
+    leader_end.close()
+
+    # If the write-ahead log fails, every command of the batch fails, including those of sessions that were not the applier
+    class FailingStorage:
+        def __init__(self):
+            self.on_sync = None
+            self.release = Event()
+        def append_many(self, entries):
+            self.release.wait()
+            raise OSError('disk full')
+    storage = FailingStorage()
+    replicator = Replicator(users, quorum=0, storage=storage)
+    failures = []
+    def commit(text):
+        try:
+            replicator.replicate_many([[OP_APPEND_MAIL, 'user_0', text, 'user_1']])
+        except OSError as error:
+            failures.append(error)
+    threads = [Thread(target=commit, args=('message {}'.format(i),)) for i in range(3)]
+    threads[0].start()
+    while not replicator.applying:
+        sleep(0.01)
+    for thread in threads[1:]:
+        thread.start()
+    while len(replicator.commands) < 2:
+        sleep(0.01)
+    storage.release.set()
+    for thread in threads:
+        thread.join()
+    assert len(failures) == 3
+    print('test_command_applier passed')
+
+# A joining backup catches up from the log tail if it can, otherwise from a snapshot, while clients keep writing
+def test_catch_up():
+    log_tail_size, snapshot_chunk = replication.LOG_TAIL_SIZE, replication.SNAPSHOT_CHUNK
+    replication.SNAPSHOT_CHUNK = 7
+    replication.LOG_TAIL_SIZE = 100
+    users = {}
+    replicator = Replicator(users, quorum='all')
+
+    def write(i):
+        username = 'user_{}'.format(i % 40)
+        if username not in users:
+            return replicator.replicate([OP_CREATE_USER, username, 'pw'])
+        if i % 13 == 0:
+            return replicator.replicate([OP_DELETE_USER, username])
+        if i % 7 == 0:
+            return replicator.replicate([OP_JOIN_GROUP, username, 'group_{}'.format(i % 3)])
+        if i % 5 == 0:
+            return replicator.replicate([OP_DRAIN_MAIL, username])
+        return replicator.replicate([OP_APPEND_MAIL, username, 'mail {}'.format(i)])
+
+    # Backup that already applied the first 150 operations (still in the log tail)
+    seq = 0
+    for i in range(150):
+        seq = write(i)
+    tail_state = BackupState({}, seq=seq)
+    for username, user in users.items():
+        tail_state.users[username] = User.from_record(user.record())
+    tail_state.epoch = 0
+    for i in range(150, 200):
+        write(i)
+
+    # New backup (nothing applied) and the backup that is behind join while clients keep writing
+    states = [BackupState({}), tail_state]
+    replicas = []
+    for state in states:
+        leader_end, backup_end = socketpair()
+        Thread(target=run_catch_up_backup, args=(FramedSocket(backup_end), state), daemon=True).start()
+        replicas.append(replicator.add_replica(FramedSocket(leader_end), 'backup', **state.position()))
+    assert replicas[0].snapshot_seq is not None and replicas[1].snapshot_seq is None
+    for i in range(200, 1000):
+        seq = write(i)
+    replicator.wait(seq)
+
+    assert all(replica['caught_up'] for replica in replicator.lag())
+    for state in states:
+        assert records(state.users) == records(users) and state.applied_seq == seq
+    # The backup that caught up from the snapshot indexed the groups like the leader (e.g., for the sessions of worker processes)
+    for group in ['group_0', 'group_1', 'group_2']:
+        assert sorted(states[0].groups.members(group)) == sorted(replicator.groups.members(group))
+    replication.LOG_TAIL_SIZE, replication.SNAPSHOT_CHUNK = log_tail_size, snapshot_chunk
+    print('test_catch_up passed')
+
+# Backups that offer compression get batches of operations (and snapshot chunks) through one zlib stream, and end up with the same state
+def test_compressed_replication():
+    assert offered_compressions() == ['zlib'] and choose_compression(['zlib']) == 'zlib' and choose_compression([]) is None
+    replication.configure(compression='none')
+    assert offered_compressions() == [] and choose_compression(['zlib']) is None
+    batch_delay = replication.BATCH_DELAY
+    replication.configure(compression='zlib', batch_delay=0.01)
+    users = {}
+    replicator = Replicator(users, quorum='all')
+    for i in range(50):
+        replicator.replicate([OP_CREATE_USER, 'user_{}'.format(i), 'pw'])
+        replicator.replicate([OP_APPEND_MAIL, 'user_{}'.format(i), 'hello user_{}, how are you today?'.format(i), 'user_0'])
+
+    # One backup catches up from a snapshot, the other one from the log tail, both compressed; a third one is uncompressed
+    states = [BackupState({}), BackupState({}), BackupState({})]
+    positions = [{'epoch': NO_EPOCH, 'seq': -1}, {'epoch': 0, 'seq': 0}, {'epoch': 0, 'seq': 0}]
+    # Number of batches recieved and total number of frames in them
+    def batch_totals():
+        series = replication.BATCH_FRAMES.series.get(None, [0])
+        return sum(series[:-1]), series[-1]
+    saved, (batches, frames) = replication.BYTES_SAVED.value(), batch_totals()
+    for state, position, compression in zip(states, positions, ['zlib', 'zlib', None]):
+        leader_end, backup_end = socketpair()
+        Thread(target=run_catch_up_backup, args=(FramedSocket(backup_end), state), daemon=True).start()
+        replicator.add_replica(FramedSocket(leader_end), 'backup', compression=compression, **position)
+
+    # Sessions committing concurrently within the batch window share compressed batches
+    def session(i):
+        for j in range(20):
+            seq = replicator.replicate([OP_APPEND_MAIL, 'user_{}'.format(j), 'message {} from a session'.format(j), 'user_{}'.format(i)])
+            replicator.wait(seq)
+    threads = [Thread(target=session, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    replicator.wait(replicator.seq)
+    for state in states:
+        assert records(state.users) == records(users) and state.applied_seq == replicator.seq
+    new_batches, new_frames = [total - before for total, before in zip(batch_totals(), (batches, frames))]
+    assert replication.BYTES_SAVED.value() > saved and new_frames > new_batches # more than one frame per batch on average
+    replication.configure(batch_delay=batch_delay)
+    print('test_compressed_replication passed')
+
+# Timeout-based and phi-accrual detectors suspect a silent peer, but not one that sends regular heartbeats
+def test_failure_detector():
+    detector = FailureDetector(timeout=0.5)
+    start = detector.last
+    for i in range(1, 11):
+        detector.heartbeat(start + 0.1 * i)
+    assert not detector.suspect(start + 1.4) and detector.suspect(start + 1.6)
+
+    detector = FailureDetector(phi_threshold=8)
+    start = detector.last
+    for i in range(1, 101):
+        detector.heartbeat(start + 0.1 * i + (0.02 if i % 2 else 0))
+    now = detector.last
+    assert detector.phi(now + 0.1) < 1 and not detector.suspect(now + 0.2)
+    assert detector.suspect(now + 1.0) and detector.phi(now + 2.0) > detector.phi(now + 1.0)
+    print('test_failure_detector passed')
+
+# The client finds the new leader among dead, hung, and promoted servers without waiting for TCP timeouts
+def test_probe_leaders():
+    dead = socket(AF_INET, SOCK_STREAM)
+    dead.bind(('127.0.0.1', 0))
+    dead_address = dead.getsockname()
+    dead.close() # connections are refused
+    hung = socket(AF_INET, SOCK_STREAM)
+    hung.bind(('127.0.0.1', 0))
+    hung.listen(1) # connections are queued but never answered
+    promoted = socket(AF_INET, SOCK_STREAM)
+    promoted.bind(('127.0.0.1', 0))
+    promoted.listen(1)
+
+    # Backup that takes over as leader a little later and answers the queued connection
+    def take_over():
+        sleep(0.2)
+        sock, _ = promoted.accept()
+        FramedSocket(sock).send_frame(MSG_INIT, b'')
+        sleep(0.5)
+        sock.close()
+    Thread(target=take_over, daemon=True).start()
+
+    candidates = [(0, dead_address), (1, hung.getsockname()), (2, promoted.getsockname())]
+    index, sock = probe_leaders(candidates, 2.0)
+    assert index == 2 and sock.recv_frame() == (MSG_INIT, b'')
+    sock.close()
+    assert probe_leaders(candidates[:2], 0.2) is None
+    hung.close()
+    promoted.close()
+    print('test_probe_leaders passed')
+
+# Pipelined requests of the async client library are answered in order, and survive a failover without duplicates
+def test_async_client():
+    # Two listening sockets on consecutive ports (server MACHINE_NUM listens on PORT+MACHINE_NUM)
+    while True:
+        first = socket(AF_INET, SOCK_STREAM)
+        first.bind(('127.0.0.1', 0))
+        second = socket(AF_INET, SOCK_STREAM)
+        try:
+            second.bind(('127.0.0.1', first.getsockname()[1] + 1))
+            break
+        except OSError:
+            first.close()
+            second.close()
+    first.listen(16)
+    second.listen(16) # connections are queued until the backup takes over
+    port = first.getsockname()[1]
+    server_addrs = ['127.0.0.1', '127.0.0.1']
+
+    async def start(sock, users, replicator, active_sockets):
+        async def on_connect(reader, writer):
+            await client_session(reader, writer, users, active_sockets, replicator, server_addrs)
+        return await asyncio.start_server(on_connect, sock=sock)
+
+    async def run():
+        users, active_sockets = {}, set()
+        replicator = FakeReplicator(users)
+        leader = await start(first, users, replicator, active_sockets)
+
+        alice, bob = ChatClient('127.0.0.1', port), ChatClient('127.0.0.1', port)
+        await alice.connect()
+        await bob.connect()
+        assert await alice.send('bob', 'too early') == NOT_LOGGED_IN
+        assert await alice.create('alice', 'pw') == CREATED and await bob.create('alice', 'pw') == TAKEN
+        assert await bob.create('bob', 'pw') == CREATED
+        await bob.close()
+        assert alice.servers == server_addrs # backups learned from MSG_INIT
+
+        # Pipelined: every request is written before the first answer arrives, and the leader waits for replication once per batch
+        waits = replicator.waits
+        statuses = await asyncio.gather(*(alice.send('bob', 'message {}'.format(i)) for i in range(2 * MAIL_PAGE_SIZE + 1)), alice.send('nobody', 'hi'))
+        assert statuses == [MAILBOX] * (2 * MAIL_PAGE_SIZE + 1) + [UNKNOWN]
+        assert replicator.waits - waits < len(statuses) // 2
+        assert (await alice.list_users())['users'] == ['alice', 'bob']
+
+        # A new account has no queued messages, so live ones can be fetched right away
+        carol = ChatClient('127.0.0.1', port)
+        await carol.connect()
+        assert await carol.create('carol', 'pw') == CREATED and await alice.send('carol', 'hi') == chat.DELIVERED
+        messages = []
+        while not messages: # (the answer to alice can overtake the message on carol's connection)
+            messages = await asyncio.wait_for(carol.fetch_mailbox(), 1)
+        assert messages == ['<alice> hi']
+        await carol.close()
+
+        # The leader fails while a message is in flight: it is sent exactly once
+        sending = asyncio.ensure_future(alice.send('bob', 'in flight'))
+        await asyncio.sleep(0)
+        leader.close()
+        for connection in list(active_sockets):
+            connection.writer.transport.abort()
+        backup_users = {}
+        for op in replicator.log:
+            apply_op(backup_users, op)
+        backup = await start(second, backup_users, FakeReplicator(backup_users), set())
+        assert await sending in (MAILBOX, DUPLICATE) and alice.leader == 1
+        assert await alice.send('bob', 'after failover') == MAILBOX
+
+        bob = ChatClient('127.0.0.1', port + 1)
+        await bob.connect()
+        assert await bob.login('bob', 'wrong') == LOGIN_FAILED and await bob.login('bob', 'pw') == LOGGED_IN
+        messages = await bob.fetch_mailbox()
+        expected = ['<alice> message {}'.format(i) for i in range(2 * MAIL_PAGE_SIZE + 1)] + ['<alice> in flight', '<alice> after failover']
+        assert messages == expected, messages
+        assert await alice.send('bob', 'live') == chat.DELIVERED and await bob.fetch_mailbox() == ['<alice> live']
+        await alice.close()
+        await bob.close()
+        backup.close()
+
+    asyncio.run(asyncio.wait_for(run(), 30))
+    print('test_async_client passed')
+
+# Worker processes share the client port: a message for a user logged in on another worker is delivered through that worker,
+# and every state change is applied by the leader process
+def test_workers():
+    # Client port socket of the server, listening since it was a backup (like in server.py)
+    server = socket(AF_INET, SOCK_STREAM)
+    server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    server.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    server.bind(('127.0.0.1', 0))
+    server.listen(MAX_CLIENTS)
+    port = server.getsockname()[1]
+    waiting = socket(AF_INET, SOCK_STREAM)
+    waiting.connect(('127.0.0.1', port)) # e.g., a client failing over before this server took over
+    users = {}
+    replicator = Replicator(users)
+    pool = WorkerPool(replicator, 2)
+    pool.start(server, ['127.0.0.1'])
+    assert replicator.required_acks() == 0 # workers do not count towards the quorum
+    # The workers serve the connections that waited in the backlog of the server's socket
+    waiting = FramedSocket(waiting)
+    assert waiting.recv_frame(timeout=5)[0] == MSG_INIT
+    waiting.close()
+
+    async def logged_in(username):
+        for _ in range(100):
+            if username in pool.presence:
+                return pool.presence[username]
+            await asyncio.sleep(0.01)
+
+    async def run():
+        alice = ChatClient('127.0.0.1', port)
+        await alice.connect()
+        assert await alice.create('alice', 'pw') == CREATED
+        alice_worker = await logged_in('alice')
+
+        # The kernel picks the worker of each connection: log in until bob is on the other one
+        bobs = [ChatClient('127.0.0.1', port)]
+        await bobs[0].connect()
+        assert await bobs[0].create('bob', 'pw') == CREATED
+        for _ in range(50):
+            bob = ChatClient('127.0.0.1', port)
+            await bob.connect()
+            assert await bob.login('bob', 'pw') == LOGGED_IN
+            bobs.append(bob)
+            while pool.presence.get('bob') is None:
+                await asyncio.sleep(0.01)
+            if pool.presence['bob'] != alice_worker:
+                break
+        assert pool.presence['bob'] != alice_worker
+
+        # Delivered through bob's worker (the latest login gets the message, like on a single server)
+        assert await alice.send('bob', 'across workers') == chat.DELIVERED
+        messages = []
+        for _ in range(100):
+            messages += await bob.fetch_mailbox()
+            if messages:
+                break
+            await asyncio.sleep(0.01) # the answer can overtake the message on its way through bob's worker
+        assert messages == ['<alice> across workers'], messages
+
+        # Once bob has logged out, messages go to the mailbox in the leader process's state
+        for other in bobs:
+            await other.close()
+        while 'bob' in pool.presence:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1) # the presence change reaches alice's worker
+        assert await alice.send('bob', 'later') == MAILBOX
+        assert list(users['bob'].mailbox) == ['<alice> later'] and sorted(users) == ['alice', 'bob']
+
+        # Pipelined requests: the worker sends their state changes without waiting for each one
+        statuses = await asyncio.gather(*(alice.send('bob', 'pipelined {}'.format(i)) for i in range(50)))
+        assert statuses == [MAILBOX] * 50 and list(users['bob'].mailbox)[1:] == ['<alice> pipelined {}'.format(i) for i in range(50)]
+        await alice.close()
+
+    try:
+        asyncio.run(asyncio.wait_for(run(), 60))
+    finally:
+        pool.stop()
+        server.close()
+    print('test_workers passed')
+
+# A new leader does not wait for a backup that connected but never reports its position (e.g., it failed right after connecting)
+def test_recv_join():
+    leader_end, backup_end = socketpair()
+    start = monotonic()
+    assert recv_join(FramedSocket(leader_end)) is None
+    assert monotonic() - start < 2 * heartbeat.FAILURE_TIMEOUT
+    join = {'machine_num': 1, 'epoch': 0, 'seq': 5}
+    FramedSocket(backup_end).send_frame(MSG_JOIN, json.dumps(join).encode())
+    assert recv_join(FramedSocket(leader_end)) == join
+    leader_end.close()
+    backup_end.close()
+    print('test_recv_join passed')
+
+# Restarting from the write-ahead log (with and without compaction into a snapshot) recovers the same users
+# Counters and histograms are served as plain text, and sessions time each request by handler (menu choices by choice)
+def test_metrics():
+    counter = metrics.Counter('test_total', 'Test counter', label_name='route')
+    histogram = metrics.Histogram('test_seconds', 'Test histogram', buckets=(0.1, 1.0))
+    depths = metrics.Distribution('test_depth', 'Test distribution', lambda: [0, 5, 500], buckets=(0, 10))
+    absent = metrics.Gauge('test_absent', 'Gauge with nothing to report', lambda: None)
+    counter.inc(label='mailbox')
+    counter.inc(2, 'mailbox')
+    for value in [0.05, 0.1, 0.5, 3.0]:
+        histogram.observe(value)
+    assert counter.render()[2:] == ['test_total{route="mailbox"} 3']
+    lines = histogram.render()
+    assert lines[:2] == ['# HELP test_seconds Test histogram', '# TYPE test_seconds histogram']
+    assert lines[2:5] == ['test_seconds_bucket{le="0.1"} 2', 'test_seconds_bucket{le="1.0"} 3', 'test_seconds_bucket{le="+Inf"} 4']
+    assert lines[5:] == ['test_seconds_sum 3.65', 'test_seconds_count 4']
+    assert depths.render()[2:] == ['test_depth_bucket{le="0"} 1', 'test_depth_bucket{le="10"} 2', 'test_depth_bucket{le="+Inf"} 3',
+                                   'test_depth_sum 505', 'test_depth_count 3']
+    assert absent.render() == []
+
+    # Requests are named after the state (or menu choice) that handled them, and timed once their replies are sent
+    def timed(request):
+        series = chat.REQUEST_SECONDS.series.get(request)
+        return sum(series[:-1]) if series is not None else 0 # bucket counts (the last element is the sum of the values)
+    before = {request: timed(request) for request in ['welcome', 'create_password', 'menu_list', 'menu_invalid', 'heartbeat']}
+    users = {}
+    sock, session = start_session(users, set(), FakeReplicator(users))
+    for text in ['1', 'sam', 'pw', '2', '9']:
+        session.handle_frame(MSG_TEXT, text.encode(encoding=ENCODING))
+        session.flush()
+    session.handle_frame(MSG_HEARTBEAT, b'')
+    session.flush()
+    after = {request: timed(request) for request in before}
+    assert {request: after[request] - before[request] for request in before} == \
+        {'welcome': 1, 'create_password': 1, 'menu_list': 1, 'menu_invalid': 1, 'heartbeat': 1}
+
+    # The endpoint serves every registered metric
+    server = metrics.serve('127.0.0.1', 0)
+    text = metrics.fetch('127.0.0.1', server.server_address[1])
+    server.shutdown()
+    server.server_close()
+    assert 'test_total{route="mailbox"} 3\n' in text and 'chat_request_seconds_count{request="menu_list"}' in text
+    for metric in [counter, histogram, depths, absent]:
+        metrics.REGISTRY.remove(metric)
+    print('test_metrics passed')
+
+# Log records are only formatted (by the writer thread) if their level is enabled, and sampled records once every SAMPLE_RATE
+def test_log():
+    class Probe:
+        formatted = 0
+        def __format__(self, spec):
+            Probe.formatted += 1
+            return 'probe'
+
+    level, sample_rate, queue_size = log.LOG_LEVEL, log.SAMPLE_RATE, log.QUEUE_SIZE
+    log.configure('info', 1)
+    log.debug('not logged {}', Probe())
+    log.info('logged {}', Probe())
+    log.flush()
+    assert Probe.formatted == 1
+    log.configure('debug', 3)
+    for _ in range(6):
+        log.sample(log.DEBUG, 'sampled {}', Probe())
+    log.flush()
+    assert Probe.formatted == 3
+    # A full queue drops records instead of blocking the caller
+    log.QUEUE_SIZE = 0
+    dropped = log.DROPPED.value()
+    log.warning('dropped {}', Probe())
+    assert log.DROPPED.value() == dropped + 1
+    log.QUEUE_SIZE = queue_size
+    log.configure(level, sample_rate)
+    log.flush()
+    assert Probe.formatted == 3
+    assert log.format_record(log.WARNING, 0, '{} and {}', (1, 2)).endswith('WARNING 1 and 2')
+    print('test_log passed')
+
+def test_storage():
+    log = [[OP_CREATE_USER, 'user_{}'.format(i), 'pw'] for i in range(7)]
+    log += [[OP_CREATE_SESSION, 'user_0', 'token'], [OP_SENT, 'user_0', 'token', 3]]
+    for i in range(200):
+        log.append([OP_APPEND_MAIL, 'user_{}'.format(i % 7), 'mail {}.'.format(i), 'user_{}'.format(i % 3)])
+        if i % 10 == 0:
+            log.append([OP_DRAIN_MAIL, 'user_{}'.format(i % 7)])
+            log.append([OP_BROADCAST, 'user_{}'.format(i % 7), 'broadcast {}.'.format(i), None, []])
+    expected = {}
+    for op in log:
+        apply_op(expected, op)
+    shared = len(BODIES)
+
+    with TemporaryDirectory() as data_dir:
+        users = {}
+        storage = Storage(data_dir, snapshot_every=50)
+        assert storage.recover(users) == 0
+        for seq, op in enumerate(log, start=1):
+            storage.append(seq, encode_op(seq, op))
+            if seq % 30 == 0:
+                storage.wait(seq) # several group commits, so some operations stay in the log tail
+        storage.wait(len(log))
+        while storage.compacting:
+            sleep(0.01)
+        assert len(BODIES) == shared # compaction released the broadcasts it replayed
+
+        recovered, storage = {}, Storage(data_dir)
+        assert storage.recover(recovered) == len(log)
+        assert records(recovered) == records(expected)
+        while storage.compacting:
+            sleep(0.01)
+
+        # Catching up from a leader's snapshot replaces the whole log
+        del recovered['user_0']
+        storage.reset(len(log) + 10, recovered)
+        storage.append(len(log) + 11, encode_op(len(log) + 11, [OP_DRAIN_MAIL, 'user_1']))
+        storage.wait(len(log) + 11)
+        apply_op(recovered, [OP_DRAIN_MAIL, 'user_1'])
+        reset, storage = {}, Storage(data_dir)
+        assert storage.recover(reset) == len(log) + 11 and records(reset) == records(recovered)
+        while storage.compacting:
+            sleep(0.01)
+    print('test_storage passed')
+
 def main():
-    global leader
-    global server_addrs
+    test_apply_op()
+    test_store()
+    test_frame_reader()
+    test_chat_session()
+    test_resume_session()
+    test_mailbox_pages()
+    test_directory()
+    test_outbound()
+    test_broadcast()
+    test_shard_map()
+    test_sharding()
+    test_read_replica()
+    test_replicator()
+    test_command_applier()
+    test_catch_up()
+    test_compressed_replication()
+    test_failure_detector()
+    test_probe_leaders()
+    test_async_client()
+    test_workers()
+    test_recv_join()
+    test_metrics()
+    test_log()
+    test_storage()
 
     # Simulate server
     server = socket(AF_INET, SOCK_STREAM)
@@ -55,23 +1296,19 @@ def main():
     backup_1 = connect_with_leader(1)
     backup_2 = connect_with_leader(2)
 
-    # Connect server to backups
-    server_to_backup_sockets = []
-    for _ in range(2):
-        sock, _ = server.accept()
-        server_to_backup_sockets.append(sock)
-
-    # Simulate update state
+    # Connect server to backups that have not applied anything yet
     users = {
-        'sam': {'password': 'yushun', 'mailbox': ['hi', 'hello']}
+        'sam': User('yushun', Mailbox([['leo', 'hi'], ['leo', 'hello']]))
     }
-    update_state(server_to_backup_sockets ,users)
+    replicator = Replicator(users)
+    for _ in range(2):
+        sock, addr = server.accept()
+        replicator.add_replica(FramedSocket(sock), addr[0], NO_EPOCH, -1)
     
-    message_1 = backup_1.recv(BUFFER_SIZE).decode(encoding=ENCODING)
-    message_2 = backup_2.recv(BUFFER_SIZE).decode(encoding=ENCODING)
-
-    print(message_1)
-    print(message_2)
+    # Each backup catches up from a snapshot: begin, one chunk of users, end
+    for backup in [backup_1, backup_2]:
+        for _ in range(3):
+            print(backup.recv_frame())
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,584 @@
+'''
+This file implements the multi-process leader: WORKERS processes serve the leader's clients, so handling
+connections (decoding frames, running sessions, formatting and sending replies) uses as many cores as
+there are workers instead of the single core the GIL gives the threads of one process.
+
+The leader process owns the state: its Replicator applies every state change, replicates it to the
+backups and persists it. It no longer accepts clients itself. Every worker listens on the client port
+with SO_REUSEPORT, so the kernel spreads new connections across the workers, and each worker runs the
+asyncio server (see async_server.py). The leader process's own client socket (which has listened since
+the server was a backup, so that clients could wait in its backlog during a failover) keeps getting
+its share of new connections too: every worker inherits it and accepts from it as well. The leader
+process and the workers talk over Unix sockets in a temporary directory:
+    - each worker follows the leader's replication stream like a backup that does not count towards the
+      quorum, so its sessions read 'users' from their own copy without asking the leader process
+    - state changes are sent to the leader process (WORKER_COMMIT), which applies them like the commands
+      of its own sessions. Sessions do not wait for the answer while they handle a frame, so the event
+      loop keeps serving other clients and a session's pipelined changes are sent back-to-back. Before
+      it replies, a session waits (asynchronously) until the worker's copy has applied its changes, so
+      it always reads its own changes, and the leader process tells every worker how far the quorum has
+      acknowledged the log (WORKER_COMMITTED), so clients are answered at the same point as by a single
+      process
+    - workers report which users log in and out on them (WORKER_PRESENCE), and the leader process tells
+      the other workers
+    - a message for a user logged in on another worker is sent straight to that worker's Unix socket
+      (WORKER_DELIVER), which queues it on the user's connection. If the user is no longer connected
+      there (or the connection is full), that worker queues it in the user's mailbox instead.
+
+Usage: python3 server.py LEADER_IP MACHINE_NUM --workers WORKERS
+'''
+# Import relevant python packages
+from concurrent.futures import Future
+from socket import socket, AF_INET, AF_UNIX, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SO_REUSEPORT, SOMAXCONN
+from tempfile import mkdtemp
+from threading import Condition, Lock, Thread
+import asyncio
+import atexit
+import json
+import multiprocessing
+import os
+import shutil
+
+from async_server import client_session, FrameReader, raise_fd_limit
+from chat import ChatSession
+from outbound import QueuedSocket, POLICY_MAILBOX
+from protocol import FramedSocket, encode_frame, MSG_TEXT, MSG_JOIN, MSG_ACK, MSG_HEARTBEAT, MSG_SNAPSHOT_BEGIN, MSG_WORKER
+from replication import BackupState, Command, set_future_result, OP_APPEND_MAIL, NO_EPOCH
+import heartbeat
+import log
+import outbound
+import sharding
+
+# Constants/configurations
+ENCODING      = 'utf-8' # message encoding
+WORKERS       = 1 # processes serving the leader's clients (1: the leader process serves them itself)
+OWNER_SOCKET  = 'leader.sock' # Unix socket of the leader process, in the workers' directory
+WORKER_SOCKET = 'worker_{}.sock' # Unix socket worker N recieves messages for its users on
+PEER_LIMIT    = 4 * 1024 * 1024 # bytes queued for another worker before messages for its users go to their mailboxes
+START_TIMEOUT = 60.0 # seconds the leader process waits for the workers to serve clients
+
+# Worker messages (MSG_WORKER, JSON encoded {type, ...})
+WORKER_HELLO     = 'hello'     # worker -> leader process: {type, worker}, once it listens on the client port
+WORKER_COMMIT    = 'commit'    # worker -> leader process: {type, id, ops}
+WORKER_APPLIED   = 'applied'   # leader process -> worker: {type, id, seq} (or {type, id, error} if the operations could not be applied)
+WORKER_COMMITTED = 'committed' # leader process -> worker: {type, seq}, the highest sequence number acknowledged by the quorum
+WORKER_PRESENCE  = 'presence'  # {type, username, worker}: user logged in on that worker (None: logged out), reported by it and relayed to the others
+WORKER_DELIVER   = 'deliver'   # worker -> worker: {type, username}, followed by the MSG_TEXT frame to queue on the user's connection
+
+# Overrides the module configuration (from command line options)
+def configure(workers=None):
+    global WORKERS
+    if workers is not None:
+        WORKERS = max(1, workers)
+
+# Adds the worker processes command line options to an ArgumentParser
+def add_arguments(parser):
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='processes serving clients once this server is the leader, each with an asyncio event loop (default: {}, the leader process itself)'.format(WORKERS))
+
+# Configuration of the modules a worker uses, as set in the leader process (spawned workers start from the defaults)
+def module_config():
+    shards = [(name, ip, port) for name, (ip, port) in sharding.SHARDS.addresses.items()] if sharding.SHARDS is not None else None
+    return {
+        'heartbeat': (heartbeat.HEARTBEAT_INTERVAL, heartbeat.FAILURE_TIMEOUT, heartbeat.PHI_THRESHOLD),
+        'outbound':  (outbound.OUTBOUND_LIMIT, outbound.OUTBOUND_POLICY),
+        'sharding':  (shards, sharding.LOCAL_SHARD, sharding.SECRET),
+        'log':       (log.LOG_LEVEL, log.SAMPLE_RATE, log.LOG_FILE),
+    }
+
+def configure_modules(config):
+    heartbeat.configure(*config['heartbeat'])
+    outbound.configure(*config['outbound'])
+    sharding.configure(*config['sharding'])
+    log.configure(*config['log'])
+
+def encode_message(message_type, **fields):
+    return json.dumps(dict(fields, type=message_type)).encode(encoding=ENCODING)
+
+# Client port socket of a worker: every worker binds the same port, and the kernel spreads connections across them
+def listen_shared(address):
+    server = socket(AF_INET, SOCK_STREAM)
+    server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    server.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    server.bind(address)
+    server.listen(SOMAXCONN)
+    return server
+
+def listen_unix(path):
+    server = socket(AF_UNIX, SOCK_STREAM)
+    server.bind(path)
+    server.listen(SOMAXCONN)
+    return server
+
+def connect_unix(path):
+    sock = socket(AF_UNIX, SOCK_STREAM)
+    sock.connect(path)
+    return sock
+
+# Leader-process side: starts the workers, applies their state changes, and relays who is logged in where
+class WorkerPool:
+    def __init__(self, replicator, count):
+        self.replicator = replicator
+        self.count      = count
+        self.socket_dir = mkdtemp(prefix='chat_workers_') # Unix sockets of the leader process and the workers
+        self.listener   = None
+        self.channels   = {} # worker number -> FramedSocket of its requests (from its WORKER_HELLO on)
+        self.presence   = {} # username -> number of the worker the user is logged in on
+        self.processes  = []
+        self.lock       = Lock() # guards channels and presence, and orders the presence changes sent to each worker
+        self.ready      = Condition(self.lock)
+
+    # Starts the workers on the client port (server: the leader process's listening socket, which they share),
+    # and waits until every one of them serves clients
+    def start(self, server, server_addrs):
+        address = server.getsockname()
+        self.listener = listen_unix(os.path.join(self.socket_dir, OWNER_SOCKET))
+        Thread(target=self.accept_loop, daemon=True).start()
+        Thread(target=self.commit_loop, daemon=True).start()
+        context = multiprocessing.get_context('spawn') # a fork would copy the leader's threads and locks mid-use
+        for number in range(self.count):
+            process = context.Process(target=run_worker, daemon=True,
+                                      args=(number, self.socket_dir, server, self.replicator.epoch, list(server_addrs), module_config()))
+            process.start()
+            self.processes.append(process)
+        with self.lock:
+            if not self.ready.wait_for(lambda: len(self.channels) == self.count, START_TIMEOUT):
+                raise RuntimeError('only {} of {} workers started'.format(len(self.channels), self.count))
+        log.info('LEADER: {} worker processes serving clients @ {}:{}', self.count, address[0], address[1])
+
+    # Blocks until every worker has exited
+    def wait(self):
+        for process in self.processes:
+            process.join()
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        self.wait()
+        self.listener.close()
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+    # Accepts the two connections of every worker: its replication stream (MSG_JOIN) and its requests (WORKER_HELLO)
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            sock = FramedSocket(sock)
+            try:
+                frame = sock.recv_frame(timeout=heartbeat.FAILURE_TIMEOUT)
+            except (OSError, TimeoutError):
+                frame = None
+            if frame is None:
+                sock.close()
+                continue
+            message = json.loads(frame[1].decode(encoding=ENCODING))
+            if frame[0] == MSG_JOIN:
+                self.replicator.add_replica(sock, 'worker {}'.format(message['worker']), NO_EPOCH, -1, voting=False)
+            elif frame[0] == MSG_WORKER and message['type'] == WORKER_HELLO:
+                Thread(target=self.channel_loop, args=(message['worker'], sock), daemon=True).start()
+
+    # Handles the requests of one worker until it exits
+    def channel_loop(self, number, sock):
+        with self.lock:
+            self.channels[number] = sock
+            # Sent under the lock, so every later change of presence reaches the worker after these
+            frames = [(MSG_WORKER, encode_message(WORKER_PRESENCE, username=username, worker=worker)) for username, worker in self.presence.items()]
+            frames.append((MSG_WORKER, encode_message(WORKER_COMMITTED, seq=self.replicator.committed)))
+            sock.send_frames(frames)
+            self.ready.notify_all()
+        log.info('LEADER: worker {} serving clients', number)
+        while True:
+            try:
+                frame = sock.recv_frame()
+            except OSError:
+                frame = None
+            if frame is None:
+                break
+            # Commits the worker sent back-to-back are applied as one batch
+            commits = []
+            while frame is not None:
+                request = json.loads(frame[1].decode(encoding=ENCODING))
+                if request['type'] == WORKER_COMMIT:
+                    commits.append(request)
+                elif request['type'] == WORKER_PRESENCE:
+                    self.presence_changed(number, request['username'], request['worker'])
+                frame = sock.next_frame()
+            if commits:
+                self.commit(sock, commits)
+        self.worker_failed(number)
+
+    # Applies the commands of a worker's sessions like those of any other session, and answers with their sequence numbers
+    def commit(self, sock, requests):
+        try:
+            commands = self.replicator.replicate_commands([request['ops'] for request in requests])
+        except Exception as error: # none of them was logged
+            commands = [Command(request['ops']) for request in requests]
+            for command in commands:
+                command.error = error
+        answers = []
+        for request, command in zip(requests, commands):
+            answer = {'type': WORKER_APPLIED, 'id': request['id']}
+            try:
+                answer['seq'] = command.result()
+            except Exception as error:
+                answer['error'] = repr(error)
+            answers.append((MSG_WORKER, json.dumps(answer).encode(encoding=ENCODING)))
+        try:
+            sock.send_frames(answers)
+        except OSError:
+            pass # the worker exited
+
+    # Sends the new commit point to every worker whenever the quorum acknowledges more operations
+    def commit_loop(self):
+        replicator = self.replicator
+        committed = None
+        while True:
+            with replicator.lock:
+                replicator.condition.wait_for(lambda: replicator.committed != committed)
+                committed = replicator.committed
+            with self.lock:
+                channels = list(self.channels.values())
+            for sock in channels:
+                try:
+                    sock.send_frame(MSG_WORKER, encode_message(WORKER_COMMITTED, seq=committed))
+                except OSError:
+                    pass
+
+    # Sends presence changes to every worker except the one they come from (call with lock held)
+    def send_others(self, number, changes):
+        frames = [(MSG_WORKER, encode_message(WORKER_PRESENCE, username=username, worker=worker)) for username, worker in changes]
+        for other, sock in self.channels.items():
+            if other != number:
+                try:
+                    sock.send_frames(frames)
+                except OSError:
+                    pass
+
+    def presence_changed(self, number, username, worker):
+        with self.lock:
+            if worker is not None:
+                self.presence[username] = worker
+            elif self.presence.get(username) == number:
+                del self.presence[username]
+            else:
+                return # the user has logged in on another worker since
+            self.send_others(number, [(username, worker)])
+
+    # The users of a worker that exited are offline (their clients reconnect to the other workers)
+    def worker_failed(self, number):
+        with self.lock:
+            self.channels.pop(number, None)
+            offline = [username for username, worker in self.presence.items() if worker == number]
+            for username in offline:
+                del self.presence[username]
+            self.send_others(number, [(username, None) for username in offline])
+        log.warning('LEADER: worker {} exited ({} users logged in on it)', number, len(offline))
+
+# A user logged in on another worker, as the connection a message is queued on (see ChatSession.connection()):
+# the message is sent to that worker after a WORKER_DELIVER header naming the user
+class PeerRecipient:
+    def __init__(self, peer, username):
+        self.peer   = peer # QueuedSocket to the worker, shared by all its users
+        self.header = encode_frame(MSG_WORKER, encode_message(WORKER_DELIVER, username=username))
+        self.policy = POLICY_MAILBOX # if the worker is not keeping up, messages for its users go to their mailboxes
+
+    def reserve(self, size):
+        return self.peer.reserve(len(self.header) + size)
+
+    def send_reserved(self, data):
+        self.peer.send_reserved(self.header + data)
+
+# Session of a client of a worker: state changes are applied by the leader process, users logged in on other
+# workers are reached through their worker, and logins and logouts are reported to the leader process
+# (self.replicator is the Worker, see below)
+class WorkerSession(ChatSession):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.commits = [] # Futures of the sequence numbers of state changes sent to the leader process and not applied yet
+
+    # Sends the operations to the leader process without waiting for them (see wait_committed())
+    def commit(self, *ops):
+        self.commits.append(self.replicator.commit(list(ops)))
+
+    def after_commit(self, callback):
+        if self.commits:
+            self.continuations.append(callback)
+        else:
+            callback()
+
+    # Waits until the leader process has applied the session's state changes and this worker's copy has too, runs
+    # what the session's handlers left for then (which may commit more), and waits for the quorum
+    async def wait_committed(self):
+        while self.commits:
+            commits, self.commits = self.commits, []
+            for commit in commits:
+                self.commit_seq = max(self.commit_seq, await asyncio.wrap_future(commit))
+            await self.replicator.wait_applied(self.commit_seq)
+            continuations, self.continuations = self.continuations, []
+            for continuation in continuations:
+                continuation()
+        await self.replicator.wait_async(self.commit_seq)
+
+    def attach(self, username, user):
+        super().attach(username, user)
+        self.replicator.report_presence(username, True)
+
+    def connection(self, username, user):
+        connection = super().connection(username, user)
+        return connection if connection is not None else self.replicator.recipient(username)
+
+    def close(self):
+        if self.username is not None:
+            user = self.users.get(self.username)
+            # Unless the user has logged in again on another connection since (or deleted its account)
+            if user is None or user.socket is self.sock:
+                self.replicator.report_presence(self.username, False)
+        super().close()
+
+# Worker side: a copy of 'users' that follows the leader process's replication stream, and the replicator of its
+# sessions (state changes are sent to the leader process, see WorkerSession)
+class Worker:
+    def __init__(self, number, socket_dir, epoch):
+        self.number         = number
+        self.socket_dir     = socket_dir
+        self.epoch          = epoch # server ID of the leader
+        self.users          = {}
+        self.state          = BackupState(self.users)
+        self.snapshot       = False # the snapshot of the leader's state has started (the copy is consistent once it is caught up)
+        self.applied        = Condition() # notified whenever the stream has been applied further
+        self.appliers       = [] # (seq, future) of sessions waiting for the copy to apply seq (see wait_applied())
+        self.active_sockets = set() # client connections of this worker
+        self.stream         = None # FramedSocket of the replication stream
+        self.channel        = None # FramedSocket of the requests to the leader process
+        self.pending        = {} # request ID -> Future of the answer to a commit
+        self.next_id        = 0
+        self.lock           = Lock()
+        self.committed      = 0 # highest sequence number acknowledged by the quorum
+        self.waiters        = [] # (seq, future) of sessions waiting for the quorum (event loop only)
+        self.loop           = None
+        self.presence       = {} # username -> number of the other worker the user is logged in on
+        self.peers          = {} # worker number -> QueuedSocket to that worker
+
+    # Sorted usernames and group members of the copy (see directory.py)
+    @property
+    def directory(self):
+        return self.state.directory
+
+    @property
+    def groups(self):
+        return self.state.groups
+
+    # Joins the leader process's replication stream, and waits until the copy of its state is consistent
+    def join(self):
+        self.stream = FramedSocket(connect_unix(os.path.join(self.socket_dir, OWNER_SOCKET)))
+        join = {'worker': self.number, 'epoch': NO_EPOCH, 'seq': -1, 'compression': []}
+        self.stream.send_frame(MSG_JOIN, json.dumps(join).encode(encoding=ENCODING))
+        Thread(target=self.stream_loop, daemon=True).start()
+        with self.applied:
+            if not self.applied.wait_for(lambda: self.snapshot and not self.state.catching_up(), START_TIMEOUT):
+                raise RuntimeError('worker {} did not catch up with the leader process'.format(self.number))
+
+    # Applies the replication stream and acknowledges it (the leader process suspects a silent worker, like a backup)
+    def stream_loop(self):
+        detector = heartbeat.new_detector()
+        while True:
+            try:
+                frame = self.stream.recv_frame(timeout=heartbeat.HEARTBEAT_INTERVAL)
+            except TimeoutError:
+                if not detector.suspect():
+                    continue
+                frame = None
+            except OSError:
+                frame = None
+            if frame is None:
+                self.leader_failed()
+            detector.heartbeat()
+            with self.applied:
+                self.state.handle_frame(frame[0], frame[1], self.epoch)
+                self.snapshot = self.snapshot or frame[0] == MSG_SNAPSHOT_BEGIN
+                self.applied.notify_all()
+                ready = [future for seq, future in self.appliers if seq <= self.state.applied_seq]
+                if ready:
+                    self.appliers = [(seq, future) for seq, future in self.appliers if seq > self.state.applied_seq]
+            for future in ready:
+                self.loop.call_soon_threadsafe(set_future_result, future)
+            if not self.stream.has_frame():
+                ack_seq = self.state.ack_seq()
+                try:
+                    if ack_seq is not None:
+                        self.stream.send_frame(MSG_ACK, str(ack_seq).encode(encoding=ENCODING))
+                    else:
+                        self.stream.send_frame(MSG_HEARTBEAT, b'')
+                except OSError:
+                    self.leader_failed()
+
+    # Without the leader process the copy is no longer updated: exit (clients fail over to the new leader)
+    def leader_failed(self):
+        log.error('WORKER {}: lost the leader process, exiting', self.number)
+        log.flush()
+        os._exit(1)
+
+    # Connects to the leader process for requests, once this worker listens on the client port
+    def connect_channel(self):
+        self.channel = FramedSocket(connect_unix(os.path.join(self.socket_dir, OWNER_SOCKET)))
+        Thread(target=self.channel_loop, daemon=True).start()
+        self.channel.send_frame(MSG_WORKER, encode_message(WORKER_HELLO, worker=self.number))
+
+    # Recieves the answers to commits, the commit point, and the presence changes of other workers' users
+    def channel_loop(self):
+        while True:
+            try:
+                frame = self.channel.recv_frame()
+            except OSError:
+                frame = None
+            if frame is None:
+                self.leader_failed()
+            message = json.loads(frame[1].decode(encoding=ENCODING))
+            if message['type'] == WORKER_APPLIED:
+                with self.lock:
+                    future = self.pending.pop(message['id'])
+                if 'error' in message:
+                    future.set_exception(RuntimeError('the leader process could not apply the operations: {}'.format(message['error'])))
+                else:
+                    future.set_result(message['seq'])
+            elif message['type'] == WORKER_COMMITTED:
+                self.loop.call_soon_threadsafe(self.set_committed, message['seq'])
+            elif message['type'] == WORKER_PRESENCE:
+                self.presence_changed(message['username'], message['worker'])
+
+    # Sends operations to the leader process, which applies them atomically with respect to other commands (see
+    # Replicator.replicate_many()). Returns a Future of the sequence number of the last one, without waiting for it.
+    def commit(self, ops):
+        future = Future()
+        with self.lock:
+            self.next_id += 1
+            self.pending[self.next_id] = future
+            request = encode_message(WORKER_COMMIT, id=self.next_id, ops=ops)
+        self.channel.send_frame(MSG_WORKER, request)
+        return future
+
+    # Waits (without blocking the event loop) until the copy has applied seq
+    async def wait_applied(self, seq):
+        with self.applied:
+            if self.state.applied_seq >= seq:
+                return
+            future = self.loop.create_future()
+            self.appliers.append((seq, future))
+        await future
+
+    def set_committed(self, seq):
+        self.committed = max(self.committed, seq)
+        remaining = []
+        for waiting_seq, future in self.waiters:
+            if waiting_seq <= self.committed:
+                if not future.done():
+                    future.set_result(None)
+            else:
+                remaining.append((waiting_seq, future))
+        self.waiters = remaining
+
+    # Waits (without blocking the event loop) until seq has been acknowledged by the quorum
+    async def wait_async(self, seq):
+        if self.committed >= seq:
+            return
+        future = self.loop.create_future()
+        self.waiters.append((seq, future))
+        await future
+
+    # Reports that a user logged in on this worker (or logged out) to the leader process, which tells the other workers
+    def report_presence(self, username, online):
+        if online:
+            self.presence.pop(username, None)
+        self.channel.send_frame(MSG_WORKER, encode_message(WORKER_PRESENCE, username=username, worker=self.number if online else None))
+
+    def presence_changed(self, username, worker):
+        if worker is None:
+            self.presence.pop(username, None)
+            return
+        self.presence[username] = worker
+        # Logged in again on another worker: like a second login on one server, the latest connection gets the messages
+        user = self.users.get(username)
+        if user is not None and user.socket in self.active_sockets:
+            user.socket = None
+
+    # Connection to queue a message for a user logged in on another worker on (None if the user is not)
+    def recipient(self, username):
+        worker = self.presence.get(username)
+        if worker is None:
+            return None
+        peer = self.peers.get(worker)
+        if peer is None or peer.closed:
+            try:
+                peer = QueuedSocket(connect_unix(os.path.join(self.socket_dir, WORKER_SOCKET.format(worker))), PEER_LIMIT, POLICY_MAILBOX)
+            except OSError:
+                return None # the worker exited
+            self.peers[worker] = peer
+        return PeerRecipient(peer, username)
+
+    # Queues the messages other workers send to users logged in on this one
+    async def peer_session(self, reader, writer):
+        frames = FrameReader(reader)
+        while True:
+            header = await frames.recv_frame()
+            frame = await frames.recv_frame() if header is not None else None
+            if frame is None:
+                break
+            self.deliver_here(json.loads(header[1].decode(encoding=ENCODING))['username'], frame[1])
+        writer.close()
+
+    # Queues a message on the user's connection, or in its mailbox if the user is no longer connected here (or not reading)
+    def deliver_here(self, username, message):
+        user = self.users.get(username)
+        if user is None:
+            return # deleted its account in the meantime
+        data = encode_frame(MSG_TEXT, message)
+        if user.socket in self.active_sockets and user.socket.reserve(len(data)):
+            user.socket.send_reserved(data)
+            return
+        # (the sender has been answered already, so nothing waits for it)
+        self.commit([[OP_APPEND_MAIL, username, message.decode(encoding=ENCODING)]]).add_done_callback(self.spilled)
+        log.sample(log.DEBUG, 'WORKER {}: {} is no longer connected here, message queued in mailbox', self.number, username)
+
+    def spilled(self, future):
+        if future.exception() is not None:
+            log.warning('WORKER {}: could not queue a message in a mailbox: {}', self.number, future.exception())
+
+    # Serves clients on the client port sockets and other workers on this worker's Unix socket
+    async def serve(self, servers, peer_server, server_addrs):
+        self.loop = asyncio.get_running_loop()
+
+        async def on_client(reader, writer):
+            await client_session(reader, writer, self.users, self.active_sockets, self, server_addrs, WorkerSession)
+
+        async def on_peer(reader, writer):
+            await self.peer_session(reader, writer)
+
+        clients = [await asyncio.start_server(on_client, sock=server, backlog=SOMAXCONN) for server in servers]
+        peers = await asyncio.start_unix_server(on_peer, sock=peer_server)
+        self.connect_channel()
+        try:
+            async with peers:
+                await peers.serve_forever()
+        finally:
+            for client_server in clients:
+                client_server.close()
+
+# Main function of a worker process (started by WorkerPool.start()): shared is the leader process's client socket
+def run_worker(number, socket_dir, shared, epoch, server_addrs, config):
+    configure_modules(config)
+    raise_fd_limit()
+    worker = Worker(number, socket_dir, epoch)
+    worker.join()
+    log.info('WORKER {}: caught up with the leader process @ {} ({} users)', number, worker.state.applied_seq, len(worker.users))
+    server = listen_shared(shared.getsockname())
+    peer_server = listen_unix(os.path.join(socket_dir, WORKER_SOCKET.format(number)))
+    asyncio.run(worker.serve([server, shared], peer_server, server_addrs))
+
+# Main leader server loop (worker processes on the listening client socket server): returns once every worker has exited
+def serve(replicator, server, server_addrs):
+    pool = WorkerPool(replicator, WORKERS)
+    atexit.register(shutil.rmtree, pool.socket_dir, True)
+    pool.start(server, server_addrs)
+    pool.wait()